@@ -0,0 +1,344 @@
+"""
+Cart optimiser backed by a cached table of reachable subtotals.
+
+For a set of wishlist items the table maps every reachable subtotal (in cents) to
+one item subset that reaches it. The saving of a coupon only depends on the
+subtotal, so the best cart for a coupon is found with a couple of binary searches
+on the sorted subtotals instead of enumerating every item combination.
+
+Tables only store the subtotals a coupon can pick (up to its discount cap plus the
+most expensive item, see subtotal_limit), so plans are exact; a table is rebuilt
+when a coupon needs higher subtotals than the cached one holds. A table that hits
+SUBSET_TABLE_MAX_ENTRIES is clipped and its plans are flagged as not optimal.
+
+Tables are cached by their item set and extended incrementally when items are
+added, the cache holds at most SUBSET_CACHE_MAX_ENTRIES subtotals in all; per-coupon
+plans are cached on (coupon rule hash, wishlist version) and only served with an exact table.
+
+With a deadline a table stops growing when the time is up: the plan is then the best
+one over the items added so far (expensive items first), flagged as not optimal.
+"""
+import os
+import time
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from decimal import Decimal
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from agent.models import Coupon, WishlistItem
+from agent.categories import eligible_item_indices
+
+# Most subtotals stored in one table (memory bound), a table above it is clipped
+SUBSET_TABLE_MAX_ENTRIES = int(os.getenv("SUBSET_TABLE_MAX_ENTRIES", "500000"))
+
+# Most subtotals kept by the table cache of a process (each optimiser worker has its own)
+SUBSET_CACHE_MAX_ENTRIES = int(os.getenv("SUBSET_CACHE_MAX_ENTRIES", "1000000"))
+
+def coupon_rule_hash(coupon: Coupon) -> int:
+    """Hash of the rules of a coupon, coupons with the same rules share their plans"""
+    return hash((
+        coupon.discount_type,
+        coupon.discount_value_cents,
+        coupon.discount_percentage,
+        coupon.max_discount_cents,
+        coupon.minimun_purchase_cents,
+        (coupon.product_type_limit or "").strip().lower(),
+    ))
+
+
+class CouponRules(NamedTuple):
+    """The fields of a coupon the optimiser reads, small to send to a worker process"""
+    code: str
+    discount_type: str
+    discount_value_cents: Optional[int]
+    discount_percentage: Optional[float]
+    max_discount_cents: Optional[int]
+    minimun_purchase_cents: Optional[int]
+    product_type_limit: Optional[str]
+
+    @classmethod
+    def from_coupon(cls, coupon: Coupon) -> "CouponRules":
+        return cls(coupon.code, coupon.discount_type, coupon.discount_value_cents, coupon.discount_percentage,
+                   coupon.max_discount_cents, coupon.minimun_purchase_cents, coupon.product_type_limit)
+
+
+class SubsetTable:
+    """Reachable subtotals of a set of items, with a back-pointer to rebuild one subset for each"""
+
+    def __init__(self, max_cents: int, max_entries: int = SUBSET_TABLE_MAX_ENTRIES):
+        # Subtotals above max_cents are not needed by the coupons the table is used for
+        self.max_cents = max_cents
+        self.max_entries = max_entries
+        self.items: Dict[int, int] = {}
+        # subtotal -> (item id added last, subtotal before adding it)
+        self.parents: Dict[int, Tuple[Optional[int], int]] = {0: (None, 0)}
+        self._sorted: Optional[List[int]] = None
+        # False when the deadline stopped the build before every item was added
+        self.complete = True
+        # True when subtotals were dropped to stay under max_entries
+        self.clipped = False
+
+    @property
+    def exact(self) -> bool:
+        """Every reachable subtotal up to max_cents is in the table, the plans are optimal"""
+        return self.complete and not self.clipped
+
+    @classmethod
+    def build(cls, items: Dict[int, int], max_cents: int,
+              deadline: Optional[float] = None) -> "SubsetTable":
+        table = cls(max_cents)
+        # Expensive items first, the subsets found first tend to have fewer items
+        for item_id, cents in sorted(items.items(), key=lambda it: it[1], reverse=True):
+            if deadline is not None and time.time() >= deadline:
+                table.complete = False
+                break
+            table.add(item_id, cents)
+        return table
+
+    def copy(self) -> "SubsetTable":
+        table = SubsetTable(self.max_cents, self.max_entries)
+        table.items = dict(self.items)
+        table.parents = dict(self.parents)
+        table.clipped = self.clipped
+        return table
+
+    def add(self, item_id: int, cents: int):
+        """Add an item, every existing subtotal can now also be reached with it"""
+        self.items[item_id] = cents
+        self._sorted = None
+        if cents <= 0:
+            return
+        new = {}
+        for total in self.parents:
+            reached = total + cents
+            if reached <= self.max_cents and reached not in self.parents:
+                new[reached] = (item_id, total)
+        room = self.max_entries - len(self.parents)
+        if len(new) > room:
+            # Memory bound, the lowest subtotals are kept
+            self.clipped = True
+            new = dict(sorted(new.items())[:max(room, 0)])
+        # Existing entries are never replaced, so chains only go through items added before
+        self.parents.update(new)
+
+    def subtotals(self) -> List[int]:
+        """Reachable subtotals above zero, sorted"""
+        if self._sorted is None:
+            self._sorted = sorted(total for total in self.parents if total > 0)
+        return self._sorted
+
+    def subset(self, total: int) -> List[int]:
+        """Item ids of the subset stored for a subtotal"""
+        ids = []
+        while total:
+            item_id, total = self.parents[total]
+            ids.append(item_id)
+        return ids
+
+    def largest_between(self, low: int, high: int) -> Optional[int]:
+        """Largest reachable subtotal in [low, high]"""
+        subtotals = self.subtotals()
+        i = bisect_right(subtotals, high) - 1
+        if i >= 0 and subtotals[i] >= low:
+            return subtotals[i]
+        return None
+
+    def smallest_from(self, low: int) -> Optional[int]:
+        """Smallest reachable subtotal >= low"""
+        subtotals = self.subtotals()
+        i = bisect_left(subtotals, low)
+        return subtotals[i] if i < len(subtotals) else None
+
+
+def coupon_saving(subtotal: int, coupon: Coupon) -> Decimal:
+    """Saving in cents of a coupon for a subtotal in cents"""
+    if subtotal < (coupon.minimun_purchase_cents or 0):
+        return Decimal("0")
+    if coupon.discount_value_cents is not None:
+        return Decimal(min(coupon.discount_value_cents, subtotal))
+    raw = Decimal(subtotal) * Decimal(str(coupon.discount_percentage)) / 100
+    if coupon.max_discount_cents is not None:
+        raw = min(raw, Decimal(coupon.max_discount_cents))
+    return raw
+
+def discount_cap(coupon: Coupon) -> Optional[int]:
+    """Subtotal from which the discount stops growing, None when it never does (uncapped percentage)"""
+    if coupon.discount_value_cents is not None:
+        return coupon.discount_value_cents
+    if coupon.max_discount_cents is not None and coupon.discount_percentage:
+        return int(Decimal(coupon.max_discount_cents) * 100 / Decimal(str(coupon.discount_percentage)))
+    return None
+
+def subtotal_limit(coupon: Coupon, items: Dict[int, int]) -> int:
+    """
+    Highest subtotal best_subtotal can pick for a coupon. Above the cap the smallest subtotal wins,
+    and it is below the cap plus the most expensive item: removing any item of a smallest cart
+    above the cap takes it under the cap. Uncapped percentages need every subtotal.
+    """
+    total = sum(items.values())
+    cap = discount_cap(coupon)
+    if cap is None:
+        return total
+    return min(total, max(coupon.minimun_purchase_cents or 0, cap) + max(items.values(), default=0))
+
+def best_subtotal(table: SubsetTable, coupon: Coupon) -> Optional[int]:
+    """
+    Subtotal with the best saving percentage for a coupon (absolute saving breaks ties).
+
+    The percentage is flat up to the point where the discount is capped and decreases after it,
+    so the best subtotal is the largest one below the cap, or the smallest one above it.
+    """
+    if coupon.discount_value_cents is None and not coupon.discount_percentage:
+        return None
+    min_purchase = max(1, coupon.minimun_purchase_cents or 0)
+    cap = discount_cap(coupon)
+    if cap is None:
+        # Uncapped percentage, the largest subtotal (the table holds them all)
+        cap = table.max_cents
+    return table.largest_between(min_purchase, cap) or table.smallest_from(max(min_purchase, cap))
+
+
+class CartOptimiser:
+    """Caches subset tables by item set and per-coupon plans by (rule hash, wishlist version)"""
+
+    def __init__(self, max_tables: int = 32, max_plans: int = 4096, max_entries: int = SUBSET_CACHE_MAX_ENTRIES):
+        self.max_tables = max_tables
+        self.max_entries = max_entries
+        self.max_plans = max_plans
+        self.tables: "OrderedDict[frozenset, SubsetTable]" = OrderedDict()
+        self.plans: "OrderedDict[tuple, Optional[int]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def table_for(self, items: Dict[int, int], max_cents: int, deadline: Optional[float] = None) -> SubsetTable:
+        """
+        Get a table of an item set holding the subtotals up to max_cents, extending the closest
+        cached table when possible. A table the deadline cut short is returned but not cached.
+        """
+        key = frozenset(items.items())
+        table = self.tables.get(key)
+        if table is not None and table.max_cents >= max_cents:
+            self.tables.move_to_end(key)
+            return table
+
+        # The largest cached table whose items are all still there only needs the new items
+        base_key = max((k for k in self.tables if k <= key and self.tables[k].max_cents >= max_cents),
+                       key=len, default=None)
+        if base_key is not None:
+            table = self.tables[base_key].copy()
+            for item_id, cents in sorted(key - base_key, key=lambda it: it[1], reverse=True):
+                if deadline is not None and time.time() >= deadline:
+                    table.complete = False
+                    break
+                table.add(item_id, cents)
+        else:
+            table = SubsetTable.build(items, max_cents, deadline)
+
+        if not table.complete:
+            return table
+        self.tables[key] = table
+        self.tables.move_to_end(key)
+        # Least recently used first, the table just built is always kept
+        entries = sum(len(cached.parents) for cached in self.tables.values())
+        while len(self.tables) > 1 and (len(self.tables) > self.max_tables or entries > self.max_entries):
+            _, evicted = self.tables.popitem(last=False)
+            entries -= len(evicted.parents)
+        return table
+
+    def coupon_plan(self, coupon: Coupon, items: Dict[int, int], version: Optional[int],
+                    deadline: Optional[float] = None) -> Tuple[SubsetTable, Optional[int]]:
+        """
+        Best subtotal of a coupon for an item set, cached when the wishlist version is known.
+        `deadline` is a time.time() value, check table.exact to know if the plan is optimal.
+        """
+        with self.lock:
+            table = self.table_for(items, subtotal_limit(coupon, items), deadline)
+            plan_key = None
+            if version is not None:
+                plan_key = (coupon_rule_hash(coupon), version, hash(frozenset(items.items())))
+                # A table rebuilt after an eviction may be cut short by the deadline, without the cached subtotal
+                if plan_key in self.plans and table.exact:
+                    return table, self.plans[plan_key]
+
+            subtotal = best_subtotal(table, coupon)
+
+            if plan_key is not None and table.exact:
+                self.plans[plan_key] = subtotal
+                while len(self.plans) > self.max_plans:
+                    self.plans.popitem(last=False)
+            return table, subtotal
+
+
+cart_optimiser = CartOptimiser()
+
+
+def coupon_items(coupons: List[Coupon], wishlist: List[WishlistItem]) -> List[Tuple[Coupon, Dict[int, int]]]:
+    """Coupons with rules and their eligible items ({item id: cents}), coupons without any are left out"""
+    tasks = []
+    for coupon in coupons:
+        if not coupon.has_rules:
+            continue
+        # Only the items in the categories the coupon is limited to
+        eligible = {wishlist[i].id: wishlist[i].price_cents for i in eligible_item_indices(coupon, wishlist)}
+        if eligible:
+            tasks.append((coupon, eligible))
+    return tasks
+
+def plan_from_subsets(subsets: List[Tuple[Coupon, Optional[int], List[int]]], wishlist: List[WishlistItem],
+                      optimal: bool = True) -> Dict[str, Any]:
+    """Best cart (best saving percentage, absolute saving breaks ties) out of the (coupon, subtotal, item ids) found"""
+    items_by_id = {item.id: item for item in wishlist}
+
+    # Track best configuration for maximum percentage discount
+    best_percentage = Decimal("0")
+    best_absolute_saving = Decimal("0")
+    best_carts = []
+
+    for coupon, subtotal, item_ids in subsets:
+        if subtotal is None:
+            continue
+
+        save = coupon_saving(subtotal, coupon)
+        save_percentage = save / subtotal * 100
+
+        # Better percentage discount, or same percentage with a bigger absolute discount
+        if save_percentage > best_percentage or (save_percentage == best_percentage and save > best_absolute_saving):
+            best_percentage = save_percentage
+            best_absolute_saving = save
+
+            cart = {
+                "coupon": coupon.code,
+                "items": [items_by_id[item_id] for item_id in item_ids],
+                "subtotal_cents": subtotal,
+                "saving_cents": int(save.to_integral_value()),
+                "saving_percentage": float(save_percentage)
+            }
+
+            best_carts = [cart]  # Just keep the single best cart
+
+    return {
+        "total_saving_cents": sum(cart["saving_cents"] for cart in best_carts),
+        "max_percentage": float(best_percentage),
+        "carts": best_carts,
+        # False when a deadline cut the search short, the carts are the best found in time
+        "optimal": optimal,
+    }
+
+def best_plan(coupons: List[Coupon], wishlist: List[WishlistItem], version: Optional[int] = None,
+              optimiser: CartOptimiser = cart_optimiser, deadline: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Best cart of the coupons with rules for a list of wishlist items, in this process.
+    agent/optimiser_pool.py runs it in worker processes for the workflow and the wishlist bot.
+    """
+    if not wishlist:
+        return {"total_saving_cents": 0, "carts": [], "optimal": True}
+
+    # For each coupon, look up the best subtotal of its eligible items in the subset table
+    subsets = []
+    optimal = True
+    for coupon, eligible in coupon_items(coupons, wishlist):
+        table, subtotal = optimiser.coupon_plan(coupon, eligible, version, deadline)
+        optimal = optimal and table.exact
+        subsets.append((coupon, subtotal, table.subset(subtotal) if subtotal is not None else []))
+
+    return plan_from_subsets(subsets, wishlist, optimal)
@@ -0,0 +1,105 @@
+"""
+Product category tagging shared by the wishlist bot and the sales agent.
+
+Wishlist items are tagged once, when they are added, by embedding similarity
+against a fixed category vocabulary. Coupon `product_type_limit` texts are mapped
+to the same vocabulary so the optimiser only considers items the coupon applies to.
+"""
+import os
+import threading
+from functools import lru_cache
+from typing import List, Optional
+
+from agent.models import Coupon, WishlistItem
+from utils.embeddings import get_embedding_model
+
+# Category name -> description used to compute its embedding
+CATEGORY_VOCABULARY = {
+    "moda": "moda, roupas, calçados, tênis, bolsas, acessórios, relógios, joias",
+    "beleza": "beleza, cuidados pessoais, perfumes, maquiagem, cosméticos",
+    "eletronicos": "eletrônicos, celulares, smartphones, fones de ouvido, tv, áudio e vídeo",
+    "informatica": "informática, computadores, notebooks, monitores, teclados, mouse, impressoras 3d",
+    "games": "games, videogames, consoles, jogos, controles",
+    "casa": "casa, móveis, decoração, cozinha, utensílios, cama mesa e banho",
+    "eletrodomesticos": "eletrodomésticos, geladeira, fogão, máquina de lavar, micro-ondas, air fryer",
+    "ferramentas": "ferramentas, construção, materiais, bricolagem, jardim",
+    "esportes": "esportes, fitness, academia, bicicletas, camping",
+    "bebes": "bebês, infantil, brinquedos",
+    "supermercado": "supermercado, alimentos, bebidas, produtos de limpeza",
+    "automotivo": "automotivo, carros, motos, peças e acessórios para veículos",
+    "livros": "livros, papelaria, material de escritório",
+    "pet": "pet shop, cães, gatos, ração, animais",
+    "saude": "saúde, farmácia, suplementos, vitaminas",
+}
+
+# Coupon limits that don't restrict the categories at all
+GENERIC_LIMITS = {"", "todos", "todos os produtos", "produtos selecionados", "selecionados",
+                  "qualquer produto", "site todo", "geral"}
+
+# Minimum cosine similarity for a text to be tagged with a category
+CATEGORY_SIMILARITY_THRESHOLD = float(os.getenv("CATEGORY_SIMILARITY_THRESHOLD", "0.35"))
+
+# Maximum number of categories stored per wishlist item
+MAX_ITEM_CATEGORIES = 2
+
+category_matrix = None
+category_matrix_lock = threading.Lock()
+
+def get_category_matrix():
+    """Get (or compute once) the normalised embeddings of the category vocabulary"""
+    global category_matrix
+    with category_matrix_lock:
+        if category_matrix is None:
+            model = get_embedding_model()
+            category_matrix = model.encode(list(CATEGORY_VOCABULARY.values()), normalize_embeddings=True)
+    return category_matrix
+
+def rank_categories(text: str, top_k: int) -> List[str]:
+    """Return up to `top_k` categories whose similarity to the text is above the threshold"""
+    if not text or not text.strip():
+        return []
+    model = get_embedding_model()
+    embedding = model.encode(text[:5000], normalize_embeddings=True)
+    similarities = get_category_matrix() @ embedding
+    names = list(CATEGORY_VOCABULARY)
+    ranked = sorted(range(len(names)), key=lambda i: similarities[i], reverse=True)[:top_k]
+    return [names[i] for i in ranked if similarities[i] >= CATEGORY_SIMILARITY_THRESHOLD]
+
+def tag_categories(title: str) -> List[str]:
+    """Compute the category tags of a wishlist item from its title"""
+    try:
+        return rank_categories(title, MAX_ITEM_CATEGORIES)
+    except Exception as e:
+        print(f"Error tagging categories: {e}")
+        return []
+
+@lru_cache(maxsize=1024)
+def coupon_categories(product_type_limit: Optional[str]) -> Optional[frozenset]:
+    """
+    Map a coupon product_type_limit to the category vocabulary.
+
+    Returns None when the coupon is not restricted (or the limit can't be mapped),
+    so no item is wrongly left out of the search.
+    """
+    limit = (product_type_limit or "").strip().lower()
+    if limit in GENERIC_LIMITS:
+        return None
+    if limit in CATEGORY_VOCABULARY:
+        return frozenset([limit])
+    try:
+        categories = rank_categories(limit, 1)
+    except Exception as e:
+        print(f"Error mapping coupon limit to categories: {e}")
+        return None
+    return frozenset(categories) if categories else None
+
+def eligible_item_indices(coupon: Coupon, wishlist: List[WishlistItem]) -> List[int]:
+    """Indices of the wishlist items a coupon can be applied to"""
+    categories = coupon_categories(coupon.product_type_limit)
+    if categories is None:
+        return list(range(len(wishlist)))
+    # Items that were never tagged are kept, we can't tell they are ineligible
+    return [
+        i for i, item in enumerate(wishlist)
+        if not item.categories or categories.intersection(item.categories)
+    ]
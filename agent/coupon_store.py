@@ -0,0 +1,86 @@
+"""
+In-memory store of the coupons that are still valid.
+
+Coupons are only seen when their sales message arrives. The store keeps them for
+ACTIVE_COUPON_TTL_HOURS after they were last claimed (coupons.date_updated), so the
+wishlist bot can check a newly added item against them right away, without a database
+query or LLM call.
+
+It is loaded from the coupons table at startup and updated by the workflow when it
+claims coupons (same process) or by refresh_since() (other processes), which reads the
+rows whose date_updated moved since the last refresh: new coupons and re-claimed ones.
+"""
+import os
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from agent.models import Coupon
+
+# How long a coupon is considered valid after it was first seen
+ACTIVE_COUPON_TTL_HOURS = float(os.getenv("ACTIVE_COUPON_TTL_HOURS", "72"))
+
+# How often a process that doesn't insert coupons checks the table for new ones (seconds)
+ACTIVE_COUPON_REFRESH_SECONDS = int(os.getenv("ACTIVE_COUPON_REFRESH_SECONDS", "60"))
+
+# Coupons of the table claimed since $1 that may still be active, with their claim time
+ACTIVE_COUPONS_QUERY = f"""
+    SELECT date_updated, EXTRACT(EPOCH FROM date_updated)::FLOAT, {Coupon.SELECT_COLUMNS}
+    FROM coupons
+    WHERE date_updated > $1 AND NOT used AND date_updated > NOW() - make_interval(secs => $2)
+    ORDER BY date_updated
+"""
+
+# date_updated is the start of the claiming transaction, a row may commit a little after a later one
+REFRESH_OVERLAP = timedelta(minutes=1)
+
+
+class ActiveCouponStore:
+    """Coupons by code with their expiry time, thread safe"""
+
+    def __init__(self, ttl_seconds: float = ACTIVE_COUPON_TTL_HOURS * 3600):
+        self.ttl_seconds = ttl_seconds
+        self.coupons: Dict[str, Tuple[Coupon, float]] = {}
+        # Latest coupons.date_updated loaded, the next refresh reads the rows claimed since
+        self.last_seen = datetime(1970, 1, 1, tzinfo=timezone.utc)
+        self.lock = threading.Lock()
+
+    def add(self, coupon: Coupon, seen_at: Optional[float] = None):
+        """Add (or refresh) a coupon, valid for the TTL from when it was seen"""
+        expires_at = (time.time() if seen_at is None else seen_at) + self.ttl_seconds
+        with self.lock:
+            self.coupons[coupon.code] = (coupon, expires_at)
+
+    def add_many(self, coupons: List[Coupon]):
+        for coupon in coupons:
+            self.add(coupon)
+
+    def load_rows(self, rows):
+        """Load rows of ACTIVE_COUPONS_QUERY"""
+        for row in rows:
+            self.add(Coupon.from_row(row[2:]), seen_at=row[1])
+            self.last_seen = max(self.last_seen, row[0])
+
+    async def refresh_since(self, pool):
+        """Load the coupons claimed since the last refresh (asyncpg pool), returns how many were read"""
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(ACTIVE_COUPONS_QUERY, self.last_seen - REFRESH_OVERLAP, self.ttl_seconds)
+        self.load_rows(rows)
+        return len(rows)
+
+    def active(self) -> List[Coupon]:
+        """Coupons that didn't expire, expired ones are dropped"""
+        now = time.time()
+        with self.lock:
+            expired = [code for code, (_, expires_at) in self.coupons.items() if expires_at <= now]
+            for code in expired:
+                del self.coupons[code]
+            return [coupon for coupon, _ in self.coupons.values()]
+
+    def __len__(self):
+        return len(self.active())
+
+
+# Shared by the workflow and the wishlist bot when they run in the same process
+active_coupons = ActiveCouponStore()
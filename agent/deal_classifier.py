@@ -0,0 +1,176 @@
+"""
+Small logistic regression on the stored MiniLM embeddings, trained from the history.
+
+A message is relevant when the workflow found a new coupon in it or sent a deal
+message for it (telegram_messages.coupon_found / deal_sent). The model runs before
+the LLM steps of the workflow and drops the messages that are very unlikely to be
+relevant: a dot product over 384 floats instead of an LLM call.
+
+    python run_bots.py train-classifier [target_recall]
+"""
+import os
+import json
+import threading
+import numpy as np
+import psycopg2
+from utils.database import get_database_url
+from utils.vector_store import EMBEDDING_TEXT_SQL
+
+# Trained model (weights, bias and decision threshold)
+DEAL_CLASSIFIER_PATH = os.getenv("DEAL_CLASSIFIER_PATH", os.path.join(os.path.dirname(__file__), "deal_classifier.npz"))
+
+# Set to false to keep every message, even with a trained model
+DEAL_CLASSIFIER_ENABLED = os.getenv("DEAL_CLASSIFIER_ENABLED", "true").lower() == "true"
+
+# Share of the relevant messages the threshold must keep on the validation set
+DEAL_CLASSIFIER_TARGET_RECALL = float(os.getenv("DEAL_CLASSIFIER_TARGET_RECALL", "0.98"))
+
+def parse_vector(value):
+    """pgvector values come as '[0.1,0.2,...]' strings without the pgvector adapter"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = json.loads(value)
+    return np.asarray(value, dtype=np.float32)
+
+
+class DealClassifier:
+    """Logistic regression over normalised embeddings"""
+
+    def __init__(self, weights, bias, threshold):
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.bias = float(bias)
+        self.threshold = float(threshold)
+
+    @staticmethod
+    def normalise(X):
+        X = np.asarray(X, dtype=np.float32)
+        return X / np.maximum(np.linalg.norm(X, axis=-1, keepdims=True), 1e-12)
+
+    def probabilities(self, X) -> np.ndarray:
+        logits = self.normalise(X) @ self.weights + self.bias
+        return 1.0 / (1.0 + np.exp(-logits))
+
+    def probability(self, embedding) -> float:
+        return float(self.probabilities(np.asarray(embedding)[None, :])[0])
+
+    def is_noise(self, embedding) -> bool:
+        """True when the message can be dropped without calling the LLM"""
+        return self.probability(embedding) < self.threshold
+
+    def save(self, path=DEAL_CLASSIFIER_PATH):
+        np.savez(path, weights=self.weights, bias=self.bias, threshold=self.threshold)
+
+    @classmethod
+    def load(cls, path=DEAL_CLASSIFIER_PATH) -> "DealClassifier":
+        data = np.load(path)
+        return cls(data["weights"], data["bias"], data["threshold"])
+
+
+def fit_logistic_regression(X, y, l2=1e-3, epochs=500, learning_rate=0.5):
+    """Full batch gradient descent, relevant messages are weighted up to balance the classes"""
+    X = DealClassifier.normalise(X)
+    y = np.asarray(y, dtype=np.float32)
+    positives = max(float(y.sum()), 1.0)
+    negatives = max(float(len(y) - y.sum()), 1.0)
+    sample_weights = np.where(y == 1, len(y) / (2 * positives), len(y) / (2 * negatives)).astype(np.float32)
+
+    weights = np.zeros(X.shape[1], dtype=np.float32)
+    bias = 0.0
+    for _ in range(epochs):
+        predictions = 1.0 / (1.0 + np.exp(-(X @ weights + bias)))
+        error = (predictions - y) * sample_weights
+        weights -= learning_rate * (X.T @ error / len(y) + l2 * weights)
+        bias -= learning_rate * float(error.mean())
+    return weights, bias
+
+def threshold_for_recall(probabilities, y, target_recall):
+    """Highest threshold that keeps at least target_recall of the relevant messages"""
+    relevant = np.sort(probabilities[np.asarray(y) == 1])
+    if len(relevant) == 0:
+        return 0.0
+    # Dropping the k lowest scored relevant messages keeps a recall of 1 - k / n
+    allowed_misses = int(np.floor((1 - target_recall) * len(relevant)))
+    return float(relevant[allowed_misses])
+
+def evaluate(probabilities, y, threshold):
+    y = np.asarray(y)
+    kept = probabilities >= threshold
+    true_positives = int(np.sum(kept & (y == 1)))
+    return {
+        "precision": true_positives / max(int(kept.sum()), 1),
+        "recall": true_positives / max(int(np.sum(y == 1)), 1),
+        "dropped": int(np.sum(~kept)),
+        "missed": int(np.sum(~kept & (y == 1))),
+    }
+
+
+def load_training_data(database_url=None):
+    """Embeddings and labels of the messages whose outcome is known"""
+    with psycopg2.connect(database_url or get_database_url()) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""
+                SELECT {EMBEDDING_TEXT_SQL}, COALESCE(coupon_found, FALSE) OR COALESCE(deal_sent, FALSE)
+                FROM telegram_messages
+                WHERE {EMBEDDING_TEXT_SQL} IS NOT NULL AND (coupon_found IS NOT NULL OR deal_sent IS NOT NULL)
+                """
+            )
+            rows = cur.fetchall()
+    if not rows:
+        return np.zeros((0, 0), dtype=np.float32), np.zeros(0, dtype=np.int8)
+    X = np.stack([parse_vector(embedding) for embedding, _ in rows])
+    y = np.asarray([1 if relevant else 0 for _, relevant in rows], dtype=np.int8)
+    return X, y
+
+def train_classifier(target_recall=DEAL_CLASSIFIER_TARGET_RECALL, validation_share=0.2,
+                     path=DEAL_CLASSIFIER_PATH, seed=42):
+    """Train on the history, pick the threshold on a held-out split and report what it would save"""
+    X, y = load_training_data()
+    if len(y) < 20 or y.sum() == 0 or y.sum() == len(y):
+        print(f"Not enough labelled messages to train ({len(y)} messages, {int(y.sum())} relevant)")
+        return None
+
+    order = np.random.default_rng(seed).permutation(len(y))
+    split = max(1, int(len(y) * validation_share))
+    validation, training = order[:split], order[split:]
+
+    weights, bias = fit_logistic_regression(X[training], y[training])
+    classifier = DealClassifier(weights, bias, 0.0)
+    validation_probabilities = classifier.probabilities(X[validation])
+    classifier.threshold = threshold_for_recall(validation_probabilities, y[validation], target_recall)
+    report = evaluate(validation_probabilities, y[validation], classifier.threshold)
+
+    # Every message that reaches the LLM steps costs at least one call (coupon extraction or direct compare)
+    all_probabilities = classifier.probabilities(X)
+    saved = int(np.sum(all_probabilities < classifier.threshold))
+
+    print(f"Trained on {len(training)} messages, validated on {len(validation)} "
+          f"({int(y.sum())} relevant out of {len(y)})")
+    print(f"Threshold: {classifier.threshold:.4f} (target recall {target_recall:.2%})")
+    print(f"Validation precision: {report['precision']:.2%}, recall: {report['recall']:.2%}, "
+          f"dropped {report['dropped']} messages ({report['missed']} relevant)")
+    print(f"LLM calls saved on the history: at least {saved} of {len(y)} ({saved / len(y):.1%})")
+
+    classifier.save(path)
+    print(f"Model saved to {path}")
+    return classifier
+
+
+deal_classifier = None
+deal_classifier_loaded = False
+deal_classifier_lock = threading.Lock()
+
+def get_deal_classifier():
+    """The trained classifier, None when it is disabled or was never trained"""
+    global deal_classifier, deal_classifier_loaded
+    with deal_classifier_lock:
+        if not deal_classifier_loaded:
+            deal_classifier_loaded = True
+            if DEAL_CLASSIFIER_ENABLED and os.path.exists(DEAL_CLASSIFIER_PATH):
+                try:
+                    deal_classifier = DealClassifier.load(DEAL_CLASSIFIER_PATH)
+                    print(f"Deal classifier loaded (threshold {deal_classifier.threshold:.4f})")
+                except Exception as e:
+                    print(f"Could not load the deal classifier: {e}")
+    return deal_classifier
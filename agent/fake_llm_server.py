@@ -0,0 +1,93 @@
+"""
+Local fake of the Groq (OpenAI compatible) chat completions API.
+
+Used to exercise the LLM gateway without the real provider: point GROQ_BASE_URL
+to it and configure the latency, the 429/5xx error rates and the reply.
+
+    python run_bots.py fake-llm 8765
+    GROQ_BASE_URL=http://127.0.0.1:8765 python run_bots.py sales
+"""
+import json
+import time
+import random
+import asyncio
+from collections import Counter
+from aiohttp import web
+
+
+class FakeLLMProvider:
+    """aiohttp application answering /openai/v1/chat/completions"""
+
+    def __init__(self, reply="no match", latency=0.2, model_latency=None,
+                 rate_limit_rate=0.0, error_rate=0.0, retry_after=1, chunk_size=8):
+        self.reply = reply
+        self.latency = latency
+        self.model_latency = model_latency or {}
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.chunk_size = chunk_size
+        # Requests received and answered per model, to check routing and hedging
+        self.requests = Counter()
+        self.responses = Counter()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/openai/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        return app
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        model = body.get("model", "unknown")
+        self.requests[model] += 1
+
+        if random.random() < self.rate_limit_rate:
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "tokens", "code": "rate_limit_exceeded"}},
+                status=429, headers={"retry-after": str(self.retry_after)},
+            )
+        if random.random() < self.error_rate:
+            return web.json_response({"error": {"message": "Internal error", "type": "server_error"}}, status=500)
+
+        await asyncio.sleep(self.model_latency.get(model, self.latency))
+        self.responses[model] += 1
+
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in body.get("messages", [])) // 4
+        completion_id = f"chatcmpl-{random.getrandbits(48):x}"
+        created = int(time.time())
+
+        if not body.get("stream"):
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": self.reply},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(self.reply) // 4,
+                          "total_tokens": prompt_tokens + len(self.reply) // 4},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i in range(0, len(self.reply), self.chunk_size):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": self.reply[i:i + self.chunk_size]},
+                             "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(0.01)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+def run_fake_llm_server(port=8765, **kwargs):
+    """Serve a fake provider until interrupted"""
+    print(f"Fake LLM provider listening on http://127.0.0.1:{port}")
+    web.run_app(FakeLLMProvider(**kwargs).app(), host="127.0.0.1", port=port)
@@ -0,0 +1,245 @@
+"""
+Single entry point for every LLM call made by the workflow nodes.
+
+- each prompt type is routed to a model tier (small and fast for extraction,
+  large for prose), configurable through the environment
+- requests and tokens are tracked with token buckets against the provider limits,
+  and 429 answers pause the bucket for the time the provider asks
+- failed calls are retried with exponential backoff and full jitter
+- slow calls can optionally be hedged with a second model, the first answer wins
+  and the other call is cancelled (before its next request, it can't be interrupted)
+
+Set GROQ_BASE_URL to point the gateway to another (e.g. a local fake) provider.
+"""
+import os
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Dict, Iterator, List, Optional
+
+MODEL_TIERS = {
+    "small": os.getenv("LLM_SMALL_MODEL", "llama-3.1-8b-instant"),
+    "large": os.getenv("LLM_LARGE_MODEL", "llama-3.3-70b-versatile"),
+}
+
+# Prompt type -> tier, each one can be overridden with LLM_TIER_<PROMPT_TYPE>=small|large
+PROMPT_TIERS = {
+    prompt_type: os.getenv(f"LLM_TIER_{prompt_type.upper()}", tier)
+    for prompt_type, tier in {
+        "coupon_extraction": "small",
+        "direct_compare": "large",
+        "deal_message": "large",
+    }.items()
+}
+
+# Provider limits per model as (requests per minute, tokens per minute)
+DEFAULT_RATE_LIMIT = (30, 6000)
+RATE_LIMITS = {
+    "llama-3.1-8b-instant": (30, 6000),
+    "llama-3.3-70b-versatile": (30, 12000),
+}
+# Extra limits as "model:rpm:tpm,model:rpm:tpm"
+for spec in filter(None, os.getenv("LLM_RATE_LIMITS", "").split(",")):
+    model, rpm, tpm = spec.rsplit(":", 2)
+    RATE_LIMITS[model] = (int(rpm), int(tpm))
+
+LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.3"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_CAP = float(os.getenv("LLM_BACKOFF_CAP", "20"))
+
+# Hedging is enabled when a hedge model is configured
+LLM_HEDGE_MODEL = os.getenv("LLM_HEDGE_MODEL")
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "4"))
+
+# Tokens reserved for the completion when estimating the cost of a request
+COMPLETION_TOKENS_ESTIMATE = 700
+
+GROQ_BASE_URL = os.getenv("GROQ_BASE_URL")
+
+
+class CallCancelled(Exception):
+    """The other call of a hedged request answered first"""
+
+
+class RateLimiter:
+    """Requests and tokens per minute token buckets of one model (thread safe)"""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.capacity = {"requests": float(requests_per_minute), "tokens": float(tokens_per_minute)}
+        self.available = dict(self.capacity)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        for key, capacity in self.capacity.items():
+            self.available[key] = min(capacity, self.available[key] + elapsed * capacity / 60)
+        self.updated_at = now
+
+    def acquire(self, tokens, cancelled: Optional[threading.Event] = None):
+        """Block until one request and `tokens` tokens are available, then take them"""
+        tokens = min(tokens, self.capacity["tokens"])
+        while True:
+            if cancelled is not None and cancelled.is_set():
+                raise CallCancelled()
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait_for = max(
+                    self.blocked_until - now,
+                    (1 - self.available["requests"]) * 60 / self.capacity["requests"],
+                    (tokens - self.available["tokens"]) * 60 / self.capacity["tokens"],
+                )
+                if wait_for <= 0:
+                    self.available["requests"] -= 1
+                    self.available["tokens"] -= tokens
+                    return
+            if cancelled is not None:
+                cancelled.wait(wait_for)
+            else:
+                time.sleep(wait_for)
+
+    def settle(self, estimated, used):
+        """Give back (or take) the difference between the estimated and the real token usage"""
+        with self.lock:
+            self.available["tokens"] = min(self.capacity["tokens"], self.available["tokens"] + estimated - used)
+
+    def pause(self, seconds):
+        """The provider answered 429, don't send anything for `seconds`"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def status_code(error) -> Optional[int]:
+    """HTTP status of a provider error, if any"""
+    code = getattr(error, "status_code", None)
+    if code is None and getattr(error, "response", None) is not None:
+        code = getattr(error.response, "status_code", None)
+    return code
+
+def retry_after(error) -> Optional[float]:
+    """Seconds the provider asked us to wait, from the retry-after header"""
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def is_retryable(error) -> bool:
+    code = status_code(error)
+    if code is not None:
+        return code == 429 or code >= 500
+    name = type(error).__name__
+    return "Timeout" in name or "Connection" in name
+
+def estimate_tokens(messages) -> int:
+    """Rough token count of the prompt (~4 characters per token) plus the completion"""
+    return sum(len(str(m.content)) for m in messages) // 4 + COMPLETION_TOKENS_ESTIMATE
+
+
+class LLMGateway:
+    """Routes, rate limits, retries and hedges the LLM calls of the workflow"""
+
+    def __init__(self, model_tiers=None, prompt_tiers=None, hedge_model=LLM_HEDGE_MODEL,
+                 hedge_after=LLM_HEDGE_AFTER, max_retries=LLM_MAX_RETRIES, base_url=GROQ_BASE_URL):
+        self.model_tiers = model_tiers or MODEL_TIERS
+        self.prompt_tiers = prompt_tiers or PROMPT_TIERS
+        self.hedge_model = hedge_model
+        self.hedge_after = hedge_after
+        self.max_retries = max_retries
+        self.base_url = base_url
+        self.clients: Dict[str, Any] = {}
+        self.limiters: Dict[str, RateLimiter] = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="llm-hedge")
+
+    def model_for(self, prompt_type: str) -> str:
+        tier = self.prompt_tiers.get(prompt_type, "large")
+        return self.model_tiers.get(tier, self.model_tiers["large"])
+
+    def client(self, model: str):
+        """Get (or create on first use) the ChatGroq client of a model"""
+        with self.lock:
+            if model not in self.clients:
+                # Imported on first use, langchain_groq is slow to import
+                from langchain_groq import ChatGroq
+                kwargs = {"base_url": self.base_url} if self.base_url else {}
+                # Retries are done by the gateway, so they are rate limited and jittered
+                self.clients[model] = ChatGroq(model_name=model, temperature=LLM_TEMPERATURE,
+                                               max_retries=0, timeout=LLM_TIMEOUT, **kwargs)
+                self.limiters[model] = RateLimiter(*RATE_LIMITS.get(model, DEFAULT_RATE_LIMIT))
+            return self.clients[model]
+
+    def _call(self, model: str, messages: List, stream: bool = False, cancelled: Optional[threading.Event] = None):
+        """One request, with the rate limit applied, retried with jittered backoff until `cancelled` is set"""
+        client = self.client(model)
+        limiter = self.limiters[model]
+        estimated = estimate_tokens(messages)
+        attempt = 0
+        while True:
+            limiter.acquire(estimated, cancelled)
+            try:
+                if stream:
+                    iterator = client.stream(messages)
+                    # Only the connection is retried, once the first chunk arrived we are committed
+                    first = next(iterator, None)
+                    return first, iterator
+                response = client.invoke(messages)
+                usage = getattr(response, "usage_metadata", None) or {}
+                limiter.settle(estimated, usage.get("total_tokens", estimated))
+                return response
+            except Exception as e:
+                if status_code(e) == 429:
+                    limiter.pause(retry_after(e) or LLM_BACKOFF_BASE * 2 ** attempt)
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = random.uniform(0, min(LLM_BACKOFF_CAP, LLM_BACKOFF_BASE * 2 ** attempt))
+                print(f"LLM call to {model} failed ({e}), retrying in {delay:.1f}s")
+                if cancelled is not None:
+                    if cancelled.wait(delay):
+                        raise CallCancelled()
+                else:
+                    time.sleep(delay)
+                attempt += 1
+
+    def invoke(self, prompt_type: str, messages: List):
+        """Call the model of the prompt type, hedging with the hedge model when it is slow"""
+        model = self.model_for(prompt_type)
+        if not self.hedge_model or self.hedge_model == model:
+            return self._call(model, messages)
+
+        cancelled = threading.Event()
+        primary = self.executor.submit(self._call, model, messages, cancelled=cancelled)
+        done, _ = wait([primary], timeout=self.hedge_after)
+        if done:
+            return primary.result()
+
+        print(f"LLM call to {model} is slow, hedging with {self.hedge_model}")
+        pending = {primary, self.executor.submit(self._call, self.hedge_model, messages, cancelled=cancelled)}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # The loser stops before its next request (or retry), or right away if not started
+                    cancelled.set()
+                    for loser in pending:
+                        loser.cancel()
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def stream(self, prompt_type: str, messages: List) -> Iterator:
+        """Stream the completion of the model of the prompt type, chunk by chunk"""
+        model = self.model_for(prompt_type)
+        first, iterator = self._call(model, messages, stream=True)
+        if first is not None:
+            yield first
+            yield from iterator
+
+
+gateway = LLMGateway()
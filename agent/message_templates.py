@@ -0,0 +1,92 @@
+"""
+Deterministic pt-BR rendering of the coupon alerts.
+
+Produces the same layout the LLM is asked to write in craft_deal_message
+("Cupons disponíveis / Plano de compras recomendado / Total de economia")
+straight from the workflow state, without an LLM round-trip.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Any, Dict, List, Optional
+
+from agent.models import Coupon, WishlistItem
+
+NO_RULES_NOTICE = ("não encontrei as regras deste cupom na mensagem, "
+                   "se outra mensagem explicar, eu reenvio")
+
+def format_brl(cents) -> str:
+    """Format cents as Brazilian currency, e.g. 133050 -> R$ 1.330,50"""
+    amount = (Decimal(cents or 0) / 100).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+    text = f"{amount:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+    return f"R$ {text}"
+
+def format_percentage(value) -> str:
+    """Format a percentage without useless decimals, e.g. 20.0 -> 20%, 12.5 -> 12,5%"""
+    amount = Decimal(str(value or 0)).quantize(Decimal("0.1"), rounding=ROUND_HALF_UP).normalize()
+    return f"{amount:f}".replace(".", ",") + "%"
+
+def link_text(title: str) -> str:
+    """Brackets in the title would break the Markdown link"""
+    return (title or "Produto").replace("[", "(").replace("]", ")")
+
+def coupon_rule(coupon: Coupon) -> str:
+    """One line description of the rules of a coupon"""
+    if not coupon.has_rules:
+        return NO_RULES_NOTICE
+
+    parts = []
+    if coupon.discount_value_cents is not None:
+        parts.append(f"{format_brl(coupon.discount_value_cents)} de desconto")
+    elif coupon.discount_percentage is not None:
+        parts.append(f"{format_percentage(coupon.discount_percentage)} de desconto")
+        if coupon.max_discount_cents is not None:
+            parts.append(f"até {format_brl(coupon.max_discount_cents)}")
+    if coupon.minimun_purchase_cents:
+        parts.append(f"compra mínima {format_brl(coupon.minimun_purchase_cents)}")
+    if coupon.product_type_limit:
+        parts.append(f"para {coupon.product_type_limit}")
+
+    return ", ".join(parts) if parts else NO_RULES_NOTICE
+
+def render_deal_message(coupons: List[Coupon], best_plan: Dict[str, Any]) -> str:
+    """Render the coupon alert for a user from the coupons and the best plan"""
+    lines = ["**Cupons disponíveis:**"]
+    for coupon in coupons:
+        lines.append(f"• `{coupon.code}`: {coupon_rule(coupon)}")
+
+    carts = (best_plan or {}).get("carts") or []
+    if carts:
+        lines += ["", "", "**Plano de compras recomendado:**"]
+        for number, cart in enumerate(carts, start=1):
+            lines += [
+                f"    🛒 **Carrinho {number}:**",
+                f"        - Cupom: `{cart['coupon']}`",
+                "        - Itens:",
+            ]
+            for item in cart["items"]:
+                lines.append(f"            - [{link_text(item.title)}]({item.url})")
+            lines += [
+                f"        - Subtotal: {format_brl(cart['subtotal_cents'])}",
+                f"        - Desconto: {format_brl(cart['saving_cents'])} ({format_percentage(cart['saving_percentage'])} off)",
+            ]
+
+        lines += ["", "",
+                  f"💰Total de economia: {format_brl(best_plan['total_saving_cents'])} "
+                  f"({format_percentage(best_plan.get('max_percentage'))} off)"]
+
+    return "\n".join(lines)
+
+def render_product_match_message(item: WishlistItem, sale_url: str, sale_price_cents: Optional[int], message: str) -> str:
+    """Render the alert for a sales message that links a product of the user's wishlist"""
+    lines = ["🎯 **Um produto da sua lista está em promoção!**", "",
+             f"• [{link_text(item.title)}]({sale_url})",
+             f"    - Na sua lista: {format_brl(item.price_cents)}"]
+    if sale_price_cents is not None:
+        line = f"    - Na promoção: {format_brl(sale_price_cents)}"
+        difference = item.price_cents - sale_price_cents
+        if difference > 0 and item.price_cents:
+            line += f" ({format_brl(difference)} a menos, {format_percentage(difference * 100 / item.price_cents)} off)"
+        elif difference < 0:
+            line += f" ({format_brl(-difference)} a mais que o preço da sua lista)"
+        lines.append(line)
+    lines += ["", "**Mensagem da promoção:**", message.strip()[:1000]]
+    return "\n".join(lines)
@@ -0,0 +1,123 @@
+"""
+Compact typed records carried in the workflow state.
+
+Money is stored in integer cents, decoded once when the rows are read from the
+database (or the coupon is parsed from the LLM answer), so no node has to convert
+or deep-copy prices again. to_json() gives the JSON-safe view, in reais.
+"""
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+
+def to_cents(value) -> Optional[int]:
+    """Convert a price (Decimal, float, int or str in reais) to integer cents"""
+    if value is None or value == "":
+        return None
+    return int((Decimal(str(value)) * 100).to_integral_value())
+
+def from_cents(cents: Optional[int]) -> Optional[float]:
+    """Convert integer cents back to reais, for JSON and the database"""
+    return None if cents is None else cents / 100
+
+
+@dataclass(slots=True)
+class WishlistItem:
+    id: int
+    url: str
+    title: str
+    price_cents: int
+    added_by: Optional[int] = None
+    categories: List[str] = field(default_factory=list)
+
+    # Columns expected by from_row, the price is converted to cents by Postgres
+    SELECT_COLUMNS = "id, url, title, ROUND(COALESCE(price, 0) * 100)::BIGINT, added_by, categories"
+
+    @classmethod
+    def from_row(cls, row) -> "WishlistItem":
+        return cls(row[0], row[1], row[2], row[3], row[4], row[5] or [])
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"id": self.id, "title": self.title, "url": self.url, "price": from_cents(self.price_cents)}
+
+
+@dataclass(slots=True)
+class Coupon:
+    code: str
+    discount_type: str = "unknown"
+    discount_value_cents: Optional[int] = None
+    discount_percentage: Optional[float] = None
+    max_discount_cents: Optional[int] = None
+    minimun_purchase_cents: Optional[int] = None
+    product_type_limit: Optional[str] = None
+    has_rules: bool = False
+
+    # Columns expected by from_row (coupons table), the amounts are converted to cents by Postgres
+    SELECT_COLUMNS = ("code, discount_type, ROUND(discount_value * 100)::BIGINT, discount_percentage::FLOAT, "
+                      "ROUND(max_discount * 100)::BIGINT, ROUND(minimun_purchase * 100)::BIGINT, product_type_limit")
+
+    @classmethod
+    def from_row(cls, row) -> "Coupon":
+        """Build a coupon from a row of the coupons table, only coupons with rules are stored with amounts"""
+        return cls(
+            code=row[0],
+            discount_type=row[1] or "unknown",
+            discount_value_cents=row[2],
+            discount_percentage=row[3],
+            max_discount_cents=row[4],
+            minimun_purchase_cents=row[5],
+            product_type_limit=row[6],
+            has_rules=row[2] is not None or row[3] is not None,
+        )
+
+    @classmethod
+    def from_llm(cls, data: Dict[str, Any]) -> "Coupon":
+        """Build a coupon from the JSON extracted by the LLM (values in reais)"""
+        percentage = data.get("discount_percentage")
+        return cls(
+            code=str(data["code"]),
+            discount_type=data.get("discount_type") or "unknown",
+            discount_value_cents=to_cents(data.get("discount_value")),
+            discount_percentage=float(percentage) if percentage is not None else None,
+            max_discount_cents=to_cents(data.get("max_discount")),
+            minimun_purchase_cents=to_cents(data.get("minimun_purchase")),
+            product_type_limit=data.get("product_type_limit"),
+            has_rules=bool(data.get("has_rules")),
+        )
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "code": self.code,
+            "discount_type": self.discount_type,
+            "discount_value": from_cents(self.discount_value_cents),
+            "discount_percentage": self.discount_percentage,
+            "max_discount": from_cents(self.max_discount_cents),
+            "minimun_purchase": from_cents(self.minimun_purchase_cents),
+            "product_type_limit": self.product_type_limit,
+            "has_rules": self.has_rules,
+        }
+
+
+def plan_to_json(plan: Dict[str, Any]) -> Dict[str, Any]:
+    """JSON view of a best plan (see optimise_cart), with the amounts in reais"""
+    return {
+        "total_saving": from_cents(plan.get("total_saving_cents", 0)),
+        "max_percentage": plan.get("max_percentage", 0.0),
+        "carts": [
+            {
+                "coupon": cart["coupon"],
+                "items": [item.to_json() for item in cart["items"]],
+                "subtotal": from_cents(cart["subtotal_cents"]),
+                "saving": from_cents(cart["saving_cents"]),
+                "saving_percentage": cart["saving_percentage"],
+            }
+            for cart in plan.get("carts", [])
+        ],
+    }
+
+def json_default(obj):
+    """json.dumps default hook for the records above (and the cents in the plans)"""
+    if hasattr(obj, "to_json"):
+        return obj.to_json()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
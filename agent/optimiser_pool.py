@@ -0,0 +1,128 @@
+"""
+Cart optimisation in worker processes.
+
+The optimiser is pure CPU work: in the workflow (listener thread) or in the wishlist
+bot it holds the GIL and stalls message reception. Here every coupon is optimised as
+its own task in a process pool, so the coupons of one message and concurrent messages
+use all the cores. Tasks get compact picklable inputs (the coupon rules and the
+eligible {item id: cents}) and return (subtotal, item ids, complete).
+
+A plan has a deadline (OPTIMISER_DEADLINE_SECONDS): workers stop growing their subset
+tables when it hits and return the best cart found so far, coupons not done in time are
+left out, and the plan is flagged "optimal": False (so is a task that failed). Callers get
+the PlanJob through optimise_in_pool(on_job=...): PlanJob.cancel() stops waiting and
+cancels the tasks that didn't start.
+
+OPTIMISER_PROCESSES=0 runs the optimiser in the calling thread.
+"""
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, List, Optional
+
+from agent.cart_optimiser import CouponRules, best_plan, cart_optimiser, coupon_items, plan_from_subsets
+from agent.models import Coupon, WishlistItem
+
+OPTIMISER_PROCESSES = int(os.getenv("OPTIMISER_PROCESSES", str(min(4, os.cpu_count() or 1))))
+OPTIMISER_DEADLINE_SECONDS = float(os.getenv("OPTIMISER_DEADLINE_SECONDS", "5"))
+
+# Time given to the workers to send back what they found once the deadline hit
+RESULT_GRACE_SECONDS = 0.25
+
+def optimise_coupon(rules: CouponRules, items, version, deadline):
+    """Worker task: best subtotal of one coupon over its eligible items ((id, cents) pairs)"""
+    # Each worker process keeps its own table and plan caches
+    table, subtotal = cart_optimiser.coupon_plan(rules, dict(items), version, deadline)
+    return subtotal, table.subset(subtotal) if subtotal is not None else [], table.exact
+
+
+executor = None
+executor_lock = threading.Lock()
+
+def get_executor() -> ProcessPoolExecutor:
+    global executor
+    with executor_lock:
+        if executor is None:
+            # Spawned, not forked: the listener has threads (Telethon, database pools) a fork would copy mid-flight
+            executor = ProcessPoolExecutor(OPTIMISER_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+        return executor
+
+def reset_executor():
+    global executor
+    with executor_lock:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+            executor = None
+
+
+class PlanJob:
+    """The coupon tasks of one plan, submitted on creation"""
+
+    def __init__(self, coupons: List[Coupon], wishlist: List[WishlistItem], version: Optional[int] = None,
+                 deadline_seconds: float = OPTIMISER_DEADLINE_SECONDS):
+        self.wishlist = wishlist
+        self.deadline = time.time() + deadline_seconds
+        self.cancelled = threading.Event()
+        pool = get_executor()
+        self.futures = {
+            pool.submit(optimise_coupon, CouponRules.from_coupon(coupon), tuple(items.items()), version, self.deadline): coupon
+            for coupon, items in (coupon_items(coupons, wishlist) if wishlist else [])
+        }
+
+    def cancel(self):
+        """Stop waiting, the result is built from the coupons already done"""
+        self.cancelled.set()
+        for future in self.futures:
+            future.cancel()
+
+    def result(self) -> Dict[str, Any]:
+        pending = set(self.futures)
+        while pending and not self.cancelled.is_set():
+            remaining = self.deadline + RESULT_GRACE_SECONDS - time.time()
+            if remaining <= 0:
+                break
+            # Short waits so a cancel() from another thread is noticed
+            _, pending = wait(pending, timeout=min(remaining, 0.1), return_when=FIRST_COMPLETED)
+
+        subsets = []
+        optimal = not pending
+        for future, coupon in self.futures.items():
+            if future in pending:
+                future.cancel()
+                continue
+            if future.cancelled():
+                optimal = False
+                continue
+            try:
+                subtotal, item_ids, complete = future.result()
+            except BrokenProcessPool:
+                raise
+            except Exception as e:
+                print(f"Optimiser task failed for coupon {coupon.code}: {e}")
+                optimal = False
+                continue
+            optimal = optimal and complete
+            subsets.append((coupon, subtotal, item_ids))
+        return plan_from_subsets(subsets, self.wishlist, optimal)
+
+
+def optimise_in_pool(coupons: List[Coupon], wishlist: List[WishlistItem], version: Optional[int] = None,
+                     deadline_seconds: float = OPTIMISER_DEADLINE_SECONDS,
+                     on_job: Optional[Callable[[PlanJob], None]] = None) -> Dict[str, Any]:
+    """
+    best_plan in the worker processes, in this process when the pool is disabled or broke.
+    on_job is given the PlanJob once its tasks are submitted, so another thread can cancel it.
+    """
+    if OPTIMISER_PROCESSES > 0:
+        try:
+            job = PlanJob(coupons, wishlist, version, deadline_seconds)
+            if on_job is not None:
+                on_job(job)
+            return job.result()
+        except BrokenProcessPool as e:
+            print(f"Optimiser pool broken ({e}), optimising in this process")
+            reset_executor()
+    return best_plan(coupons, wishlist, version, deadline=time.time() + deadline_seconds)
@@ -0,0 +1,66 @@
+"""
+Mercado Livre product ids of URLs.
+
+Product URLs carry the id of the listing or of the catalog product:
+
+    https://produto.mercadolivre.com.br/MLB-1234567890-fone-bluetooth-_JM?tracking_id=...
+    https://www.mercadolivre.com.br/fone-bluetooth/p/MLB19876543#reco_item_pos=1
+    https://www.mercadolivre.com.br/fone-bluetooth/p/MLB19876543?pdp_filters=item_id:MLB1234567890
+
+The canonical id (MLB1234567890) ignores the title slug, tracking parameters and
+fragments. Wishlist rows store it in wishlist.product_id (hash index), so a sales
+message linking the exact product is matched without scraping or an LLM call.
+Short links (mercadolivre.com/sec/..., meli.la) have no id until they are resolved, they are
+the only links worth resolving to find one.
+"""
+import re
+from typing import Optional
+from urllib.parse import unquote, urlsplit
+
+ML_HOST = re.compile(r'(^|\.)mercadoli[vb]re\.', re.IGNORECASE)
+SHORT_LINK = re.compile(r'^(www\.)?(meli\.la(/|$)|mercadoli[vb]re\.com(\.br)?/sec/)', re.IGNORECASE)
+
+# Most specific first: the listing picked on a catalog page, the catalog product, the listing
+ITEM_IN_QUERY = re.compile(r'item_id[:=](ML[A-Z])-?(\d{6,})', re.IGNORECASE)
+CATALOG_IN_PATH = re.compile(r'/p/(ML[A-Z])-?(\d{6,})', re.IGNORECASE)
+ITEM_IN_PATH = re.compile(r'(?<!/p)/(ML[A-Z])-?(\d{6,})', re.IGNORECASE)
+
+# Prices of a sales message ("R$ 1.299,90", "R$199")
+PRICE_PATTERN = re.compile(r'R\$\s*(\d{1,3}(?:\.\d{3})+|\d+)(?:,(\d{2}))?', re.IGNORECASE)
+
+# Amounts that are not the product price: the coupon value and minimum, the shipping, the cashback, the installments
+NOT_A_PRICE_BEFORE = re.compile(
+    r'(cupom|frete|desconto|off|economi\w*|acima|m[ií]nim[oa]|cashback|parcelas?|\d+\s*x(\s*sem juros)?)\s*(de\s*)?$', re.IGNORECASE
+)
+NOT_A_PRICE_AFTER = re.compile(r'^\s*(off|de desconto|de frete|de cashback|de volta|/m[eê]s|por m[eê]s)', re.IGNORECASE)
+
+def product_id(url: str) -> Optional[str]:
+    """Canonical id (e.g. MLB1234567890) of the product a Mercado Livre URL points to, None when it has none"""
+    parts = urlsplit(url.strip())
+    if not ML_HOST.search(parts.netloc):
+        return None
+    for text, pattern in ((unquote(parts.query), ITEM_IN_QUERY), (parts.path, CATALOG_IN_PATH), (parts.path, ITEM_IN_PATH)):
+        match = pattern.search(text)
+        if match:
+            return (match.group(1) + match.group(2)).upper()
+    return None
+
+def is_short_link(url: str) -> bool:
+    """Mercado Livre short link, its product id is only known after following the redirect"""
+    parts = urlsplit(url.strip())
+    return bool(SHORT_LINK.match(parts.netloc + parts.path))
+
+def sale_price_cents(message: str) -> Optional[int]:
+    """
+    Price of the product of a sales message in cents, None when there is none.
+    With several ("de R$ 299 por R$ 199") the lowest is the sale price; coupon, shipping, cashback
+    and installment amounts are skipped.
+    """
+    prices = []
+    for match in PRICE_PATTERN.finditer(message):
+        if NOT_A_PRICE_BEFORE.search(message[max(0, match.start() - 20):match.start()]):
+            continue
+        if NOT_A_PRICE_AFTER.match(message[match.end():match.end() + 15]):
+            continue
+        prices.append(int(match.group(1).replace(".", "")) * 100 + int(match.group(2) or 0))
+    return min(prices) if prices else None
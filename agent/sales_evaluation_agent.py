@@ -1,8 +1,8 @@
-from langchain_groq import ChatGroq
 from langgraph.graph import StateGraph, START, END
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Callable
 import os
-from langchain_core.runnables.graph import CurveStyle, MermaidDrawMethod, NodeStyles
+import uuid
+import threading
 
 # Import all node functions from the new file
 from agent.workflow_nodes import (
@@ -11,8 +11,10 @@ from agent.workflow_nodes import (
     coupon_extraction,
     filter_viewed_coupons,
     get_wishlist_items,
-    optimise_cart,
-    craft_deal_message,
+    match_wishlist_products,
+    classify_message,
+    user_deal_message,
+    announce_coupons,
     insert_coupons_in_database,
     continue_or_end,
     route_after_filter,
@@ -20,14 +22,11 @@ from agent.workflow_nodes import (
     State,
     direct_compare_deal_message,
     optimise_or_full_message,
-    return_full_message
-)
-
-# Initialize the LLM for any local usage
-llm = ChatGroq(
-    model_name="llama-3.3-70b-versatile",
-    temperature=0.3
+    return_full_message,
+    STREAM_FACTORIES
 )
+from agent.models import Coupon, WishlistItem
+from utils.profiling import profile_run, timed_node, PROFILE_SLOW_RUNS
 
 # Database connection parameters
 DB_USER = os.getenv("DATABASE_USER", "postgres")
@@ -39,23 +38,69 @@ DB_PORT = os.getenv("DATABASE_PORT", "5432")
 # Create connection string
 DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
-def instantiate_workflow():
+# Checkpoint every node of a run in Postgres, so a crashed run resumes where it stopped
+WORKFLOW_CHECKPOINTS = os.getenv("WORKFLOW_CHECKPOINTS", "true").lower() == "true"
+
+# Dataclasses of the state, the checkpoint serializer only rebuilds the registered types
+CHECKPOINT_TYPES = [(cls.__module__, cls.__name__) for cls in (Coupon, WishlistItem)]
+
+compiled_workflow = None
+compiled_workflow_lock = threading.Lock()
+
+def get_checkpointer():
+    """Create the Postgres checkpointer, None if checkpoints are disabled or unavailable"""
+    if not WORKFLOW_CHECKPOINTS:
+        return None
+    try:
+        from langgraph.checkpoint.postgres import PostgresSaver
+        from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+        from psycopg_pool import ConnectionPool
+    except ImportError as e:
+        print(f"Workflow checkpoints disabled, install langgraph-checkpoint-postgres: {e}")
+        return None
+    try:
+        pool = ConnectionPool(DATABASE_URL, max_size=10, kwargs={"autocommit": True, "prepare_threshold": 0})
+        checkpointer = PostgresSaver(pool, serde=JsonPlusSerializer(allowed_msgpack_modules=CHECKPOINT_TYPES))
+        checkpointer.setup()
+        return checkpointer
+    except Exception as e:
+        print(f"Workflow checkpoints disabled, could not connect to the database: {e}")
+        return None
+
+def get_workflow():
+    """Compile the workflow once per process"""
+    global compiled_workflow
+    with compiled_workflow_lock:
+        if compiled_workflow is None:
+            compiled_workflow = instantiate_workflow(get_checkpointer())
+    return compiled_workflow
+
+def instantiate_workflow(checkpointer=None):
     workflow = StateGraph(State)
 
-    workflow.add_node("get_wishlist_items", get_wishlist_items)
-    workflow.add_node("is_mercadolivre_sale", is_it_a_mercadolivre_sale)
-    workflow.add_node("coupon_extraction", coupon_extraction)
-    workflow.add_node("filter_viewed_coupons", filter_viewed_coupons)
-    workflow.add_node("optimise_cart", optimise_cart)
-    workflow.add_node("return_full_message", return_full_message)
-    workflow.add_node("craft_deal_message", craft_deal_message)
-    workflow.add_node("insert_coupons_in_database", insert_coupons_in_database)
-    workflow.add_node("coupon_or_direct_compare", coupon_or_direct_compare)
-    workflow.add_node("direct_compare_deal_message", direct_compare_deal_message)
-    workflow.add_node("optimise_or_full_message", optimise_or_full_message)
-
-    workflow.add_edge(START, "get_wishlist_items")
-    workflow.add_conditional_edges("get_wishlist_items", continue_or_end, {"continue": "is_mercadolivre_sale", "end": END})
+    def add_node(name, node):
+        # Node durations are recorded in the slow run profiles (utils/profiling.py)
+        workflow.add_node(name, timed_node(name, node) if PROFILE_SLOW_RUNS else node)
+
+    add_node("classify_message", classify_message)
+    add_node("get_wishlist_items", get_wishlist_items)
+    add_node("match_wishlist_products", match_wishlist_products)
+    add_node("is_mercadolivre_sale", is_it_a_mercadolivre_sale)
+    add_node("coupon_extraction", coupon_extraction)
+    add_node("filter_viewed_coupons", filter_viewed_coupons)
+    add_node("user_deal_message", user_deal_message)
+    add_node("announce_coupons", announce_coupons)
+    add_node("return_full_message", return_full_message)
+    add_node("insert_coupons_in_database", insert_coupons_in_database)
+    add_node("coupon_or_direct_compare", coupon_or_direct_compare)
+    add_node("direct_compare_deal_message", direct_compare_deal_message)
+    add_node("optimise_or_full_message", optimise_or_full_message)
+
+    workflow.add_edge(START, "classify_message")
+    # Obvious noise is dropped by the deal classifier before the database and the LLM are involved
+    workflow.add_conditional_edges("classify_message", continue_or_end, {"continue": "get_wishlist_items", "end": END})
+    workflow.add_conditional_edges("get_wishlist_items", continue_or_end, {"continue": "match_wishlist_products", "end": END})
+    workflow.add_edge("match_wishlist_products", "is_mercadolivre_sale")
     workflow.add_conditional_edges("is_mercadolivre_sale", coupon_or_direct_compare, {"coupon": "coupon_extraction", "direct_compare": "direct_compare_deal_message", "end": END})
     workflow.add_edge("coupon_extraction", "filter_viewed_coupons")
     workflow.add_conditional_edges(
@@ -64,20 +109,23 @@ def instantiate_workflow():
         {"work": "parallel_router", "end": END},
     )
 
-    workflow.add_node("parallel_router", identity)
-    workflow.add_conditional_edges("parallel_router", optimise_or_full_message, {"optimise_cart": "optimise_cart", "full_message": "return_full_message", "end": END})
+    add_node("parallel_router", identity)
+    # one user_deal_message run per user is sent from the router, plus the full message fallback
+    workflow.add_conditional_edges("parallel_router", optimise_or_full_message, {"user_deal_message": "user_deal_message", "full_message": "return_full_message", "end": END})
     # unconditional edges from the router to both workers
     workflow.add_edge("parallel_router", "insert_coupons_in_database")
 
-    workflow.add_edge("optimise_cart", "craft_deal_message")
     workflow.add_edge("return_full_message", END)
-    workflow.add_edge("craft_deal_message", END)
+    # Runs once after every user_deal_message run, the coupons are announced to the group if no user got them
+    workflow.add_edge("user_deal_message", "announce_coupons")
+    workflow.add_edge("announce_coupons", END)
     workflow.add_edge("direct_compare_deal_message", END)
     workflow.add_edge("insert_coupons_in_database", END)
 
 
-    app = workflow.compile()
+    app = workflow.compile(checkpointer=checkpointer)
     #try:
+    #    from langchain_core.runnables.graph import CurveStyle, MermaidDrawMethod, NodeStyles
     #    with open("workflow_graph.png", "wb") as f:
     #        f.write(app.get_graph().draw_mermaid_png(
     #        curve_style=CurveStyle.LINEAR,
@@ -93,11 +141,41 @@ def instantiate_workflow():
     #    print("Unable to save the graph image:",e)
     return app
 
-def run_workflow(message: str) -> Dict[str, Any]:
-    workflow = instantiate_workflow()
-    initial_state = {"message": message}
-    data = workflow.invoke(initial_state)
-    return data
+def run_workflow(message: str, stream_factory: Optional[Callable] = None,
+                 thread_id: Optional[str] = None, overrides: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Run the workflow for a sales message.
+
+    stream_factory(user_id) may return a sink with feed(text)/finish(text) to stream the
+    deal messages while they are generated (see telegram_bots/streaming.py).
+
+    With a thread_id (e.g. "chat:message_id") and checkpoints enabled, a run that was
+    interrupted resumes from its last completed node instead of starting over.
+
+    overrides are added to the initial state (e.g. skip_direct_compare under load).
+    """
+    workflow = get_workflow()
+    thread_id = thread_id or str(uuid.uuid4())
+    config = {"configurable": {"thread_id": thread_id}}
+    initial_state = {"message": message, **(overrides or {})}
+
+    if stream_factory is not None:
+        STREAM_FACTORIES[thread_id] = stream_factory
+    try:
+        if workflow.checkpointer is not None:
+            snapshot = workflow.get_state(config)
+            if snapshot.next:
+                print(f"Resuming workflow {thread_id} at {snapshot.next}")
+                initial_state = None
+        # Kept only if the run is slower than PROFILE_THRESHOLD_SECONDS (and PROFILE_SLOW_RUNS is set)
+        with profile_run(f"workflow-{thread_id}"):
+            data = workflow.invoke(initial_state, config=config)
+        if workflow.checkpointer is not None and hasattr(workflow.checkpointer, "delete_thread"):
+            # The run is over, the message queue keeps it from being processed again
+            workflow.checkpointer.delete_thread(thread_id)
+        return data
+    finally:
+        STREAM_FACTORIES.pop(thread_id, None)
 
 if __name__ == "__main__":
     run_workflow("test")
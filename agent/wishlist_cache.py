@@ -0,0 +1,146 @@
+"""
+In-process snapshot of the wishlist for the sales agent.
+
+The wishlist changes a few times a day but is read for every sales message. The
+snapshot is loaded once and reloaded only after a change: the wishlist triggers
+bump wishlist_version and send it on the `wishlist_changed` channel (pg_notify),
+which a background thread LISTENs to. The same thread compares the version every
+WISHLIST_CACHE_CHECK_SECONDS, for notifications missed while it was reconnecting.
+While the listener is down, every read checks the version (one small query).
+"""
+import os
+import select
+import threading
+from typing import Dict, List, NamedTuple, Optional
+
+import psycopg2
+
+from agent.models import WishlistItem
+
+WISHLIST_CACHE_ENABLED = os.getenv("WISHLIST_CACHE_ENABLED", "true").lower() == "true"
+WISHLIST_CACHE_CHECK_SECONDS = float(os.getenv("WISHLIST_CACHE_CHECK_SECONDS", "60"))
+
+# Channel of the notifications sent by bump_wishlist_version() (init.sql)
+WISHLIST_CHANNEL = "wishlist_changed"
+
+# Seconds between reconnections of the listener
+RECONNECT_SECONDS = 5
+
+
+class WishlistSnapshot(NamedTuple):
+    version: Optional[int]
+    items: List[WishlistItem]
+    # Items grouped by the user who added them
+    user_wishlists: Dict[Optional[int], List[WishlistItem]]
+
+
+def read_version(cur) -> Optional[int]:
+    cur.execute("SELECT version FROM wishlist_version WHERE id = 1")
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+class WishlistCache:
+    """Wishlist snapshot reloaded when the wishlist_version notified (or checked) is newer"""
+
+    def __init__(self, database_url: str, check_seconds: float = WISHLIST_CACHE_CHECK_SECONDS):
+        self.database_url = database_url
+        self.check_seconds = check_seconds
+        self.snapshot: Optional[WishlistSnapshot] = None
+        # Highest version seen by the listener, None when it can't be trusted (no payload)
+        self.latest_version: Optional[int] = None
+        self.dirty = True
+        self.listening = False
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.listen, name="wishlist-cache", daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def changed(self, version: Optional[int]):
+        """A change was notified (or found by the periodic check)"""
+        with self.lock:
+            if version is None:
+                self.dirty = True
+            elif self.latest_version is None or version > self.latest_version:
+                self.latest_version = version
+
+    def is_stale(self) -> bool:
+        if self.snapshot is None or self.dirty:
+            return True
+        return self.latest_version is not None and self.latest_version != self.snapshot.version
+
+    def load(self) -> WishlistSnapshot:
+        conn = psycopg2.connect(self.database_url)
+        try:
+            # One snapshot of the database, so the version matches the rows
+            conn.set_session(readonly=True, isolation_level="REPEATABLE READ")
+            with conn, conn.cursor() as cur:
+                version = read_version(cur)
+                cur.execute(f"SELECT {WishlistItem.SELECT_COLUMNS} FROM wishlist")
+                items = [WishlistItem.from_row(row) for row in cur.fetchall()]
+        finally:
+            conn.close()
+
+        user_wishlists = {}
+        for item in items:
+            user_wishlists.setdefault(item.added_by, []).append(item)
+        print(f"Wishlist cache loaded: {len(items)} items, version {version}")
+        return WishlistSnapshot(version, items, user_wishlists)
+
+    def get(self) -> WishlistSnapshot:
+        """The current snapshot, reloaded first if the wishlist changed"""
+        self.start()
+        with self.lock:
+            if not self.listening and self.snapshot is not None:
+                # No notifications, check the version on every read
+                conn = psycopg2.connect(self.database_url)
+                try:
+                    with conn, conn.cursor() as cur:
+                        self.latest_version = read_version(cur)
+                finally:
+                    conn.close()
+            if self.is_stale():
+                # Under the lock, concurrent runs wait for a single load
+                self.dirty = False
+                self.snapshot = self.load()
+                if self.latest_version is None or self.latest_version < (self.snapshot.version or 0):
+                    self.latest_version = self.snapshot.version
+            return self.snapshot
+
+    def listen(self):
+        """LISTEN for the change notifications, with a periodic version check"""
+        while not self.stopped.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(self.database_url)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {WISHLIST_CHANNEL}")
+                    # Changes made while nobody was listening
+                    self.changed(read_version(cur))
+                self.listening = True
+
+                while not self.stopped.is_set():
+                    if select.select([conn], [], [], self.check_seconds) == ([], [], []):
+                        with conn.cursor() as cur:
+                            self.changed(read_version(cur))
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        payload = conn.notifies.pop(0).payload
+                        self.changed(int(payload) if payload.isdigit() else None)
+            except Exception as e:
+                print(f"Wishlist cache listener error: {e}, reconnecting in {RECONNECT_SECONDS}s")
+            finally:
+                self.listening = False
+                if conn is not None:
+                    conn.close()
+            self.stopped.wait(RECONNECT_SECONDS)
@@ -9,15 +9,37 @@ CREATE TABLE IF NOT EXISTS telegram_messages (
     message_id BIGINT NOT NULL,
     sender_id BIGINT,
     embedding vector(384),  -- For all-MiniLM-L6-v2 embeddings (384 dimensions)
+    embedding_half halfvec(384),  -- Compact storage modes (EMBEDDING_STORAGE=halfvec or binary)
+    embedding_bits bit(384),
+    coupon_found BOOLEAN,  -- Outcome of the workflow (labels of the deal classifier), NULL until known
+    deal_sent BOOLEAN,
     timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Columns added after the first release, for databases created before them
+ALTER TABLE telegram_messages ADD COLUMN IF NOT EXISTS embedding_half halfvec(384);
+ALTER TABLE telegram_messages ADD COLUMN IF NOT EXISTS embedding_bits bit(384);
+ALTER TABLE telegram_messages ADD COLUMN IF NOT EXISTS coupon_found BOOLEAN;
+ALTER TABLE telegram_messages ADD COLUMN IF NOT EXISTS deal_sent BOOLEAN;
+
 -- Create index on common search fields
 CREATE INDEX IF NOT EXISTS idx_telegram_messages_chat_title ON telegram_messages(chat_title);
 CREATE INDEX IF NOT EXISTS idx_telegram_messages_timestamp ON telegram_messages(timestamp);
 
+-- A message is stored once, even if it is received again after a restart
+-- (duplicates stored before the index existed are removed first, the oldest row is kept)
+DELETE FROM telegram_messages AS duplicate
+USING telegram_messages AS kept
+WHERE duplicate.chat_title = kept.chat_title
+  AND duplicate.message_id = kept.message_id
+  AND duplicate.id > kept.id
+  AND NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'idx_telegram_messages_chat_message');
+CREATE UNIQUE INDEX IF NOT EXISTS idx_telegram_messages_chat_message ON telegram_messages(chat_title, message_id);
+
 -- Create vector index for similarity search
 CREATE INDEX IF NOT EXISTS idx_telegram_messages_embedding ON telegram_messages USING ivfflat (embedding vector_cosine_ops);
+CREATE INDEX IF NOT EXISTS idx_telegram_messages_embedding_half ON telegram_messages USING hnsw (embedding_half halfvec_cosine_ops);
+CREATE INDEX IF NOT EXISTS idx_telegram_messages_embedding_bits ON telegram_messages USING hnsw (embedding_bits bit_hamming_ops);
 
 -- Create a table for storing wishlist items from Mercado Livre
 CREATE TABLE IF NOT EXISTS wishlist (
@@ -26,11 +48,49 @@ CREATE TABLE IF NOT EXISTS wishlist (
     title TEXT,
     price DECIMAL(10,2),
     added_by BIGINT,
+    categories TEXT[],  -- Category tags computed from the title when the item is added
+    product_id TEXT,  -- Mercado Livre product id of the URL (agent/product_ids.py), e.g. MLB1234567890
     added_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
--- Create index on wishlist table
-CREATE INDEX IF NOT EXISTS idx_wishlist_added_at ON wishlist(added_at);
+ALTER TABLE wishlist ADD COLUMN IF NOT EXISTS categories TEXT[];
+ALTER TABLE wishlist ADD COLUMN IF NOT EXISTS product_id TEXT;
+
+-- Create index on wishlist table (matches the keyset pagination of /list)
+CREATE INDEX IF NOT EXISTS idx_wishlist_added_at_id ON wishlist(added_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_wishlist_added_by ON wishlist(added_by);
+-- Exact product matches of the sales messages (equality lookups only)
+CREATE INDEX IF NOT EXISTS idx_wishlist_product_id ON wishlist USING hash (product_id);
+
+-- Wishlist version, bumped on every add, delete or update (cache key for the cart optimiser and the wishlist cache)
+CREATE TABLE IF NOT EXISTS wishlist_version (
+    id INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    version BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO wishlist_version (id, version) VALUES (1, 0) ON CONFLICT (id) DO NOTHING;
+
+-- The new version is notified on wishlist_changed (agent/wishlist_cache.py), delivered when the change commits
+CREATE OR REPLACE FUNCTION bump_wishlist_version() RETURNS TRIGGER AS $$
+DECLARE
+    new_version BIGINT;
+BEGIN
+    UPDATE wishlist_version SET version = version + 1 WHERE id = 1 RETURNING version INTO new_version;
+    PERFORM pg_notify('wishlist_changed', new_version::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER wishlist_version_on_change
+    AFTER INSERT OR DELETE ON wishlist
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_wishlist_version();
+
+-- Any update (price, title, categories...), the wishlist cache holds every column;
+-- it replaces the price-only trigger of older databases
+DROP TRIGGER IF EXISTS wishlist_version_on_price_change ON wishlist;
+CREATE OR REPLACE TRIGGER wishlist_version_on_update
+    AFTER UPDATE ON wishlist
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_wishlist_version();
 
 -- Create a table for storing coupons
 CREATE TABLE IF NOT EXISTS coupons (
@@ -50,4 +110,51 @@ CREATE TABLE IF NOT EXISTS coupons (
 -- Create indexes for coupons table
 CREATE INDEX IF NOT EXISTS idx_coupons_code ON coupons(code);
 CREATE INDEX IF NOT EXISTS idx_coupons_used ON coupons(used);
-CREATE INDEX IF NOT EXISTS idx_coupons_date_created ON coupons(date_created); 
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS idx_coupons_date_created ON coupons(date_created);
+-- Coupons claimed since the last refresh of the active coupon stores (agent/coupon_store.py)
+CREATE INDEX IF NOT EXISTS idx_coupons_date_updated ON coupons(date_updated);
+
+-- Durable queue of the sales messages waiting for the workflow
+CREATE TABLE IF NOT EXISTS message_queue (
+    id BIGSERIAL PRIMARY KEY,
+    chat_title VARCHAR(255) NOT NULL,
+    message_id BIGINT NOT NULL,
+    message_text TEXT NOT NULL,
+    priority INT NOT NULL DEFAULT 0,  -- Admission score, higher is processed first
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',  -- pending, processing, done, failed, shed
+    attempts INT NOT NULL DEFAULT 0,
+    last_error TEXT,
+    locked_at TIMESTAMP WITH TIME ZONE,
+    enqueued_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP WITH TIME ZONE,
+    UNIQUE (chat_title, message_id)
+);
+
+ALTER TABLE message_queue ADD COLUMN IF NOT EXISTS priority INT NOT NULL DEFAULT 0;
+
+-- Index for the workers claiming messages
+CREATE INDEX IF NOT EXISTS idx_message_queue_claim ON message_queue(status, priority DESC, id) WHERE status IN ('pending', 'processing');
+
+-- Live listener processes (telegram_bots/sharding.py), the sales groups are spread over them
+CREATE TABLE IF NOT EXISTS listener_shards (
+    name VARCHAR(100) PRIMARY KEY,
+    heartbeat_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Alerts of every shard, sent by the shard holding the outbox advisory lock
+CREATE TABLE IF NOT EXISTS outbound_messages (
+    id BIGSERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    message_text TEXT NOT NULL,
+    claimed_at TIMESTAMP WITH TIME ZONE,  -- Handed to the OutboundQueue of the lock holder, deleted once sent
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE outbound_messages ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP WITH TIME ZONE;
+
+-- Last message id backfilled per chat (telegram_bots/backfill.py), the next run resumes after it
+CREATE TABLE IF NOT EXISTS backfill_state (
+    chat_title VARCHAR(255) PRIMARY KEY,
+    high_water_mark BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
\ No newline at end of file
@@ -14,6 +14,10 @@ load_dotenv()
 def run_sales_listener():
     """Run the sales listener bot in a separate process"""
     print("Starting Sales Listener...")
+    # --shard=NAME runs this listener as one shard of the sales groups (telegram_bots/sharding.py)
+    for arg in sys.argv[2:]:
+        if arg.startswith("--shard="):
+            os.environ["LISTENER_SHARD"] = arg.split("=", 1)[1]
     from telegram_bots.sales_listener import main
     asyncio.run(main())
 
@@ -29,8 +33,72 @@ def run_test_mode():
     from telegram_bots.sales_listener import test_bot_send_message
     asyncio.run(test_bot_send_message())
 
+def run_fake_llm():
+    """Run a local fake of the LLM provider"""
+    from agent.fake_llm_server import run_fake_llm_server
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8765
+    run_fake_llm_server(port)
+
+def run_queue_benchmark():
+    """Measure the throughput of the workflow message queue"""
+    from telegram_bots.message_queue import benchmark_queue
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    asyncio.run(benchmark_queue(messages))
+
+def run_train_classifier():
+    """Train the deal classifier on the stored messages and their outcomes"""
+    from agent.deal_classifier import train_classifier, DEAL_CLASSIFIER_TARGET_RECALL
+    target_recall = float(sys.argv[2]) if len(sys.argv) > 2 else DEAL_CLASSIFIER_TARGET_RECALL
+    train_classifier(target_recall)
+
+def run_migrate_vectors():
+    """Convert the stored embeddings to a compact storage mode"""
+    from utils.vector_store import migrate_embeddings, EMBEDDING_STORAGE
+    args = [arg for arg in sys.argv[2:] if not arg.startswith("--")]
+    migrate_embeddings(args[0] if args else EMBEDDING_STORAGE, clear_float32="--clear-float32" in sys.argv)
+
+def run_vector_benchmark():
+    """Compare the embedding storage modes"""
+    from utils.vector_store import benchmark_vectors
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    k = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    benchmark_vectors(queries, k)
+
+def run_wishlist_load_test():
+    """Load test the wishlist bot URL ingestion against a local product page server"""
+    from telegram_bots.wishlist_loadtest import run_wishlist_load_test
+    args = [arg for arg in sys.argv[2:] if not arg.startswith("--")]
+    options = dict(arg[2:].split("=", 1) if "=" in arg else (arg[2:], "true")
+                   for arg in sys.argv[2:] if arg.startswith("--"))
+    asyncio.run(run_wishlist_load_test(
+        messages=int(args[0]) if args else 100,
+        rate=float(args[1]) if len(args) > 1 else 20.0,
+        latency=float(options.get("latency", 0.3)),
+        jitter=float(options.get("jitter", 0.2)),
+        error_rate=float(options.get("error-rate", 0.05)),
+        pool_size=int(options.get("pool-size", 10)),
+        pages_dir=options.get("pages"),
+        use_database="database" in options,
+        skip_categories="skip-categories" in options,
+    ))
+
+def run_history_backfill():
+    """Backfill the history of the sales groups into telegram_messages"""
+    from telegram_bots.backfill import run_backfill, BACKFILL_BATCH_SIZE
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[2:] if arg.startswith("--") and "=" in arg)
+    asyncio.run(run_backfill(
+        limit=int(options["limit"]) if "limit" in options else None,
+        batch_size=int(options.get("batch", BACKFILL_BATCH_SIZE)),
+    ))
+
 def main():
     """Main function to start the bots based on command line arguments"""
+    if "--profile-startup" in sys.argv:
+        from utils.startup import profile_startup
+        sys.argv.remove("--profile-startup")
+        profile_startup(sys.argv[1] if len(sys.argv) > 1 else "both")
+        return
+
     if len(sys.argv) > 1:
         if sys.argv[1] == "sales":
             run_sales_listener()
@@ -38,6 +106,20 @@ def main():
             run_wishlist_bot()
         elif sys.argv[1] == "test":
             run_test_mode()
+        elif sys.argv[1] == "fake-llm":
+            run_fake_llm()
+        elif sys.argv[1] == "bench-queue":
+            run_queue_benchmark()
+        elif sys.argv[1] == "train-classifier":
+            run_train_classifier()
+        elif sys.argv[1] == "migrate-vectors":
+            run_migrate_vectors()
+        elif sys.argv[1] == "bench-vectors":
+            run_vector_benchmark()
+        elif sys.argv[1] == "loadtest-wishlist":
+            run_wishlist_load_test()
+        elif sys.argv[1] == "backfill":
+            run_history_backfill()
         else:
             print(f"Unknown command: {sys.argv[1]}")
             print_usage()
@@ -75,13 +157,23 @@ def main():
 def print_usage():
     """Print usage information"""
     print("""
-Usage: python run_bots.py [command]
+Usage: python run_bots.py [--profile-startup] [command]
 
 Commands:
   (none)    - Run both bots
-  sales     - Run only the Sales Listener
+  sales [--shard=NAME] - Run only the Sales Listener (as one shard of the sales groups with --shard)
   wishlist  - Run only the Wishlist Bot
   test      - Run the Sales Listener in test mode
+  fake-llm [port] - Run a local fake LLM provider (point GROQ_BASE_URL to it)
+  bench-queue [messages] - Measure the message queue throughput with 1, 2, 4 and 8 workers
+  train-classifier [target_recall] - Train the deal classifier on the stored messages
+  migrate-vectors [halfvec|binary] [--clear-float32] - Convert the stored embeddings to a compact storage mode
+  bench-vectors [queries] [k] - Compare size, latency and recall@k of the embedding storage modes
+  loadtest-wishlist [messages] [rate] [--latency=0.3] [--jitter=0.2] [--error-rate=0.05] [--pool-size=10]
+                    [--pages=DIR] [--database] [--skip-categories] - Load test the wishlist URL ingestion
+  backfill [--limit=N] [--batch=256] - Store the past messages of the sales groups (resumes where it stopped)
+
+  --profile-startup - Print the import and init time breakdown of the command instead of running it
     """)
 
 if __name__ == "__main__":
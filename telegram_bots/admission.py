@@ -0,0 +1,133 @@
+"""
+Admission control and priority scheduling of the sales messages.
+
+Every message gets a cheap priority score before it is queued:
+    - a Mercado Livre link or mention (only those can be coupon or cart deals)
+    - coupon keywords ("cupom", "off", "desconto", ...)
+    - similarity of the message embedding to the wishlist titles
+
+The queue is bounded: when it is full, the lowest priority pending message is shed to
+make room, or the new message is shed if nothing queued is less important. Under load
+(queue deeper than QUEUE_SHED_DIRECT_COMPARE_DEPTH) the direct-compare LLM call is
+skipped, so coupon posts keep a low latency during floods of unrelated products.
+"""
+import os
+import re
+import time
+import threading
+import numpy as np
+
+from utils.embeddings import get_embedding_model
+
+# Pending messages kept in the queue, the lowest priority ones are shed above it
+QUEUE_MAX_DEPTH = int(os.getenv("QUEUE_MAX_DEPTH", "200"))
+
+# Above this depth the direct-compare step (one LLM call per message) is skipped
+QUEUE_SHED_DIRECT_COMPARE_DEPTH = int(os.getenv("QUEUE_SHED_DIRECT_COMPARE_DEPTH", "20"))
+
+# Weights of the priority score
+PRIORITY_ML_LINK = 40
+PRIORITY_COUPON_KEYWORDS = 40
+PRIORITY_WISHLIST_SIMILARITY = 20
+
+# How often the wishlist titles are checked for changes (seconds)
+WISHLIST_INDEX_REFRESH_SECONDS = 30
+
+ML_PATTERN = re.compile(r"mercadoli[vb]re|mercado livre|meli\.la|\bmlb-?\d+", re.IGNORECASE)
+COUPON_PATTERN = re.compile(r"\bcup(?:om|ons?|ones)\b|\bc[oó]digo\b|\bdesconto\b|\boff\b|\d+\s?%", re.IGNORECASE)
+
+
+class WishlistTitleIndex:
+    """Normalised embeddings of the wishlist titles, reloaded when the wishlist version changes"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.version = None
+        self.matrix = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        with self.lock:
+            if time.monotonic() - self.checked_at < WISHLIST_INDEX_REFRESH_SECONDS:
+                return
+            self.checked_at = time.monotonic()
+            with self.connection() as conn, conn.cursor() as cur:
+                cur.execute("SELECT version FROM wishlist_version WHERE id = 1")
+                row = cur.fetchone()
+                version = row[0] if row else None
+                if version == self.version and self.matrix is not None:
+                    return
+                cur.execute("SELECT title FROM wishlist WHERE title IS NOT NULL")
+                titles = [title for (title,) in cur.fetchall()]
+
+            if titles:
+                vectors = np.asarray(get_embedding_model().encode(titles), dtype=np.float32)
+                vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+                self.matrix = vectors
+            else:
+                self.matrix = np.zeros((0, 0), dtype=np.float32)
+            self.version = version
+
+    def similarity(self, embedding) -> float:
+        """Highest cosine similarity between the embedding and a wishlist title"""
+        if embedding is None:
+            return 0.0
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"Could not refresh the wishlist titles: {e}")
+        if self.matrix is None or self.matrix.size == 0:
+            return 0.0
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector /= max(float(np.linalg.norm(vector)), 1e-12)
+        return float(np.max(self.matrix @ vector))
+
+
+def priority_score(text, similarity=0.0) -> int:
+    """Cheap priority of a message, between 0 and 100"""
+    text = text or ""
+    score = 0
+    if ML_PATTERN.search(text):
+        score += PRIORITY_ML_LINK
+    if COUPON_PATTERN.search(text):
+        score += PRIORITY_COUPON_KEYWORDS
+    score += int(round(PRIORITY_WISHLIST_SIMILARITY * min(max(similarity, 0.0), 1.0)))
+    return score
+
+
+class AdmissionController:
+    """Scores messages, keeps the queue bounded and tells the workers what to shed"""
+
+    def __init__(self, queue, max_depth=QUEUE_MAX_DEPTH,
+                 shed_direct_compare_depth=QUEUE_SHED_DIRECT_COMPARE_DEPTH, wishlist_index=None):
+        self.queue = queue
+        self.max_depth = max_depth
+        self.shed_direct_compare_depth = shed_direct_compare_depth
+        self.wishlist_index = wishlist_index or WishlistTitleIndex(queue.connection)
+        self.last_depth = 0
+
+    def admit(self, chat_title, message_id, text, embedding=None) -> bool:
+        """Score and enqueue a message, returns False if it was already queued or was shed"""
+        priority = priority_score(text, self.wishlist_index.similarity(embedding))
+        self.last_depth = self.queue.depth()
+
+        if self.last_depth >= self.max_depth and not self.queue.shed_lowest(priority):
+            print(f"Queue full ({self.last_depth} messages), shedding message {message_id} "
+                  f"from {chat_title} (priority {priority})")
+            return False
+
+        queued = self.queue.enqueue(chat_title, message_id, text, priority)
+        if queued:
+            print(f"Queued message {message_id} from {chat_title} with priority {priority} "
+                  f"({self.last_depth} waiting)")
+        return queued
+
+    def workflow_overrides(self) -> dict:
+        """Extra initial state of the workflow runs under the current load"""
+        depth = self.queue.depth()
+        self.last_depth = depth
+        if depth > self.shed_direct_compare_depth:
+            print(f"Queue depth {depth}, skipping direct compare")
+            return {"skip_direct_compare": True}
+        return {}
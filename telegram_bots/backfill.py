@@ -0,0 +1,188 @@
+"""
+Backfill of the sales groups history into telegram_messages.
+
+    python run_bots.py backfill [--limit=N] [--batch=256]
+
+Pages through the history of every SALES_GROUP group with Telethon (oldest first, from
+the high-water mark of the chat in backfill_state), skips the messages already stored
+(by the listener or a previous run), embeds the others in batches and inserts each batch
+with a single statement. The high-water mark is saved in the same transaction as the
+insert, so an interrupted backfill resumes where it stopped. The embedding runs before
+that transaction, no transaction is held open while it runs. Fetching the next page and
+storing the previous batch overlap.
+
+Backfilled messages are not queued for the workflow, they only feed the similarity
+search and the deduplication. The backfill uses its own Telegram session, so it can run
+next to the listener.
+"""
+import os
+import time
+import asyncio
+import psycopg2
+from psycopg2.extras import execute_values
+from utils.database import get_database_url
+from utils.embeddings import get_embeddings
+from utils.vector_store import storage_columns, EMBEDDING_DIMENSIONS
+
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "256"))
+
+
+class BackfillStats:
+    def __init__(self, chat_title):
+        self.chat_title = chat_title
+        self.fetched = 0
+        self.stored = 0
+        self.skipped = 0
+        self.embed_seconds = 0.0
+        self.insert_seconds = 0.0
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def report(self) -> str:
+        rate = self.fetched / self.elapsed if self.elapsed else 0.0
+        return (f"{self.chat_title}: {self.fetched} messages in {self.elapsed:.1f}s ({rate:.0f}/s), "
+                f"{self.stored} stored, {self.skipped} already stored or empty "
+                f"(embedding {self.embed_seconds:.1f}s, insert {self.insert_seconds:.1f}s)")
+
+
+class HistoryBackfill:
+    """
+    Backfills chats from a Telethon client (or anything with the same get_entity and
+    iter_messages, like a fake client feeding recorded messages)
+    """
+
+    def __init__(self, client, database_url=None, batch_size=BACKFILL_BATCH_SIZE, embed=get_embeddings):
+        self.client = client
+        self.database_url = database_url or get_database_url()
+        self.batch_size = batch_size
+        self.embed = embed
+        self.conn = None
+
+    def connection(self):
+        # Batches are stored one at a time, a single connection is enough
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(self.database_url)
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+    def high_water_mark(self, chat_title) -> int:
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT high_water_mark FROM backfill_state WHERE chat_title = %s", (chat_title,))
+            row = cur.fetchone()
+        return row[0] if row else 0
+
+    def store_batch(self, chat_title, messages, stats: BackfillStats):
+        """Embed the new messages of a batch, then insert them and move the high-water mark in one transaction"""
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT message_id FROM telegram_messages WHERE chat_title = %s AND message_id = ANY(%s)",
+                (chat_title, [message.id for message in messages])
+            )
+            existing = {row[0] for row in cur.fetchall()}
+        new = [message for message in messages
+               if message.id not in existing and message.text and message.text.strip()]
+
+        # Outside of any transaction, the embedding model is the slow part
+        start = time.perf_counter()
+        embeddings = self.embed([message.text for message in new])
+        stats.embed_seconds += time.perf_counter() - start
+
+        # A message stored by the listener in the meantime is skipped by ON CONFLICT
+        start = time.perf_counter()
+        with self.connection() as conn, conn.cursor() as cur:
+            if new:
+                # Columns and casts of EMBEDDING_STORAGE, a failed embedding is stored as NULL
+                columns, placeholders, _ = storage_columns([0.0] * EMBEDDING_DIMENSIONS)
+                rows = [
+                    (chat_title, message.text, message.id, message.sender_id, message.date,
+                     *(storage_columns(embedding)[2] if embedding is not None else [None] * len(columns)))
+                    for message, embedding in zip(new, embeddings)
+                ]
+                execute_values(
+                    cur,
+                    f"""
+                    INSERT INTO telegram_messages (chat_title, message_text, message_id, sender_id, timestamp{"".join(", " + c for c in columns)})
+                    VALUES %s
+                    ON CONFLICT (chat_title, message_id) DO NOTHING
+                    """,
+                    rows,
+                    template=f"(%s, %s, %s, %s, %s{''.join(', ' + p for p in placeholders)})",
+                    page_size=len(rows)
+                )
+            cur.execute(
+                """
+                INSERT INTO backfill_state (chat_title, high_water_mark, updated_at) VALUES (%s, %s, NOW())
+                ON CONFLICT (chat_title) DO UPDATE
+                SET high_water_mark = GREATEST(backfill_state.high_water_mark, EXCLUDED.high_water_mark), updated_at = NOW()
+                """,
+                (chat_title, max(message.id for message in messages))
+            )
+            stats.insert_seconds += time.perf_counter() - start
+
+        stats.stored += len(new)
+        stats.skipped += len(messages) - len(new)
+        print(f"{chat_title}: {stats.fetched} fetched, {stats.stored} stored, up to message {max(message.id for message in messages)}")
+
+    async def backfill_chat(self, group, limit=None) -> BackfillStats:
+        """Backfill one group from its high-water mark, at most `limit` messages"""
+        loop = asyncio.get_running_loop()
+        entity = await self.client.get_entity(group)
+        chat_title = entity.title
+        stats = BackfillStats(chat_title)
+        min_id = await loop.run_in_executor(None, self.high_water_mark, chat_title)
+        print(f"Backfilling {chat_title} from message {min_id}")
+
+        batch = []
+        storing = None
+        async for message in self.client.iter_messages(entity, min_id=min_id, reverse=True, limit=limit):
+            batch.append(message)
+            stats.fetched += 1
+            if len(batch) >= self.batch_size:
+                # The previous batch is stored while this one was fetched, batches commit in order
+                if storing is not None:
+                    await storing
+                storing = loop.run_in_executor(None, self.store_batch, chat_title, batch, stats)
+                batch = []
+        if storing is not None:
+            await storing
+        if batch:
+            await loop.run_in_executor(None, self.store_batch, chat_title, batch, stats)
+
+        stats.elapsed = time.perf_counter() - stats.started
+        return stats
+
+    async def run(self, groups, limit=None):
+        """Backfill every group and print the throughput"""
+        results = []
+        try:
+            for group in groups:
+                results.append(await self.backfill_chat(group, limit))
+        finally:
+            self.close()
+
+        print("\nBackfill report:")
+        for stats in results:
+            print(f"  {stats.report()}")
+        fetched = sum(stats.fetched for stats in results)
+        elapsed = sum(stats.elapsed for stats in results)
+        if elapsed:
+            print(f"Total: {fetched} messages in {elapsed:.1f}s ({fetched / elapsed:.0f}/s), "
+                  f"{sum(stats.stored for stats in results)} stored")
+        return results
+
+
+async def run_backfill(limit=None, batch_size=BACKFILL_BATCH_SIZE):
+    """Backfill the SALES_GROUP groups with the user account"""
+    from telethon import TelegramClient
+    from telegram_bots.sales_listener import api_id, api_hash, session, SALES_GROUP
+
+    # Its own session file, the listener may be running with the main one
+    client = TelegramClient(f"{session}_backfill", api_id, api_hash)
+    await client.start()
+    try:
+        await HistoryBackfill(client, batch_size=batch_size).run(SALES_GROUP.split(","), limit)
+    finally:
+        await client.disconnect()
@@ -0,0 +1,267 @@
+"""
+Durable, Postgres backed queue of the sales messages waiting for the workflow.
+
+The listener enqueues every message (the unique key on chat_title + message_id makes
+it idempotent across restarts and redeliveries) and workers claim them with
+FOR UPDATE SKIP LOCKED, highest priority first (see telegram_bots/admission.py).
+A worker renews the lease of its message while the workflow runs (LLM retries
+included); a message whose worker died is claimed again once its lease expires, and
+the workflow resumes from its last checkpoint. A message that keeps killing its worker
+is marked as failed after QUEUE_MAX_ATTEMPTS claims, like any other failure.
+"""
+import os
+import time
+import asyncio
+from contextlib import contextmanager
+from dataclasses import dataclass
+from psycopg2.pool import ThreadedConnectionPool
+from utils.database import get_database_url
+
+# A message still "processing" after this long is considered abandoned and claimed again,
+# the worker renews the lease every third of it
+QUEUE_LEASE_SECONDS = int(os.getenv("QUEUE_LEASE_SECONDS", "300"))
+
+# Attempts before a message is marked as failed
+QUEUE_MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", "3"))
+
+
+@dataclass(slots=True)
+class QueuedMessage:
+    id: int
+    chat_title: str
+    message_id: int
+    message_text: str
+    attempts: int
+    priority: int = 0
+
+    @property
+    def thread_id(self) -> str:
+        """Checkpoint thread of the workflow run of this message"""
+        return f"{self.chat_title}:{self.message_id}"
+
+
+class MessageQueue:
+    """Enqueue, claim and settle messages of the message_queue table"""
+
+    def __init__(self, database_url=None, max_connections=8,
+                 lease_seconds=QUEUE_LEASE_SECONDS, max_attempts=QUEUE_MAX_ATTEMPTS):
+        self.pool = ThreadedConnectionPool(1, max_connections, database_url or get_database_url())
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    @contextmanager
+    def connection(self):
+        conn = self.pool.getconn()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self.pool.putconn(conn)
+
+    def enqueue(self, chat_title, message_id, message_text, priority=0) -> bool:
+        """Add a message to the queue, returns False if it was already there"""
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO message_queue (chat_title, message_id, message_text, priority)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (chat_title, message_id) DO NOTHING
+                """,
+                (chat_title, message_id, message_text, priority)
+            )
+            return cur.rowcount == 1
+
+    def depth(self) -> int:
+        """Number of messages waiting to be claimed"""
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM message_queue WHERE status = 'pending'")
+            return cur.fetchone()[0]
+
+    def shed_lowest(self, below_priority) -> bool:
+        """Drop the newest of the lowest priority pending messages, if its priority is below the given one"""
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE message_queue
+                SET status = 'shed', finished_at = NOW()
+                WHERE id = (
+                    SELECT id FROM message_queue
+                    WHERE status = 'pending' AND priority < %s
+                    ORDER BY priority, id DESC
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+                )
+                """,
+                (below_priority,)
+            )
+            return cur.rowcount == 1
+
+    def claim(self):
+        """Claim the highest priority pending (or abandoned) message, None if there is nothing to do"""
+        with self.connection() as conn, conn.cursor() as cur:
+            # Abandoned after the last attempt: the message kills its worker, it is not retried again
+            cur.execute(
+                """
+                UPDATE message_queue
+                SET status = 'failed', finished_at = NOW(), locked_at = NULL,
+                    last_error = 'lease expired on the last attempt'
+                WHERE status = 'processing' AND locked_at < NOW() - make_interval(secs => %s) AND attempts >= %s
+                """,
+                (self.lease_seconds, self.max_attempts)
+            )
+            if cur.rowcount:
+                print(f"{cur.rowcount} abandoned messages out of attempts, marked as failed")
+            cur.execute(
+                """
+                UPDATE message_queue
+                SET status = 'processing', attempts = attempts + 1, locked_at = NOW()
+                WHERE id = (
+                    SELECT id FROM message_queue
+                    WHERE status = 'pending'
+                       OR (status = 'processing' AND locked_at < NOW() - make_interval(secs => %s) AND attempts < %s)
+                    ORDER BY priority DESC, id
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+                )
+                RETURNING id, chat_title, message_id, message_text, attempts, priority
+                """,
+                (self.lease_seconds, self.max_attempts)
+            )
+            row = cur.fetchone()
+            return QueuedMessage(*row) if row else None
+
+    def renew_lease(self, queue_id):
+        """The message is still being processed"""
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "UPDATE message_queue SET locked_at = NOW() WHERE id = %s AND status = 'processing'",
+                (queue_id,)
+            )
+
+    def complete(self, queue_id):
+        """Mark a message as processed"""
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "UPDATE message_queue SET status = 'done', finished_at = NOW(), last_error = NULL WHERE id = %s",
+                (queue_id,)
+            )
+
+    def fail(self, queued: QueuedMessage, error):
+        """Put a message back in the queue, or mark it as failed after too many attempts"""
+        status = "failed" if queued.attempts >= self.max_attempts else "pending"
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "UPDATE message_queue SET status = %s, last_error = %s, locked_at = NULL WHERE id = %s",
+                (status, str(error)[:2000], queued.id)
+            )
+        print(f"Message {queued.thread_id} failed (attempt {queued.attempts}), now {status}: {error}")
+
+    def close(self):
+        self.pool.closeall()
+
+
+class QueueWorkers:
+    """Asyncio workers that claim messages and process them in the default executor"""
+
+    def __init__(self, queue: MessageQueue, process, workers=2, poll_seconds=2.0):
+        self.queue = queue
+        self.process = process
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.work_available = asyncio.Event()
+        self.tasks = []
+
+    def notify(self):
+        """Wake the workers up, a message was enqueued"""
+        self.work_available.set()
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def _worker(self, number):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                queued = await loop.run_in_executor(None, self.queue.claim)
+            except Exception as e:
+                print(f"Worker {number} could not claim a message: {e}")
+                await asyncio.sleep(self.poll_seconds)
+                continue
+
+            if queued is None:
+                # Messages enqueued by other processes are picked up by polling
+                self.work_available.clear()
+                try:
+                    await asyncio.wait_for(self.work_available.wait(), self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heartbeat = asyncio.create_task(self._renew_lease(queued))
+            try:
+                await self.process(queued)
+                await loop.run_in_executor(None, self.queue.complete, queued.id)
+            except Exception as e:
+                await loop.run_in_executor(None, self.queue.fail, queued, e)
+            finally:
+                heartbeat.cancel()
+
+    async def _renew_lease(self, queued):
+        """Keep the lease of a message alive while it is processed, however long its LLM calls retry"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            try:
+                await loop.run_in_executor(None, self.queue.renew_lease, queued.id)
+            except Exception as e:
+                print(f"Could not renew the lease of {queued.thread_id}: {e}")
+
+
+async def benchmark_queue(messages=200, worker_counts=(1, 2, 4, 8), work_seconds=0.05):
+    """
+    Measure the queue throughput with several worker counts.
+
+    Each message simulates `work_seconds` of workflow time (LLM calls are I/O bound),
+    so the result shows the claim/settle overhead and how well workers scale.
+    """
+    queue = MessageQueue(max_connections=max(worker_counts) + 2)
+    chat_title = "__queue_benchmark__"
+
+    async def process(queued):
+        await asyncio.sleep(work_seconds)
+
+    def cleanup():
+        with queue.connection() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM message_queue WHERE chat_title = %s", (chat_title,))
+
+    try:
+        for workers in worker_counts:
+            cleanup()
+            base = int(time.time() * 1000)
+            for i in range(messages):
+                queue.enqueue(chat_title, base + i, f"benchmark message {i}")
+
+            runner = QueueWorkers(queue, process, workers=workers, poll_seconds=0.05)
+            start = time.perf_counter()
+            runner.start()
+            while True:
+                with queue.connection() as conn, conn.cursor() as cur:
+                    cur.execute("SELECT count(*) FROM message_queue WHERE chat_title = %s AND status <> 'done'",
+                                (chat_title,))
+                    if cur.fetchone()[0] == 0:
+                        break
+                await asyncio.sleep(0.02)
+            elapsed = time.perf_counter() - start
+            await runner.stop()
+
+            ideal = workers / work_seconds
+            print(f"{workers:>2} workers: {messages / elapsed:8.1f} msg/s "
+                  f"({elapsed:.2f}s for {messages} messages, ideal {ideal:.1f} msg/s)")
+    finally:
+        cleanup()
+        queue.close()
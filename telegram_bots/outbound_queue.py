@@ -0,0 +1,216 @@
+"""
+Outbound delivery queue for the messages the bot sends to Telegram.
+
+Messages are enqueued per chat and delivered by a background task that:
+- respects a token-bucket rate limit per chat
+- honours FloodWait errors by rescheduling the delivery instead of blocking
+- retries any other error with a capped backoff, an alert is never dropped
+- coalesces alerts that arrive within a short window into a single digest,
+  split at Telegram's 4096 character limit (a lone alert is not delayed)
+"""
+import os
+import time
+import asyncio
+from telethon.errors import FloodWaitError
+
+# Telegram rejects messages longer than this
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Rate limit per chat (Telegram allows ~20 messages per minute in groups)
+OUTBOUND_RATE_PER_MINUTE = float(os.getenv("OUTBOUND_RATE_PER_MINUTE", "20"))
+OUTBOUND_BURST = int(os.getenv("OUTBOUND_BURST", "3"))
+
+# Alerts arriving within this window are sent together as one digest
+OUTBOUND_COALESCE_SECONDS = float(os.getenv("OUTBOUND_COALESCE_SECONDS", "2"))
+
+# Longest wait between two retries of a message that failed (with other errors than FloodWait)
+OUTBOUND_MAX_BACKOFF_SECONDS = float(os.getenv("OUTBOUND_MAX_BACKOFF_SECONDS", "60"))
+
+# Failed attempts after which the message is sent as plain text, a Markdown error fails every time
+OUTBOUND_PLAIN_TEXT_AFTER = int(os.getenv("OUTBOUND_PLAIN_TEXT_AFTER", "3"))
+
+DIGEST_SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+
+# Prepended to the messages sent by the fallback client, the digests leave room for it
+FALLBACK_PREFIX = "[BOT FALLBACK] "
+
+
+class TokenBucket:
+    """Simple token bucket, refilled continuously at `rate` tokens per second"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return now
+
+    def delay(self):
+        """Seconds to wait until a token is available"""
+        now = self._refill()
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    async def acquire(self):
+        """Wait for a token and consume it"""
+        while True:
+            wait = self.delay()
+            if wait <= 0:
+                self.tokens -= 1
+                return
+            await asyncio.sleep(wait)
+
+    def penalise(self, seconds):
+        """Block the bucket for `seconds` (used when Telegram asks us to wait)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Split a message in chunks of at most `limit` characters, preferring line breaks"""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+def build_digests(alerts, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Pack a list of alerts into as few messages as possible, none above `limit`"""
+    digests = []
+    current = ""
+    for alert in alerts:
+        for part in split_message(alert, limit):
+            if not current:
+                current = part
+            elif len(current) + len(DIGEST_SEPARATOR) + len(part) <= limit:
+                current += DIGEST_SEPARATOR + part
+            else:
+                digests.append(current)
+                current = part
+    if current:
+        digests.append(current)
+    return digests
+
+
+class OutboundQueue:
+    """Per-chat delivery queue with rate limiting, FloodWait handling and digests"""
+
+    def __init__(self, client, fallback_client=None,
+                 rate_per_minute=OUTBOUND_RATE_PER_MINUTE,
+                 burst=OUTBOUND_BURST,
+                 coalesce_seconds=OUTBOUND_COALESCE_SECONDS,
+                 max_backoff_seconds=OUTBOUND_MAX_BACKOFF_SECONDS,
+                 plain_text_after=OUTBOUND_PLAIN_TEXT_AFTER,
+                 parse_mode="Markdown"):
+        self.client = client
+        self.fallback_client = fallback_client
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.coalesce_seconds = coalesce_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.plain_text_after = plain_text_after
+        self.parse_mode = parse_mode
+        self.queues = {}
+        self.buckets = {}
+        self.workers = {}
+        self.message_limit = TELEGRAM_MESSAGE_LIMIT - (len(FALLBACK_PREFIX) if fallback_client is not None else 0)
+
+        # Handle FloodWait ourselves instead of letting Telethon sleep inside send_message
+        self.client.flood_sleep_threshold = 0
+
+    def bucket(self, chat_id):
+        """Get the token bucket for a chat"""
+        if chat_id not in self.buckets:
+            self.buckets[chat_id] = TokenBucket(self.rate, self.burst)
+        return self.buckets[chat_id]
+
+    def enqueue(self, chat_id, text, on_done=None):
+        """
+        Schedule a message for delivery, never blocks. on_done() is called once it was sent.
+        """
+        if chat_id not in self.queues:
+            self.queues[chat_id] = asyncio.Queue()
+        self.queues[chat_id].put_nowait((text, on_done))
+
+        worker = self.workers.get(chat_id)
+        if worker is None or worker.done():
+            self.workers[chat_id] = asyncio.create_task(self._worker(chat_id))
+
+    async def _worker(self, chat_id):
+        queue = self.queues[chat_id]
+        while True:
+            alerts = [await queue.get()]
+
+            # A lone alert goes out right away. When others are already queued (a burst) or the chat
+            # is out of tokens (the alert has to wait anyway), the next ones get the chance to join the digest
+            wait = self.bucket(chat_id).delay()
+            if not queue.empty() or wait > 0:
+                await asyncio.sleep(max(self.coalesce_seconds, wait))
+            while not queue.empty():
+                alerts.append(queue.get_nowait())
+
+            if len(alerts) > 1:
+                print(f"Coalescing {len(alerts)} alerts for chat {chat_id}")
+
+            for digest in build_digests([text for text, _ in alerts], self.message_limit):
+                await self._deliver(chat_id, digest)
+
+            for _, on_done in alerts:
+                if on_done is not None:
+                    on_done()
+                queue.task_done()
+
+    async def _deliver(self, chat_id, text):
+        """Send one message, falling back to the user client and retrying until it is sent"""
+        bucket = self.bucket(chat_id)
+        attempts = 0
+        while True:
+            parse_mode = self.parse_mode if attempts < self.plain_text_after else None
+            await bucket.acquire()
+            try:
+                await self.client.send_message(chat_id, text, parse_mode=parse_mode)
+                print("Message sent successfully via bot!")
+                return
+            except FloodWaitError as e:
+                # FloodWait is never counted as a failed attempt, the alert must go out
+                print(f"FloodWait for chat {chat_id}, retrying in {e.seconds}s")
+                bucket.penalise(e.seconds)
+                continue
+            except Exception as e:
+                print(f"Error sending message: {e}")
+
+            if self.fallback_client is not None:
+                try:
+                    await self.fallback_client.send_message(chat_id, FALLBACK_PREFIX + text, parse_mode=parse_mode)
+                    print("Fallback message sent via user account")
+                    return
+                except FloodWaitError as e:
+                    print(f"FloodWait on fallback for chat {chat_id}, retrying in {e.seconds}s")
+                    bucket.penalise(e.seconds)
+                    continue
+                except Exception as e2:
+                    print(f"Fallback also failed: {e2}")
+
+            attempts += 1
+            if attempts == self.plain_text_after:
+                print(f"Message to chat {chat_id} failed {attempts} times, retrying as plain text")
+            await asyncio.sleep(min(self.max_backoff_seconds, 2 ** attempts))
+
+    async def join(self):
+        """Wait until every enqueued message has been delivered"""
+        for queue in list(self.queues.values()):
+            await queue.join()
@@ -1,14 +1,20 @@
 # pip install telethon
+# The workflow (LangGraph, LangChain) and numpy are imported in the background once Telegram is connected, see load_workflow
 from telethon import TelegramClient, events, types
-from agent.sales_evaluation_agent import run_workflow
+from telegram_bots.outbound_queue import OutboundQueue
+from telegram_bots.streaming import ProgressiveMessage
+from telegram_bots.message_queue import MessageQueue, QueueWorkers
+from telegram_bots.sharding import LISTENER_SHARD, ShardMembership, ShardedListener, DatabaseOutbox
 import os
+import json
 from dotenv import load_dotenv
 import asyncio
 import sys
 import psycopg2
 from datetime import datetime
-from sentence_transformers import SentenceTransformer
-import numpy as np
+from utils.embeddings import get_embedding_model, get_embedding
+from utils.vector_store import storage_columns, search_similar, EMBEDDING_TEXT_SQL
+from utils.profiling import profile_run
 
 # Load environment variables
 load_dotenv()
@@ -20,6 +26,12 @@ api_hash = os.getenv("API_HASH")
 # Create sessions directory if it doesn't exist
 os.makedirs("telegram_bots/sessions", exist_ok=True)
 session = "telegram_bots/sessions/user_session"
+bot_session = "telegram_bots/sessions/bot_session"
+
+# Each shard has its own sessions, Telethon session files can't be shared between processes
+if LISTENER_SHARD:
+    session = f"{session}_{LISTENER_SHARD}"
+    bot_session = f"{bot_session}_{LISTENER_SHARD}"
 
 # Use your bot token for the sender
 bot_token = os.getenv("TELEGRAM_BOT_TOKEN")  # Add your bot token to .env file
@@ -35,6 +47,16 @@ if test:
 # Use negative chat ID for the wishlist group
 WISHLIST_GROUP_ID = int(os.getenv("WISHLIST_GROUP_ID"))
 
+# Where the per-user coupon alerts go: "group" mentions the user in the wishlist group,
+# "private" sends them straight to the user (they must have started a chat with the bot)
+USER_ALERTS_DESTINATION = os.getenv("USER_ALERTS_DESTINATION", "group")
+
+# Stream the LLM written deal messages to Telegram while they are generated
+STREAM_DEAL_MESSAGES = os.getenv("STREAM_DEAL_MESSAGES", "false").lower() == "true"
+
+# Number of messages processed by the workflow at the same time
+WORKFLOW_WORKERS = int(os.getenv("WORKFLOW_WORKERS", "2"))
+
 # Database connection parameters
 DB_USER = os.getenv("DATABASE_USER", "postgres")
 DB_PASSWORD = os.getenv("DATABASE_PASSWORD", "postgres")
@@ -45,38 +67,6 @@ DB_PORT = os.getenv("DATABASE_PORT", "5432")
 # Create connection string
 DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
-# Initialize the embedding model (lazy loading - will load on first use)
-embedding_model = None
-
-def get_embedding_model():
-    """Get or initialize the embedding model"""
-    global embedding_model
-    if embedding_model is None:
-        # Load the model - this will download it if not already present
-        print("Loading embedding model...")
-        embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-        print("Embedding model loaded")
-    return embedding_model
-
-def get_embedding(text):
-    """Generate embedding for the given text using MiniLM"""
-    try:
-        if not text or text.strip() == "":
-            return None
-            
-        # Truncate text if it's too long
-        if len(text) > 5000:  # Arbitrary limit to avoid memory issues
-            text = text[:5000]
-            
-        model = get_embedding_model()
-        embedding = model.encode(text)
-        
-        # Convert to list for database storage
-        return embedding.tolist()
-    except Exception as e:
-        print(f"Error generating embedding: {e}")
-        return None
-
 def get_db_connection():
     """Create and return a database connection"""
     conn = psycopg2.connect(
@@ -89,7 +79,7 @@ def get_db_connection():
     return conn
 
 def store_message(chat_title, message_text, message_id, sender_id):
-    """Store the message and its embedding in the database"""
+    """Store the message and its embedding in the database, returns the embedding"""
     try:
         # Generate embedding for the message
         embedding = get_embedding(message_text)
@@ -97,31 +87,59 @@ def store_message(chat_title, message_text, message_id, sender_id):
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        # Insert the message into the telegram_messages table with embedding
-        if embedding:
-            cursor.execute(
-                """
-                INSERT INTO telegram_messages (chat_title, message_text, message_id, sender_id, embedding)
-                VALUES (%s, %s, %s, %s, %s)
-                """,
-                (chat_title, message_text, message_id, sender_id, embedding)
-            )
-        else:
-            # Insert without embedding if generation failed
-            cursor.execute(
-                """
-                INSERT INTO telegram_messages (chat_title, message_text, message_id, sender_id)
-                VALUES (%s, %s, %s, %s)
-                """,
-                (chat_title, message_text, message_id, sender_id)
-            )
+        # Insert the message into the telegram_messages table with embedding, in the columns of EMBEDDING_STORAGE
+        # (without embedding if generation failed)
+        columns, placeholders, values = storage_columns(embedding)
+        cursor.execute(
+            f"""
+            INSERT INTO telegram_messages (chat_title, message_text, message_id, sender_id{"".join(", " + c for c in columns)})
+            VALUES (%s, %s, %s, %s{"".join(", " + p for p in placeholders)})
+            ON CONFLICT (chat_title, message_id) DO NOTHING
+            """,
+            (chat_title, message_text, message_id, sender_id, *values)
+        )
         
         conn.commit()
         cursor.close()
         conn.close()
         print(f"Message stored in database with embedding. ID: {message_id}")
+        return embedding
     except Exception as e:
         print(f"Error storing message in database: {e}")
+        return None
+
+def get_message_embedding(chat_title, message_id):
+    """Embedding stored for a message, None if it has none"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            f"SELECT {EMBEDDING_TEXT_SQL} FROM telegram_messages WHERE chat_title = %s AND message_id = %s",
+            (chat_title, message_id)
+        )
+        row = cursor.fetchone()
+        cursor.close()
+        conn.close()
+        # pgvector values come as '[0.1,0.2,...]' strings
+        return json.loads(row[0]) if row and row[0] else None
+    except Exception as e:
+        print(f"Error loading message embedding: {e}")
+        return None
+
+def store_outcome(chat_title, message_id, coupon_found, deal_sent):
+    """Record what the workflow found for a message, the labels of the deal classifier"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE telegram_messages SET coupon_found = %s, deal_sent = %s WHERE chat_title = %s AND message_id = %s",
+            (coupon_found, deal_sent, chat_title, message_id)
+        )
+        conn.commit()
+        cursor.close()
+        conn.close()
+    except Exception as e:
+        print(f"Error storing message outcome: {e}")
 
 def search_similar_messages(query_text, limit=5):
     """Search for messages similar to the query text"""
@@ -134,20 +152,8 @@ def search_similar_messages(query_text, limit=5):
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        # Search for similar messages using cosine similarity
-        cursor.execute(
-            """
-            SELECT id, chat_title, message_text, 
-                   1 - (embedding <=> %s) as similarity
-            FROM telegram_messages
-            WHERE embedding IS NOT NULL
-            ORDER BY embedding <=> %s
-            LIMIT %s
-            """,
-            (query_embedding, query_embedding, limit)
-        )
-        
-        results = cursor.fetchall()
+        # Search for similar messages using cosine similarity (re-ranked in the compact storage modes)
+        results = search_similar(cursor, query_embedding, limit)
         cursor.close()
         conn.close()
         
@@ -167,6 +173,14 @@ def search_similar_messages(query_text, limit=5):
         print(f"Error searching similar messages: {e}")
         return []
 
+def user_alert_destination(user_id, deal_message):
+    """Return the chat and text for an alert addressed to a single user"""
+    if user_id is None:
+        return WISHLIST_GROUP_ID, deal_message
+    if USER_ALERTS_DESTINATION == "private":
+        return user_id, deal_message
+    return WISHLIST_GROUP_ID, f"[🔔 Alerta para você](tg://user?id={user_id})\n\n{deal_message}"
+
 def process_sales_message(chat_title, message_text):
     """Function that processes the received sales message"""
     print(f"Sales alert from {chat_title}: {message_text}")
@@ -225,6 +239,14 @@ async def test_bot_send_message():
     await user_client.disconnect()
     print("Test completed.")
 
+def load_workflow():
+    """Import and compile the workflow and load its models, returns run_workflow"""
+    from agent.sales_evaluation_agent import run_workflow, get_workflow
+    from agent.deal_classifier import get_deal_classifier
+    get_workflow()
+    get_deal_classifier()
+    return run_workflow
+
 async def main():
     # Start listener client
     print("Starting listener (personal account)")
@@ -233,53 +255,137 @@ async def main():
     
     print("Starting sender (bot account)")
     # Use a different session name for the bot
-    client_sender = TelegramClient("telegram_bots/sessions/bot_session", api_id, api_hash)
+    client_sender = TelegramClient(bot_session, api_id, api_hash)
     # Make sure we're using the bot token
     await client_sender.start(bot_token=bot_token)
     
     # Verify the bot identity
     bot_info = await client_sender.get_me()
     print(f"Bot authenticated as: @{bot_info.username} (ID: {bot_info.id})")
-    
-    @client_listener.on(events.NewMessage(chats=SALES_GROUP.split(",")))
-    async def sales_watcher(event):
-        # Store the message in the database
-        store_message(
-            event.chat.title, 
-            event.message.text, 
-            event.message.id,
-            event.message.sender_id if event.message.sender else None
-        )
-        
-        # Call the processing function with the message details
-        process_sales_message(event.chat.title, event.message.text)
 
-        # Process messages sequentially to avoid race conditions
-        async with asyncio.Lock():
-            data = run_workflow(event.message.text)
+    # Outbound messages go through a rate limited queue, falling back to the user account
+    outbound = OutboundQueue(client_sender, fallback_client=client_listener)
+
+    # The workflow runs in worker threads, so the event loop stays free for new messages and the streamed edits
+    loop = asyncio.get_running_loop()
+
+    # Sharded, the alerts of every shard are sent by a single one (telegram_bots/sharding.py)
+    alerts = outbound
+    if LISTENER_SHARD:
+        alerts = DatabaseOutbox(outbound, loop)
+        asyncio.create_task(alerts.run())
+
+    # Heavy dependencies load in the background, Telegram is already connected and messages are queued meanwhile
+    workflow_loading = loop.run_in_executor(None, load_workflow)
+    loop.run_in_executor(None, get_embedding_model)
+
+    def stream_factory(user_id=None):
+        """Progressive message for a deal message being generated for a user (or the whole group)"""
+        chat_id, prefix = user_alert_destination(user_id, "")
+        return ProgressiveMessage(
+            client_sender, chat_id, loop,
+            prefix=prefix,
+            bucket=outbound.bucket(chat_id),
+            should_post=lambda text: "no match" not in text.lower(),
+        )
+    
+    def deliver(data):
+        """Send the messages generated by a workflow run, returns True if a deal was sent"""
         print(data)
         print(data.get('deal_message'))
-        # Send deal message to the wishlist group if one was generated
-        if data.get('deal_message') and "no match" not in data.get('deal_message').lower():
-            try:
-                # Use the negative chat ID
-                await client_sender.send_message(WISHLIST_GROUP_ID, data['deal_message'], parse_mode="Markdown")
-                print("Message sent successfully via bot!")
-            except Exception as e:
-                print(f"Error sending message: {e}")
-                # Fallback: try to send using the user account if bot fails
-                try:
-                    await client_listener.send_message(WISHLIST_GROUP_ID, 
-                                                     f"[BOT FALLBACK] {data['deal_message']}", parse_mode="Markdown")
-                    print("Fallback message sent via user account")
-                except Exception as e2:
-                    print(f"Fallback also failed: {e2}")
-        else:
+        sent = False
+        # Send deal message to the wishlist group if one was generated (and not already streamed there)
+        if data.get('deal_message_streamed'):
+            print("Deal message already streamed.")
+            sent = True
+        elif data.get('deal_message') and "no match" not in data.get('deal_message').lower():
+            # Delivery is rate limited and retried by the outbound queue, so the handler never blocks on it
+            alerts.enqueue(WISHLIST_GROUP_ID, data['deal_message'])
+            sent = True
+        elif not data.get('deal_messages') and not data.get('product_match_messages'):
             print("No message will be sent.")
+
+        # Coupon and exact product alerts are crafted per user, each one goes to its user
+        for alert in data.get('deal_messages', []) + data.get('product_match_messages', []):
+            sent = True
+            if alert.get('streamed'):
+                continue
+            chat_id, text = user_alert_destination(alert['user_id'], alert['deal_message'])
+            alerts.enqueue(chat_id, text)
+        return sent
+
+    async def process_queued_message(queued):
+        """Run the workflow for a message claimed from the queue (resuming it if it was interrupted)"""
+        run_workflow = await workflow_loading
+        overrides = await loop.run_in_executor(None, admission.workflow_overrides)
+        # The stored embedding feeds the deal classifier at the start of the workflow
+        overrides["embedding"] = await loop.run_in_executor(
+            None, get_message_embedding, queued.chat_title, queued.message_id
+        )
+        data = await loop.run_in_executor(
+            None, run_workflow, queued.message_text,
+            stream_factory if STREAM_DEAL_MESSAGES else None, queued.thread_id, overrides
+        )
+        sent = deliver(data)
+        # Runs dropped by the classifier, or ended before the message was examined (empty wishlist,
+        # direct compare shed under load) have no known outcome, they are left out of its training data
+        coupon_found = data.get('coupon_found')
+        deal_sent = sent if coupon_found is not None or sent else None
+        await loop.run_in_executor(
+            None, store_outcome, queued.chat_title, queued.message_id, coupon_found, deal_sent
+        )
+
+    # Messages are queued in Postgres first, so a crash or a Groq timeout doesn't lose them
+    message_queue = MessageQueue(max_connections=WORKFLOW_WORKERS + 2)
+    # Messages are scored before they are queued, the queue is bounded and sheds the least important ones
+    from telegram_bots.admission import AdmissionController
+    admission = AdmissionController(message_queue)
+    workers = QueueWorkers(message_queue, process_queued_message, workers=WORKFLOW_WORKERS)
+    workers.start()
+    
+    async def ingest(chat_title, message):
+        """Store, score and enqueue a message of a sales group"""
+        # Slow handling (embedding, database) is profiled like the workflow runs, see utils/profiling.py
+        with profile_run(f"watcher-{chat_title}:{message.id}"):
+            # Store the message in the database (in a thread, the embedding model may still be loading)
+            embedding = await loop.run_in_executor(
+                None, store_message,
+                chat_title, 
+                message.text, 
+                message.id,
+                message.sender_id if message.sender else None
+            )
+
+            # Call the processing function with the message details
+            process_sales_message(chat_title, message.text)
+
+            # Score and enqueue it for the workflow workers (a message seen before, or shed, is ignored)
+            admitted = await loop.run_in_executor(
+                None, admission.admit, chat_title, message.id, message.text or "", embedding
+            )
+            if admitted:
+                workers.notify()
+
+    async def sales_watcher(event):
+        await ingest(event.chat.title, event.message)
+
+    groups = SALES_GROUP.split(",")
+    membership = None
+    if LISTENER_SHARD:
+        # The handler is registered for the groups of this shard, and moved when shards join or die
+        membership = ShardMembership(LISTENER_SHARD, groups)
+        asyncio.create_task(ShardedListener(client_listener, sales_watcher, ingest, membership).run())
+    else:
+        client_listener.add_event_handler(sales_watcher, events.NewMessage(chats=groups))
     
     # Keep the script running
     print("Bot is running...")
-    await client_listener.run_until_disconnected()
+    try:
+        await client_listener.run_until_disconnected()
+    finally:
+        if membership is not None:
+            # The other shards take the groups over at their next heartbeat
+            await loop.run_in_executor(None, membership.leave)
 
 if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1] == "test":
@@ -0,0 +1,288 @@
+"""
+Sharded listening of the sales groups across listener processes.
+
+Give every listener process its own LISTENER_SHARD name (or `python run_bots.py sales
+--shard=NAME`), each one then uses its own Telegram sessions. Shards heartbeat in the
+listener_shards table and the groups of SALES_GROUP are spread over the live shards by
+consistent hashing (SHARD_VNODES points per shard on a hash ring), so a shard joining or
+leaving only moves its own share of the groups. Every SHARD_HEARTBEAT_SECONDS each shard
+recomputes its groups: a shard without a heartbeat for SHARD_TTL_SECONDS is dead, its groups
+move to the others, which catch up the messages posted since the last one stored (or, for a
+group without stored messages, since the last heartbeat of a dead shard).
+
+The rest is coordinated by the database already: messages are stored and queued
+idempotently on (chat_title, message_id), so a group briefly listened to by two shards is
+harmless, and the workflow workers of every shard claim from the same message queue.
+Alerts are written to outbound_messages and sent by the single shard holding the outbox
+advisory lock, so the per chat rate limits of OutboundQueue hold across shards. Rows are
+marked as claimed when handed to OutboundQueue and deleted once it sent them; the claims of
+a shard that died are released by the next shard taking the lock. Delivery is at least
+once: a message sent just before its shard died, or whose delete failed, is sent again.
+"""
+import os
+import asyncio
+import hashlib
+from bisect import bisect
+from functools import partial
+from typing import List, Optional
+
+import psycopg2
+from telethon import events
+from utils.database import get_database_url
+
+LISTENER_SHARD = os.getenv("LISTENER_SHARD")
+SHARD_HEARTBEAT_SECONDS = float(os.getenv("SHARD_HEARTBEAT_SECONDS", "10"))
+SHARD_TTL_SECONDS = float(os.getenv("SHARD_TTL_SECONDS", "30"))
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "64"))
+
+# Most messages fetched for a group taken over from another shard
+SHARD_CATCH_UP_LIMIT = int(os.getenv("SHARD_CATCH_UP_LIMIT", "200"))
+
+# pg_try_advisory_lock key of the shard sending the outbound messages
+OUTBOX_LOCK_KEY = 4701
+OUTBOX_POLL_SECONDS = 1.0
+OUTBOX_BATCH = 100
+
+def ring_hash(key: str) -> int:
+    """Same value in every process (the built-in hash() of a str is salted per process)"""
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hashing of the groups over the shards"""
+
+    def __init__(self, shards: List[str], vnodes: int = SHARD_VNODES):
+        points = sorted((ring_hash(f"{shard}#{i}"), shard) for shard in shards for i in range(vnodes))
+        self.hashes = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self.hashes:
+            return None
+        return self.shards[bisect(self.hashes, ring_hash(key)) % len(self.hashes)]
+
+
+class ShardMembership:
+    """Heartbeat of this shard and the groups it owns among the live shards"""
+
+    def __init__(self, name: str, groups: List[str], database_url=None, ttl_seconds: float = SHARD_TTL_SECONDS):
+        self.name = name
+        self.groups = groups
+        self.database_url = database_url or get_database_url()
+        self.ttl_seconds = ttl_seconds
+
+    def heartbeat(self) -> List[str]:
+        """Record this shard as alive, returns the groups it owns"""
+        with psycopg2.connect(self.database_url) as conn:
+            with conn.cursor() as cur:
+                # The database clock for every shard, their own clocks may drift
+                cur.execute(
+                    """
+                    INSERT INTO listener_shards (name, heartbeat_at) VALUES (%s, NOW())
+                    ON CONFLICT (name) DO UPDATE SET heartbeat_at = NOW()
+                    """,
+                    (self.name,)
+                )
+                cur.execute(
+                    "SELECT name FROM listener_shards WHERE heartbeat_at > NOW() - make_interval(secs => %s)",
+                    (self.ttl_seconds,)
+                )
+                alive = [row[0] for row in cur.fetchall()]
+        ring = HashRing(alive)
+        return [group for group in self.groups if ring.owner(group) == self.name]
+
+    def leave(self):
+        """Remove this shard right away on a clean shutdown, instead of waiting for the TTL"""
+        with psycopg2.connect(self.database_url) as conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM listener_shards WHERE name = %s", (self.name,))
+
+    def last_message_id(self, chat_title) -> Optional[int]:
+        with psycopg2.connect(self.database_url) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT MAX(message_id) FROM telegram_messages WHERE chat_title = %s", (chat_title,))
+                return cur.fetchone()[0]
+
+    def catch_up_since(self):
+        """Last heartbeat of the shards that died, or the TTL ago when none did (a shard joined or left)"""
+        with psycopg2.connect(self.database_url) as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT COALESCE(
+                        MAX(heartbeat_at) FILTER (WHERE heartbeat_at <= NOW() - make_interval(secs => %s)),
+                        NOW() - make_interval(secs => %s)
+                    )
+                    FROM listener_shards WHERE name <> %s
+                    """,
+                    (self.ttl_seconds, self.ttl_seconds, self.name)
+                )
+                return cur.fetchone()[0]
+
+
+class ShardedListener:
+    """Keeps the NewMessage handler of the client registered for the groups of this shard"""
+
+    def __init__(self, client, handler, ingest, membership: ShardMembership,
+                 catch_up_limit: int = SHARD_CATCH_UP_LIMIT):
+        self.client = client
+        # handler(event) for the new messages, ingest(chat_title, message) for the caught up ones
+        self.handler = handler
+        self.ingest = ingest
+        self.membership = membership
+        self.catch_up_limit = catch_up_limit
+        self.owned = set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                owned = await loop.run_in_executor(None, self.membership.heartbeat)
+            except Exception as e:
+                # Keep listening, a group listened to twice is deduplicated, a group nobody listens to is lost
+                print(f"Shard heartbeat failed, keeping the current groups: {e}")
+            else:
+                if set(owned) != self.owned:
+                    await self.rebalance(owned)
+            await asyncio.sleep(SHARD_HEARTBEAT_SECONDS)
+
+    async def rebalance(self, owned: List[str]):
+        gained = [group for group in owned if group not in self.owned]
+        self.client.remove_event_handler(self.handler)
+        if owned:
+            self.client.add_event_handler(self.handler, events.NewMessage(chats=owned))
+        self.owned = set(owned)
+        print(f"Shard {self.membership.name} listens to {len(owned)} of {len(self.membership.groups)} groups: {owned}")
+        for group in gained:
+            await self.catch_up(group)
+
+    async def catch_up(self, group):
+        """Messages of a group posted while no shard was listening to it"""
+        loop = asyncio.get_running_loop()
+        try:
+            entity = await self.client.get_entity(group)
+            last_id = await loop.run_in_executor(None, self.membership.last_message_id, entity.title)
+            if last_id is not None:
+                messages = self.client.iter_messages(entity, min_id=last_id, reverse=True, limit=self.catch_up_limit)
+            else:
+                # Nothing stored for the group yet, the messages posted since its previous owner stopped
+                since = await loop.run_in_executor(None, self.membership.catch_up_since)
+                messages = self.client.iter_messages(entity, offset_date=since, reverse=True, limit=self.catch_up_limit)
+            caught_up = 0
+            async for message in messages:
+                await self.ingest(entity.title, message)
+                caught_up += 1
+            if caught_up:
+                print(f"Caught up {caught_up} messages of {entity.title}")
+        except Exception as e:
+            print(f"Error catching up the messages of {group}: {e}")
+
+
+class DatabaseOutbox:
+    """
+    Outbound messages of every shard, delivered by the shard holding the outbox lock through its
+    OutboundQueue. The lock is tied to a connection, when that shard dies another one takes over.
+    """
+
+    def __init__(self, outbound, loop, database_url=None):
+        self.outbound = outbound
+        self.loop = loop
+        self.database_url = database_url or get_database_url()
+        self.leader = False
+        # Ids claimed by this shard and still in its OutboundQueue
+        self.in_flight = set()
+
+    def bucket(self, chat_id):
+        return self.outbound.bucket(chat_id)
+
+    def enqueue(self, chat_id, text):
+        """Same as OutboundQueue.enqueue, never blocks (the row is inserted in a worker thread)"""
+        future = self.loop.run_in_executor(None, self.insert, chat_id, text)
+        future.add_done_callback(
+            lambda done: done.exception() and print(f"Error storing outbound message: {done.exception()}")
+        )
+
+    def insert(self, chat_id, text):
+        with psycopg2.connect(self.database_url) as conn:
+            with conn.cursor() as cur:
+                cur.execute("INSERT INTO outbound_messages (chat_id, message_text) VALUES (%s, %s)", (chat_id, text))
+
+    @staticmethod
+    def try_lock(conn) -> bool:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (OUTBOX_LOCK_KEY,))
+            return cur.fetchone()[0]
+
+    def release_stale(self, conn):
+        """
+        Release the claims left by a previous lock holder, their messages are sent again. Some
+        may have been sent already (the holder died before deleting them): alerts can be duplicated.
+        """
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE outbound_messages SET claimed_at = NULL WHERE claimed_at IS NOT NULL AND NOT (id = ANY(%s))",
+                (list(self.in_flight),)
+            )
+            if cur.rowcount:
+                print(f"Released {cur.rowcount} outbound messages claimed by a previous shard")
+
+    @staticmethod
+    def claim(conn):
+        """Mark the oldest unclaimed messages as claimed, oldest first"""
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE outbound_messages SET claimed_at = NOW() WHERE id IN (
+                    SELECT id FROM outbound_messages WHERE claimed_at IS NULL
+                    ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, chat_id, message_text
+                """,
+                (OUTBOX_BATCH,)
+            )
+            return sorted(cur.fetchall())
+
+    def delete(self, message_id):
+        with psycopg2.connect(self.database_url) as conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM outbound_messages WHERE id = %s", (message_id,))
+
+    def done(self, message_id):
+        """OutboundQueue sent a message, it leaves the table"""
+        future = self.loop.run_in_executor(None, self.delete, message_id)
+
+        def deleted(done):
+            if done.exception():
+                # Still claimed, it is sent again if another shard takes the lock
+                print(f"Error deleting outbound message {message_id}: {done.exception()}")
+            self.in_flight.discard(message_id)
+        future.add_done_callback(deleted)
+
+    async def run(self):
+        conn = None
+        while True:
+            try:
+                if conn is None:
+                    conn = await self.loop.run_in_executor(None, psycopg2.connect, self.database_url)
+                    conn.autocommit = True
+                if not self.leader:
+                    self.leader = await self.loop.run_in_executor(None, self.try_lock, conn)
+                    if self.leader:
+                        print("This shard sends the outbound messages")
+                        # Only the lock holder claims, so the other claims are from a shard that lost it
+                        await self.loop.run_in_executor(None, self.release_stale, conn)
+                if self.leader:
+                    # Handed to the local queue (rate limits, digests), like a message of this shard
+                    rows = await self.loop.run_in_executor(None, self.claim, conn)
+                    for message_id, chat_id, text in rows:
+                        self.in_flight.add(message_id)
+                        self.outbound.enqueue(chat_id, text, on_done=partial(self.done, message_id))
+                    if len(rows) == OUTBOX_BATCH:
+                        continue
+            except Exception as e:
+                print(f"Outbox error: {e}")
+                self.leader = False
+                if conn is not None:
+                    conn.close()
+                    conn = None
+            await asyncio.sleep(OUTBOX_POLL_SECONDS)
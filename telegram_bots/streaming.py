@@ -0,0 +1,179 @@
+"""
+Progressive delivery of LLM generated messages.
+
+The workflow runs in a worker thread and feeds the text generated so far; the
+message is posted as soon as there is something worth showing and then edited
+at a throttled cadence on the event loop until the final text is known.
+"""
+import os
+import re
+import time
+import asyncio
+import threading
+from telethon.errors import FloodWaitError, MessageNotModifiedError
+from telegram_bots.outbound_queue import split_message
+
+# Minimum interval between two edits of the same message
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+
+# Don't post anything before the LLM produced this many characters
+STREAM_MIN_CHARS = int(os.getenv("STREAM_MIN_CHARS", "40"))
+
+# Appended to the partial text while the message is being generated
+TYPING_CURSOR = " ▌"
+
+LINK_START = re.compile(r'\[[^\]]*$|\[[^\]]*\]\([^)]*$')
+
+
+def close_markdown(text):
+    """
+    Make a partially generated Markdown text safe to send.
+
+    Half written links are cut and open code blocks, inline code and
+    bold/italic/strikethrough markers are closed.
+    """
+    # A link whose text or url is still being written is dropped until it is complete
+    match = LINK_START.search(text)
+    if match:
+        text = text[:match.start()]
+
+    # Half written "**" / "__" / "~~" at the very end
+    text = re.sub(r'(?<![*_~])[*_~]$', '', text)
+
+    suffix = ""
+    if text.count("```") % 2:
+        return text + "\n```"
+
+    outside_code = re.sub(r'```.*?```', '', text, flags=re.S)
+    if outside_code.count("`") % 2:
+        suffix += "`"
+        # Markers inside the open inline code don't count
+        outside_code = outside_code[:outside_code.rfind("`")]
+    outside_code = re.sub(r'`[^`]*`', '', outside_code)
+
+    for marker in ("**", "__", "~~"):
+        if outside_code.count(marker) % 2:
+            suffix += marker
+    return text + suffix
+
+
+class ProgressiveMessage:
+    """A message that is posted early and edited while its text is generated"""
+
+    def __init__(self, client, chat_id, loop, prefix="", bucket=None,
+                 should_post=None, parse_mode="Markdown",
+                 min_interval=STREAM_EDIT_INTERVAL, min_chars=STREAM_MIN_CHARS):
+        self.client = client
+        self.chat_id = chat_id
+        self.loop = loop
+        self.prefix = prefix
+        self.bucket = bucket
+        self.should_post = should_post or (lambda text: True)
+        self.parse_mode = parse_mode
+        self.min_interval = min_interval
+        self.min_chars = min_chars
+
+        self.lock = threading.Lock()
+        self.text = ""
+        self.final = False
+        self.pump = None
+        self.message = None
+        self.shown = None
+        self.last_edit = 0.0
+
+    # ---------- called from the workflow thread ---------------------------
+    def feed(self, text):
+        """Update the text generated so far"""
+        with self.lock:
+            self.text = text
+            if self.pump is None or self.pump.done():
+                self.pump = asyncio.run_coroutine_threadsafe(self._pump(), self.loop)
+
+    def finish(self, text, timeout=60):
+        """
+        Publish the final text. Returns True when it is on Telegram, False when
+        the caller should deliver it some other way (or not at all).
+        """
+        with self.lock:
+            self.text = text
+            self.final = True
+            pump = self.pump
+        try:
+            if pump is not None:
+                pump.result(timeout)
+            return asyncio.run_coroutine_threadsafe(self._publish_final(text), self.loop).result(timeout)
+        except Exception as e:
+            print(f"Error finishing streamed message: {e}")
+            return False
+
+    # ---------- running on the event loop ---------------------------------
+    async def _pump(self):
+        while True:
+            wait = self.last_edit + self.min_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            with self.lock:
+                text, final = self.text, self.final
+            if final or text == self.shown:
+                return
+            if len(text.strip()) < self.min_chars or not self.should_post(text):
+                return
+            await self._show(close_markdown(text) + TYPING_CURSOR)
+            self.shown = text
+
+    async def _show(self, text):
+        if self.bucket is not None:
+            await self.bucket.acquire()
+        try:
+            if self.message is None:
+                self.message = await self.client.send_message(self.chat_id, self.prefix + text,
+                                                              parse_mode=self.parse_mode)
+            else:
+                await self.message.edit(self.prefix + text, parse_mode=self.parse_mode)
+        except MessageNotModifiedError:
+            pass
+        except FloodWaitError as e:
+            # Skip the intermediate edits until Telegram lets us talk again
+            print(f"FloodWait while streaming, pausing edits for {e.seconds}s")
+            if self.bucket is not None:
+                self.bucket.penalise(e.seconds)
+            self.last_edit = time.monotonic() + e.seconds
+            return
+        except Exception as e:
+            print(f"Error streaming message: {e}")
+        self.last_edit = time.monotonic()
+
+    async def _publish_final(self, text):
+        if not self.should_post(text):
+            # The placeholder turned out to be noise (e.g. "no match"), remove it
+            if self.message is not None:
+                try:
+                    await self.message.delete()
+                except Exception as e:
+                    print(f"Error deleting streamed message: {e}")
+                self.message = None
+            return False
+
+        if self.message is None:
+            return False
+
+        chunks = split_message(self.prefix + text)
+        wait = self.last_edit + self.min_interval - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        if self.bucket is not None:
+            await self.bucket.acquire()
+        try:
+            await self.message.edit(chunks[0], parse_mode=self.parse_mode)
+            for chunk in chunks[1:]:
+                if self.bucket is not None:
+                    await self.bucket.acquire()
+                await self.client.send_message(self.chat_id, chunk, parse_mode=self.parse_mode)
+            print("Streamed message finished")
+            return True
+        except MessageNotModifiedError:
+            return True
+        except Exception as e:
+            # The partial message stays up, the caller sends the complete one
+            print(f"Error publishing final streamed message: {e}")
+            return False
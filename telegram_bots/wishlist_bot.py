@@ -8,7 +8,17 @@ from telethon.tl.custom import Button
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 import os
+import time
+from decimal import Decimal
+from urllib.parse import urlsplit, urlunsplit
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
+from agent.categories import tag_categories, get_category_matrix
+from agent.coupon_store import active_coupons, ACTIVE_COUPON_REFRESH_SECONDS
+from agent.cart_optimiser import best_plan
+from agent.product_ids import product_id
+from agent.message_templates import render_deal_message
+from agent.models import WishlistItem, to_cents
 
 # Load environment variables
 load_dotenv()
@@ -39,70 +49,335 @@ ML_PATTERN = re.compile(r'https?://[a-zA-Z0-9.-]+mercadoli[v|b]re\.[a-zA-Z0-9.]+
 
 bot_token = os.getenv("TELEGRAM_BOT_TOKEN")  # Add your bot token to .env file
 
+# Number of items shown per /list page
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "10"))
+
+# Maximum number of rendered /list pages kept in memory
+LIST_CACHE_SIZE = 200
+
+# Product pages fetched at the same time by /import
+IMPORT_CONCURRENCY = int(os.getenv("IMPORT_CONCURRENCY", "8"))
+
+# Most URLs added by one /import, and the largest file it accepts
+IMPORT_MAX_ITEMS = int(os.getenv("IMPORT_MAX_ITEMS", "500"))
+
+# Time the known coupon check may spend on the cart search before answering with the best carts found
+KNOWN_COUPON_DEADLINE_SECONDS = float(os.getenv("KNOWN_COUPON_DEADLINE_SECONDS", "0.05"))
+IMPORT_MAX_FILE_BYTES = 1024 * 1024
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def strip_url(url):
+    """URL without the trailing punctuation of the text around it"""
+    return url.rstrip(').,;]>"\'')
+
+def canonical_url(url):
+    """Product URL without tracking parameters, fragment and trailing punctuation"""
+    parts = urlsplit(strip_url(url))
+    return urlunsplit(("https", parts.netloc.lower(), parts.path.rstrip("/"), "", ""))
+
+def dedupe_key(url):
+    """Same key for the links of one product: its id (the query may hold it), else the canonical URL"""
+    return product_id(strip_url(url)) or canonical_url(url)
+
+def encode_cursor(direction, row):
+    """Encode a keyset cursor as inline button data (Telegram allows up to 64 bytes)"""
+    added_at_us = (row['added_at'] - EPOCH) // timedelta(microseconds=1)
+    return f"list:{direction}:{added_at_us}:{row['id']}".encode()
+
+def decode_cursor(data):
+    """Decode the inline button data back into (direction, (added_at, id))"""
+    _, direction, added_at_us, item_id = data.decode().split(":")
+    return direction, (EPOCH + timedelta(microseconds=int(added_at_us)), int(item_id))
+
 class WishlistBot:
-    def __init__(self):
-        self.client = TelegramClient(SESSION, API_ID, API_HASH)
+    def __init__(self, client=None):
+        # A client can be injected (e.g. by the load test harness)
+        self.client = client or TelegramClient(SESSION, API_ID, API_HASH)
         self.db_pool = None
+        # Rendered /list pages, keyed by (direction, cursor), cleared whenever the wishlist changes
+        self.list_cache = {}
+        # Coupons still valid, a new item is checked against them as soon as it is added
+        self.coupon_store = active_coupons
+        # Items of each user, kept in sync by the handlers so the known coupon check needs no query
+        self.user_wishlists = {}
         
     async def init_db(self):
         self.db_pool = await asyncpg.create_pool(DATABASE_URL)
+
+    async def index_product_ids(self):
+        """Fill wishlist.product_id of the rows added before the column existed"""
+        async with self.db_pool.acquire() as conn:
+            rows = await conn.fetch('SELECT id, url FROM wishlist WHERE product_id IS NULL')
+            updates = [(product_id(row['url']), row['id']) for row in rows]
+            updates = [update for update in updates if update[0] is not None]
+            if updates:
+                await conn.executemany('UPDATE wishlist SET product_id = $1 WHERE id = $2', updates)
+                print(f"Product ids indexed for {len(updates)} wishlist items")
+
+    async def load_user_wishlists(self, sender_id=None):
+        """Load the items of every user, or of one user (after an import)"""
+        async with self.db_pool.acquire() as conn:
+            if sender_id is None:
+                rows = await conn.fetch(f'SELECT {WishlistItem.SELECT_COLUMNS} FROM wishlist')
+            else:
+                rows = await conn.fetch(
+                    f'SELECT {WishlistItem.SELECT_COLUMNS} FROM wishlist WHERE added_by IS NOT DISTINCT FROM $1',
+                    sender_id
+                )
+        items = [WishlistItem.from_row(row) for row in rows]
+        if sender_id is None:
+            self.user_wishlists = {}
+        else:
+            self.user_wishlists[sender_id] = []
+        for item in items:
+            self.user_wishlists.setdefault(item.added_by, []).append(item)
         
-    async def extract_ml_info(self, url):
-        """Extract title and price from Mercado Livre URL"""
+    def product_page_url(self, url):
+        """URL the product page is fetched from (the load test points it to a local server)"""
+        return url
+
+    def categorise(self, title):
+        """Category tags of a title, runs in a worker thread"""
+        return tag_categories(title)
+
+    async def extract_ml_info(self, url, session=None):
+        """Extract title and price from Mercado Livre URL (bulk imports share one aiohttp session)"""
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers={'User-Agent': 'Mozilla/5.0'}) as response:
-                    if response.status == 200:
-                        html = await response.text()
-                        soup = BeautifulSoup(html, 'html.parser')
-                        
-                        # Extract title and price (adjust selectors as needed)
-                        title_elem = soup.select_one('h1.ui-pdp-title')
-                        price_elem = soup.select_one('span.andes-money-amount__fraction')
-                        
-                        title = title_elem.text.strip() if title_elem else 'Unknown Title'
-                        price = price_elem.text.strip() if price_elem else '0'
-                        
-                        try:
-                            price = float(price.replace('.', '').replace(',', '.'))
-                        except ValueError:
-                            price = 0.0
-                            
-                        return title, price
-                        
+            if session is None:
+                async with aiohttp.ClientSession() as session:
+                    return await self.fetch_ml_info(session, url)
+            return await self.fetch_ml_info(session, url)
         except Exception as e:
             print(f"Error extracting info: {e}")
             
         return 'Unknown Title', 0.0
+
+    async def fetch_ml_info(self, session, url):
+        async with session.get(self.product_page_url(url), headers={'User-Agent': 'Mozilla/5.0'}) as response:
+            if response.status == 200:
+                html = await response.text()
+                soup = BeautifulSoup(html, 'html.parser')
+                
+                # Extract title and price (adjust selectors as needed)
+                title_elem = soup.select_one('h1.ui-pdp-title')
+                price_elem = soup.select_one('span.andes-money-amount__fraction')
+                
+                title = title_elem.text.strip() if title_elem else 'Unknown Title'
+                price = price_elem.text.strip() if price_elem else '0'
+                
+                try:
+                    price = float(price.replace('.', '').replace(',', '.'))
+                except ValueError:
+                    price = 0.0
+                    
+                return title, price
+
+        return 'Unknown Title', 0.0
         
     async def add_to_wishlist(self, url, sender_id):
         """Add an item to the wishlist"""
         title, price = await self.extract_ml_info(url)
+
+        # Category tags are computed once here, so the sales agent never has to embed wishlist items
+        categories = []
+        if title != 'Unknown Title':
+            loop = asyncio.get_running_loop()
+            categories = await loop.run_in_executor(None, self.categorise, title)
         
         async with self.db_pool.acquire() as conn:
-            await conn.execute(
+            item_id = await conn.fetchval(
                 '''
-                INSERT INTO wishlist (url, title, price, added_by)
-                VALUES ($1, $2, $3, $4)
+                INSERT INTO wishlist (url, title, price, added_by, categories, product_id)
+                VALUES ($1, $2, $3, $4, $5, $6)
+                RETURNING id
                 ''',
-                url, title, price, sender_id
+                url, title, price, sender_id, categories, product_id(url)
             )
+        self.list_cache.clear()
+        self.user_wishlists.setdefault(sender_id, []).append(
+            WishlistItem(item_id, url, title, to_cents(price), sender_id, categories)
+        )
         
-        return title, price
+        return item_id, title, price
+
+    async def known_coupon_alert(self, item_id, sender_id):
+        """
+        Run the optimiser on the user's wishlist with the coupons already known to be valid,
+        returns the deal message if the best cart includes the new item, None otherwise
+        """
+        coupons = [coupon for coupon in self.coupon_store.active() if coupon.has_rules]
+        if not coupons:
+            return None
+
+        # In memory only, no query and no LLM call. The subset tables of the user's previous
+        # items are cached by the optimiser, the search usually only adds the new item.
+        wishlist = list(self.user_wishlists.get(sender_id, []))
+        deadline = time.time() + KNOWN_COUPON_DEADLINE_SECONDS
+        loop = asyncio.get_running_loop()
+        plan = await loop.run_in_executor(None, lambda: best_plan(coupons, wishlist, deadline=deadline))
+        carts = [cart for cart in plan["carts"] if any(item.id == item_id for item in cart["items"])]
+        if not carts:
+            return None
+
+        used = {cart["coupon"] for cart in carts}
+        return "🎟️ Um cupom conhecido vale para este item!\n\n" + render_deal_message(
+            [coupon for coupon in coupons if coupon.code in used], plan
+        )
+
+    async def refresh_active_coupons(self):
+        """Pick up the coupons inserted by the sales listener when it runs in another process"""
+        while True:
+            await asyncio.sleep(ACTIVE_COUPON_REFRESH_SECONDS)
+            try:
+                await self.coupon_store.refresh_since(self.db_pool)
+            except Exception as e:
+                print(f"Error refreshing the active coupons: {e}")
         
-    async def list_wishlist(self):
-        """List all items in the wishlist"""
+    async def import_urls(self, text, sender_id):
+        """
+        Add every Mercado Livre URL of a text (message or file) to the sender's wishlist,
+        scraping with bounded concurrency and inserting with a single COPY. Returns the summary.
+        """
+        found = ML_PATTERN.findall(text)
+        # The URLs are stored as sent (pdp_filters=item_id picks the listing of a catalog page)
+        unique = {}
+        for url in found:
+            unique.setdefault(dedupe_key(url), strip_url(url))
+        urls = list(unique.values())
+        repeated = len(found) - len(urls)
+        over_limit = max(0, len(urls) - IMPORT_MAX_ITEMS)
+        urls = urls[:IMPORT_MAX_ITEMS]
+
+        # Dedupe against the sender's items (idx_wishlist_added_by)
         async with self.db_pool.acquire() as conn:
-            rows = await conn.fetch('SELECT id, title, url, price FROM wishlist ORDER BY added_at DESC')
-            
+            rows = await conn.fetch('SELECT url FROM wishlist WHERE added_by IS NOT DISTINCT FROM $1', sender_id)
+        existing = {dedupe_key(row['url']) for row in rows}
+        new_urls = [url for url in urls if dedupe_key(url) not in existing]
+
+        semaphore = asyncio.Semaphore(IMPORT_CONCURRENCY)
+        async with aiohttp.ClientSession() as session:
+            async def scrape(url):
+                async with semaphore:
+                    return await self.extract_ml_info(url, session)
+            infos = await asyncio.gather(*(scrape(url) for url in new_urls))
+
+        loop = asyncio.get_running_loop()
+        categories = await loop.run_in_executor(
+            None, lambda: [self.categorise(title) if title != 'Unknown Title' else [] for title, _ in infos]
+        )
+
+        records = [
+            (url, title, Decimal(str(price)), sender_id, item_categories, product_id(url))
+            for url, (title, price), item_categories in zip(new_urls, infos, categories)
+        ]
+        if records:
+            async with self.db_pool.acquire() as conn:
+                await conn.copy_records_to_table(
+                    'wishlist', records=records, columns=['url', 'title', 'price', 'added_by', 'categories', 'product_id']
+                )
+            self.list_cache.clear()
+            # COPY returns no ids
+            await self.load_user_wishlists(sender_id)
+
+        not_scraped = sum(1 for title, _ in infos if title == 'Unknown Title')
+        summary = f"📥 Importação concluída: {len(records)} itens adicionados à sua lista de desejos."
+        if not_scraped:
+            summary += f"\n⚠️ {not_scraped} sem título e preço (a página não pôde ser lida)."
+        if len(urls) - len(new_urls):
+            summary += f"\n↩️ {len(urls) - len(new_urls)} já estavam na sua lista."
+        if repeated:
+            summary += f"\n🔁 {repeated} links repetidos ignorados."
+        if over_limit:
+            summary += f"\n✂️ {over_limit} links acima do limite de {IMPORT_MAX_ITEMS} não foram importados."
+        return summary
+
+    async def on_import_command(self, event):
+        """/import with the URLs in the message, or in an attached text/CSV file"""
+        text = event.text or ""
+        if event.message.file:
+            if event.message.file.size and event.message.file.size > IMPORT_MAX_FILE_BYTES:
+                await event.reply(f"❌ Arquivo muito grande, o limite é {IMPORT_MAX_FILE_BYTES // 1024} KB.")
+                return
+            data = await event.message.download_media(file=bytes)
+            text += "\n" + data.decode("utf-8", errors="ignore")
+
+        count = len(set(ML_PATTERN.findall(text)))
+        if not count:
+            await event.reply("Nenhum link do Mercado Livre encontrado. Envie /import com os links, "
+                              "ou anexe um arquivo .txt/.csv com /import na legenda.")
+            return
+
+        # One message, edited with the summary at the end
+        status = await event.reply(f"⏳ Importando {count} links...")
+        summary = await self.import_urls(text, event.sender_id)
+        await status.edit(summary)
+
+    async def fetch_wishlist_page(self, direction="next", cursor=None):
+        """
+        Fetch one page of the wishlist using keyset pagination on (added_at, id).
+
+        Returns the rows (newest first) and whether there are previous and next pages.
+        """
+        async with self.db_pool.acquire() as conn:
+            if cursor is None:
+                rows = await conn.fetch(
+                    'SELECT id, title, url, price, added_at FROM wishlist '
+                    'ORDER BY added_at DESC, id DESC LIMIT $1',
+                    LIST_PAGE_SIZE + 1
+                )
+            elif direction == "next":
+                rows = await conn.fetch(
+                    'SELECT id, title, url, price, added_at FROM wishlist '
+                    'WHERE (added_at, id) < ($1, $2) '
+                    'ORDER BY added_at DESC, id DESC LIMIT $3',
+                    cursor[0], cursor[1], LIST_PAGE_SIZE + 1
+                )
+            else:
+                rows = await conn.fetch(
+                    'SELECT id, title, url, price, added_at FROM wishlist '
+                    'WHERE (added_at, id) > ($1, $2) '
+                    'ORDER BY added_at ASC, id ASC LIMIT $3',
+                    cursor[0], cursor[1], LIST_PAGE_SIZE + 1
+                )
+
+        has_more = len(rows) > LIST_PAGE_SIZE
+        rows = rows[:LIST_PAGE_SIZE]
+        if direction == "prev" and cursor is not None:
+            rows.reverse()
+            return rows, has_more, True
+        return rows, cursor is not None, has_more
+
+    async def list_wishlist(self, direction="next", cursor=None):
+        """List one page of the wishlist, returning the text and the navigation buttons"""
+        key = (direction, cursor)
+        if key in self.list_cache:
+            return self.list_cache[key]
+
+        rows, has_prev, has_next = await self.fetch_wishlist_page(direction, cursor)
+
+        if not rows and cursor is None:
+            return "Sua lista de desejos está vazia.", None
+
         if not rows:
-            return "Sua lista de desejos está vazia."
-            
-        result = "📋 Sua Lista de Desejos:\n\n"
-        for row in rows:
-            result += f"**ID:** {row['id']}\n[{row['title']}]({row['url']})\n Preço: R${row['price']:.2f}\n\n"
-            
-        return result
+            # The page we were on no longer exists (items were removed), go back to the start
+            page = ("Não há mais itens nesta página.", [Button.inline("⏮ Início", data=b"list:first")])
+        else:
+            result = "📋 Sua Lista de Desejos:\n\n"
+            for row in rows:
+                result += f"**ID:** {row['id']}\n[{row['title']}]({row['url']})\n Preço: R${row['price']:.2f}\n\n"
+
+            buttons = []
+            if has_prev:
+                buttons.append(Button.inline("⬅️ Anterior", data=encode_cursor("prev", rows[0])))
+            if has_next:
+                buttons.append(Button.inline("Próxima ➡️", data=encode_cursor("next", rows[-1])))
+            page = (result, buttons or None)
+
+        if len(self.list_cache) >= LIST_CACHE_SIZE:
+            self.list_cache.clear()
+        self.list_cache[key] = page
+        return page
         
     async def delete_from_wishlist(self, item_id):
         """Delete an item from the wishlist"""
@@ -116,26 +391,50 @@ class WishlistBot:
                 'DELETE FROM wishlist WHERE id = $1',
                 item_id
             )
+        self.list_cache.clear()
+        for items in self.user_wishlists.values():
+            items[:] = [item for item in items if item.id != item_id]
             
         if result and result.split()[-1] != '0':
             return f"✅ Item {item_id} foi removido da sua lista de desejos."
         else:
             return f"❌ Item com ID {item_id} não encontrado na sua lista de desejos."
             
+    async def on_mercadolivre_url(self, event):
+        """Add the Mercado Livre URL of a message to the sender's wishlist"""
+        sender_id = event.sender_id
+        url = ML_PATTERN.search(event.text).group(0)
+        
+        item_id, title, price = await self.add_to_wishlist(url, sender_id)
+        
+        await event.reply(f"✅ Adicionado à sua lista de desejos:\n{title}\nPreço: R${price:.2f}")
+
+        # Coupons seen before the item was added are applied right away
+        alert = await self.known_coupon_alert(item_id, sender_id)
+        if alert:
+            await event.reply(alert, parse_mode="Markdown")
+
     async def setup_handlers(self):
-        @self.client.on(events.NewMessage(chats=GROUP, pattern=ML_PATTERN))
-        async def on_mercadolivre_url(event):
-            sender_id = event.sender_id
-            url = ML_PATTERN.search(event.text).group(0)
-            
-            title, price = await self.add_to_wishlist(url, sender_id)
-            
-            await event.reply(f"✅ Adicionado à sua lista de desejos:\n{title}\nPreço: R${price:.2f}")
+        # Messages starting with /import are handled (all their URLs at once) by on_import_command
+        self.client.add_event_handler(self.on_mercadolivre_url, events.NewMessage(
+            chats=GROUP, pattern=ML_PATTERN, func=lambda event: not (event.raw_text or "").startswith('/import')
+        ))
+        self.client.add_event_handler(self.on_import_command, events.NewMessage(chats=GROUP, pattern=r'^/import'))
             
         @self.client.on(events.NewMessage(chats=GROUP, pattern=r'^/list$'))
         async def on_list_command(event):
-            wishlist = await self.list_wishlist()
-            await event.reply(wishlist, parse_mode="Markdown")
+            wishlist, buttons = await self.list_wishlist()
+            await event.reply(wishlist, parse_mode="Markdown", buttons=buttons)
+
+        @self.client.on(events.CallbackQuery(chats=GROUP, pattern=rb'^list:'))
+        async def on_list_page(event):
+            if event.data == b"list:first":
+                wishlist, buttons = await self.list_wishlist()
+            else:
+                direction, cursor = decode_cursor(event.data)
+                wishlist, buttons = await self.list_wishlist(direction, cursor)
+            await event.edit(wishlist, parse_mode="Markdown", buttons=buttons)
+            await event.answer()
             
         @self.client.on(events.NewMessage(chats=GROUP, pattern=r'^/delete\s+(\d+)$'))
         async def on_delete_command(event):
@@ -150,14 +449,22 @@ class WishlistBot:
             /help - Mostrar esta mensagem de ajuda
             /list - Mostrar sua lista de desejos
             /delete [number] - Remover um item da sua lista de desejos
+            /import [links] - Adicionar vários links de uma vez (ou anexe um arquivo .txt/.csv)
             """
             await event.reply(help_text)
             
     async def start(self):
         await self.init_db()
+        await self.index_product_ids()
+        await self.load_user_wishlists()
+        await self.coupon_store.refresh_since(self.db_pool)
+        print(f"{len(self.coupon_store)} active coupons loaded")
+        asyncio.create_task(self.refresh_active_coupons())
         await self.setup_handlers()
         
         await self.client.start(bot_token=bot_token)
+        # The embedding model (for the category tags) loads in the background once the bot is connected
+        asyncio.get_running_loop().run_in_executor(None, get_category_matrix)
         await self.client.run_until_disconnected()
 
 
@@ -0,0 +1,303 @@
+"""
+Load test of the wishlist bot URL ingestion (scrape + categorise + insert).
+
+    python run_bots.py loadtest-wishlist [messages] [rate] [--latency=0.3] [--jitter=0.2]
+        [--error-rate=0.05] [--pool-size=10] [--pages=DIR] [--database] [--skip-categories]
+
+Three parts:
+    - ProductPageServer: local HTTP server with Mercado Livre product pages (recorded .html
+      files from --pages, or a built-in page), with configurable latency and error rate
+    - fake Telethon events fired at the chosen rate into WishlistBot.on_mercadolivre_url
+    - an in-memory connection pool, or the local database with --database (rows are removed after)
+
+The report gives the throughput, the scrape / insert / end-to-end latency percentiles
+and the connection pool saturation.
+"""
+import os
+import glob
+import time
+import random
+import asyncio
+import zlib
+from aiohttp import web
+
+# wishlist_bot reads it at import time, the load test never talks to Telegram
+os.environ.setdefault("WISHLIST_GROUP_ID", "0")
+
+from telegram_bots.wishlist_bot import WishlistBot
+from agent.coupon_store import ActiveCouponStore
+
+# added_by of the load test rows, so they can be removed from a real database
+LOADTEST_SENDER_ID = -424242
+
+PRODUCT_PAGE = """<!DOCTYPE html>
+<html lang="pt-BR"><head><title>{title} | Mercado Livre</title></head>
+<body>
+<div class="ui-pdp-container">
+  <h1 class="ui-pdp-title">{title}</h1>
+  <div class="ui-pdp-price__second-line">
+    <span class="andes-money-amount__currency-symbol">R$</span>
+    <span class="andes-money-amount__fraction">{price}</span>
+  </div>
+</div>
+</body></html>
+"""
+
+PRODUCTS = [
+    "Fone De Ouvido Bluetooth Sem Fio", "Filamento PLA 1kg 1.75mm", "Tênis De Corrida Masculino",
+    "Cafeteira Elétrica 30 Xícaras", "Kit 3 Camisetas Básicas Algodão", "Mouse Gamer RGB 12000 DPI",
+    "Panela De Pressão 4,5 Litros", "Livro Arquitetura Limpa", "Smartwatch Monitor Cardíaco",
+]
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class ProductPageServer:
+    """Local product pages with latency and errors"""
+
+    def __init__(self, latency=0.3, jitter=0.2, error_rate=0.0, pages_dir=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.pages = []
+        for path in sorted(glob.glob(os.path.join(pages_dir, "*.html"))) if pages_dir else []:
+            with open(path, encoding="utf-8") as f:
+                self.pages.append(f.read())
+        self.requests = 0
+        self.runner = None
+
+    def page(self, path):
+        # Same page for a path in every run (the built-in hash() of a str is salted per process)
+        number = zlib.crc32(path.encode())
+        if self.pages:
+            return self.pages[number % len(self.pages)]
+        title = f"{PRODUCTS[number % len(PRODUCTS)]} {number % 1000}"
+        price = f"{(number % 2000) + 19:,}".replace(",", ".") + ",90"
+        return PRODUCT_PAGE.format(title=title, price=price)
+
+    async def handle(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        if random.random() < self.error_rate:
+            return web.Response(status=503, text="Service Unavailable")
+        return web.Response(text=self.page(request.path), content_type="text/html")
+
+    async def start(self, port=0):
+        app = web.Application()
+        app.router.add_get("/{path:.*}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+
+class InMemoryConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def fetchval(self, query, *args):
+        await asyncio.sleep(self.pool.query_latency)
+        self.pool.rows.append(args)
+        return len(self.pool.rows)
+
+    async def execute(self, query, *args):
+        await asyncio.sleep(self.pool.query_latency)
+        return "OK 1"
+
+    async def fetch(self, query, *args):
+        await asyncio.sleep(self.pool.query_latency)
+        return []
+
+    async def copy_records_to_table(self, table, records, columns=None):
+        await asyncio.sleep(self.pool.query_latency)
+        self.pool.rows.extend(records)
+        return f"COPY {len(records)}"
+
+
+class InMemoryPool:
+    """Stand-in for an asyncpg pool, with max_size connections and a fixed query latency"""
+
+    def __init__(self, max_size=10, query_latency=0.005):
+        self.max_size = max_size
+        self.query_latency = query_latency
+        self.rows = []
+        self.semaphore = asyncio.Semaphore(max_size)
+
+    def get_max_size(self):
+        return self.max_size
+
+    def acquire(self):
+        pool = self
+
+        class Acquire:
+            async def __aenter__(self):
+                await pool.semaphore.acquire()
+                return InMemoryConnection(pool)
+
+            async def __aexit__(self, *exc):
+                pool.semaphore.release()
+
+        return Acquire()
+
+
+class InstrumentedPool:
+    """Wraps a pool to measure the acquire waits, the time connections are held and the saturation"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.size = pool.get_max_size()
+        self.in_use = 0
+        self.max_in_use = 0
+        self.waits = []
+        self.holds = []
+        self.saturated_since = None
+        self.saturated_seconds = 0.0
+
+    def _update(self, delta):
+        now = time.perf_counter()
+        if self.in_use >= self.size and self.saturated_since is not None:
+            self.saturated_seconds += now - self.saturated_since
+            self.saturated_since = None
+        self.in_use += delta
+        self.max_in_use = max(self.max_in_use, self.in_use)
+        if self.in_use >= self.size:
+            self.saturated_since = now
+
+    def acquire(self):
+        instrumented = self
+
+        class Acquire:
+            async def __aenter__(self):
+                start = time.perf_counter()
+                self.context = instrumented.pool.acquire()
+                conn = await self.context.__aenter__()
+                self.acquired = time.perf_counter()
+                instrumented.waits.append(self.acquired - start)
+                instrumented._update(1)
+                return conn
+
+            async def __aexit__(self, *exc):
+                instrumented.holds.append(time.perf_counter() - self.acquired)
+                instrumented._update(-1)
+                return await self.context.__aexit__(*exc)
+
+        return Acquire()
+
+    async def close(self):
+        await self.pool.close()
+
+
+class FakeClient:
+    """Telethon client stand-in, events are fired directly into the handlers"""
+
+    def add_event_handler(self, callback, event=None):
+        pass
+
+
+class FakeEvent:
+    """The parts of a Telethon NewMessage event used by on_mercadolivre_url"""
+
+    def __init__(self, text, sender_id):
+        self.text = text
+        self.sender_id = sender_id
+        self.replies = []
+
+    async def reply(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class LoadTestWishlistBot(WishlistBot):
+    """WishlistBot fetching the product pages from the local server, with timings"""
+
+    def __init__(self, page_server_url, skip_categories=False):
+        super().__init__(client=FakeClient())
+        self.page_server_url = page_server_url
+        self.skip_categories = skip_categories
+        # No known coupon, the ingestion path only
+        self.coupon_store = ActiveCouponStore()
+        self.scrapes = []
+        self.scrape_errors = 0
+
+    def product_page_url(self, url):
+        return self.page_server_url + "/" + url.split("://", 1)[1].split("/", 1)[1]
+
+    def categorise(self, title):
+        return [] if self.skip_categories else super().categorise(title)
+
+    async def extract_ml_info(self, url, session=None):
+        start = time.perf_counter()
+        title, price = await super().extract_ml_info(url, session)
+        self.scrapes.append(time.perf_counter() - start)
+        if title == 'Unknown Title':
+            self.scrape_errors += 1
+        return title, price
+
+
+async def run_wishlist_load_test(messages=100, rate=20.0, latency=0.3, jitter=0.2, error_rate=0.05,
+                                 pool_size=10, pages_dir=None, use_database=False, skip_categories=False):
+    """Fire `messages` URL messages at `rate` per second into the wishlist bot and print the report"""
+    server = ProductPageServer(latency, jitter, error_rate, pages_dir)
+    base_url = await server.start()
+    bot = LoadTestWishlistBot(base_url, skip_categories)
+
+    if use_database:
+        import asyncpg
+        from telegram_bots.wishlist_bot import DATABASE_URL
+        pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=pool_size)
+    else:
+        pool = InMemoryPool(pool_size)
+    bot.db_pool = InstrumentedPool(pool)
+
+    if not skip_categories:
+        # The model load is startup cost, not ingestion
+        await asyncio.get_running_loop().run_in_executor(None, bot.categorise, "aquecimento")
+
+    latencies = []
+    failures = 0
+
+    async def handle(event):
+        nonlocal failures
+        start = time.perf_counter()
+        try:
+            await bot.on_mercadolivre_url(event)
+            latencies.append(time.perf_counter() - start)
+        except Exception as e:
+            failures += 1
+            print(f"Handler failed: {e}")
+
+    print(f"Firing {messages} messages at {rate}/s (page latency {latency}s + up to {jitter}s, "
+          f"{error_rate:.0%} errors, pool of {pool_size}, {'local database' if use_database else 'in-memory pool'})")
+    start = time.perf_counter()
+    tasks = []
+    for i in range(messages):
+        url = f"https://produto.mercadolivre.com.br/MLB-{3000000000 + i}-produto-teste-{i}-_JM"
+        tasks.append(asyncio.create_task(handle(FakeEvent(f"olha esse {url}", LOADTEST_SENDER_ID))))
+        await asyncio.sleep(1 / rate)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    if use_database:
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM wishlist WHERE added_by = $1", LOADTEST_SENDER_ID)
+        await pool.close()
+    await server.stop()
+
+    instrumented = bot.db_pool
+    print(f"\nThroughput: {len(latencies) / elapsed:.1f} msg/s ({len(latencies)} handled in {elapsed:.1f}s, "
+          f"{failures} failed, {bot.scrape_errors} pages not scraped)")
+    print(f"{'latency (ms)':<20} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for label, values in [("scrape", bot.scrapes), ("insert (conn held)", instrumented.holds),
+                          ("pool acquire wait", instrumented.waits), ("end to end", latencies)]:
+        print(f"{label:<20} " + " ".join(f"{percentile(values, p) * 1000:>8.1f}" for p in (50, 95, 99, 100)))
+    print(f"\nPool: {instrumented.max_in_use}/{instrumented.size} connections in use at most, "
+          f"saturated {instrumented.saturated_seconds / elapsed:.1%} of the time")
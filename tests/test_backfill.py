@@ -0,0 +1,178 @@
+import asyncio
+import datetime
+
+import pytest
+
+from telegram_bots import backfill
+from telegram_bots.backfill import HistoryBackfill
+
+CHAT = "Promoções"
+
+
+class FakeMessage:
+    def __init__(self, message_id, text=None):
+        self.id = message_id
+        self.text = f"oferta {message_id}" if text is None else text
+        self.sender_id = 42
+        self.date = datetime.datetime(2026, 1, 1) + datetime.timedelta(minutes=message_id)
+
+
+class FakeClient:
+    """get_entity and iter_messages of Telethon over a list of messages, failing after `fail_after` messages"""
+
+    def __init__(self, messages, fail_after=None):
+        self.messages = messages
+        self.fail_after = fail_after
+        self.min_ids = []
+
+    async def get_entity(self, group):
+        return type("Entity", (), {"title": CHAT})()
+
+    async def iter_messages(self, entity, min_id=0, reverse=False, limit=None):
+        assert reverse
+        self.min_ids.append(min_id)
+        sent = 0
+        for message in self.messages:
+            if message.id <= min_id:
+                continue
+            if limit is not None and sent >= limit:
+                return
+            if self.fail_after is not None and sent >= self.fail_after:
+                raise ConnectionError("disconnected")
+            sent += 1
+            yield message
+
+
+class FakeDatabase:
+    """telegram_messages and backfill_state, the changes of a transaction are kept only when it commits"""
+
+    def __init__(self, stored=()):
+        self.stored = {message_id: None for message_id in stored}
+        self.high_water_marks = {}
+        # Message ids of each committed batch
+        self.batches = []
+        self.closed = False
+        self.in_transaction = False
+
+    def __enter__(self):
+        self.pending = (dict(self.stored), dict(self.high_water_marks), [])
+        self.in_transaction = True
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.in_transaction = False
+        if exc_type is None:
+            self.stored, self.high_water_marks, batch = self.pending
+            if batch:
+                self.batches.append(batch)
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        pass
+
+
+class FakeCursor:
+    def __init__(self, database):
+        self.database = database
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, query, args=()):
+        stored, high_water_marks, batch = self.database.pending
+        if "SELECT high_water_mark" in query:
+            self.rows = [(high_water_marks[args[0]],)] if args[0] in high_water_marks else []
+        elif "SELECT message_id" in query:
+            batch.extend(args[1])
+            self.rows = [(message_id,) for message_id in args[1] if message_id in stored]
+        elif "INSERT INTO backfill_state" in query:
+            high_water_marks[args[0]] = max(high_water_marks.get(args[0], 0), args[1])
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+
+def fake_execute_values(cur, query, rows, template, page_size):
+    assert template.count("%s") == len(rows[0])
+    for row in rows:
+        cur.database.pending[0][row[2]] = row
+
+
+class FakeBackfill(HistoryBackfill):
+    def __init__(self, client, database, **kwargs):
+        super().__init__(client, database_url="postgresql://test", embed=self.embed_texts, **kwargs)
+        self.database = database
+        self.embedded = []
+
+    def connection(self):
+        return self.database
+
+    def embed_texts(self, texts):
+        # No transaction is held open while embedding
+        assert not self.database.in_transaction
+        self.embedded.append(list(texts))
+        return [[0.1] * backfill.EMBEDDING_DIMENSIONS for _ in texts]
+
+
+@pytest.fixture(autouse=True)
+def no_database(monkeypatch):
+    monkeypatch.setattr(backfill, "execute_values", fake_execute_values)
+
+
+def test_skips_stored_and_empty_messages():
+    messages = [FakeMessage(i) for i in range(1, 11)]
+    messages[6] = FakeMessage(7, text="   ")
+    database = FakeDatabase(stored=[3, 5])
+    runner = FakeBackfill(FakeClient(messages), database, batch_size=100)
+
+    stats = asyncio.run(runner.backfill_chat("promocoes"))
+
+    assert stats.fetched == 10
+    assert stats.stored == 7
+    assert stats.skipped == 3
+    assert runner.embedded == [[f"oferta {i}" for i in (1, 2, 4, 6, 8, 9, 10)]]
+    assert set(database.stored) == set(range(1, 11)) - {7}
+    assert database.high_water_marks == {CHAT: 10}
+
+
+def test_batch_boundaries():
+    database = FakeDatabase()
+    runner = FakeBackfill(FakeClient([FakeMessage(i) for i in range(1, 251)]), database, batch_size=100)
+
+    asyncio.run(runner.backfill_chat("promocoes"))
+
+    assert database.batches == [list(range(1, 101)), list(range(101, 201)), list(range(201, 251))]
+    assert [len(texts) for texts in runner.embedded] == [100, 100, 50]
+    assert database.high_water_marks == {CHAT: 250}
+
+
+def test_resumes_from_high_water_mark_after_interruption():
+    messages = [FakeMessage(i) for i in range(1, 301)]
+    database = FakeDatabase()
+
+    # The connection drops in the middle of the third batch, that batch is never stored
+    client = FakeClient(messages, fail_after=250)
+    with pytest.raises(ConnectionError):
+        asyncio.run(FakeBackfill(client, database, batch_size=100).backfill_chat("promocoes"))
+    assert database.high_water_marks == {CHAT: 200}
+    assert set(database.stored) == set(range(1, 201))
+
+    client = FakeClient(messages)
+    runner = FakeBackfill(client, database, batch_size=100)
+    stats = asyncio.run(runner.backfill_chat("promocoes"))
+
+    assert client.min_ids == [200]
+    assert stats.fetched == 100
+    assert stats.stored == 100
+    assert database.batches[-1] == list(range(201, 301))
+    assert set(database.stored) == set(range(1, 301))
+    assert database.high_water_marks == {CHAT: 300}
@@ -0,0 +1,132 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from aiohttp import web
+from langchain_core.messages import HumanMessage
+
+from agent.fake_llm_server import FakeLLMProvider
+from agent.llm_gateway import LLMGateway
+
+MODEL_TIERS = {"small": "small-model", "large": "large-model"}
+PROMPT_TIERS = {"coupon_extraction": "small", "deal_message": "large"}
+MESSAGES = [HumanMessage(content="Cupom MELI20: R$ 20 OFF acima de R$ 100")]
+
+
+class ScriptedProvider(FakeLLMProvider):
+    """FakeLLMProvider answering 429 to its first `rate_limited` requests"""
+
+    def __init__(self, rate_limited=0, **kwargs):
+        super().__init__(**kwargs)
+        self.rate_limited = rate_limited
+
+    async def chat_completions(self, request):
+        self.rate_limit_rate = 1.0 if self.rate_limited > 0 else 0.0
+        self.rate_limited -= 1
+        return await super().chat_completions(request)
+
+
+def serve(provider):
+    """Run the provider on a free local port in a background thread, returns (base_url, stop)"""
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(provider.app())
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+    return f"http://127.0.0.1:{port}", stop
+
+
+@pytest.fixture
+def start_provider(monkeypatch):
+    monkeypatch.setenv("GROQ_API_KEY", "test")
+    stops = []
+
+    def start(provider, **kwargs):
+        base_url, stop = serve(provider)
+        stops.append(stop)
+        return LLMGateway(model_tiers=MODEL_TIERS, prompt_tiers=PROMPT_TIERS, base_url=base_url, **kwargs)
+    yield start
+    for stop in stops:
+        stop()
+
+
+def test_routes_prompt_types_to_their_tier(start_provider):
+    provider = FakeLLMProvider(reply="ok", latency=0)
+    gateway = start_provider(provider, hedge_model=None)
+
+    assert gateway.invoke("coupon_extraction", MESSAGES).content == "ok"
+    gateway.invoke("deal_message", MESSAGES)
+    # Prompt types without a tier use the large model
+    gateway.invoke("unknown_prompt", MESSAGES)
+
+    assert provider.requests == {"small-model": 1, "large-model": 2}
+
+
+def test_pauses_after_429(start_provider):
+    provider = ScriptedProvider(rate_limited=1, reply="ok", latency=0, retry_after=0.5)
+    gateway = start_provider(provider, hedge_model=None, max_retries=2)
+
+    start = time.monotonic()
+    response = gateway.invoke("coupon_extraction", MESSAGES)
+
+    assert response.content == "ok"
+    assert provider.requests["small-model"] == 2
+    # The retry waits for the retry-after of the 429, whatever the jittered backoff
+    assert time.monotonic() - start >= 0.5
+    assert gateway.limiters["small-model"].blocked_until > 0
+
+
+def test_gives_up_after_max_retries(start_provider):
+    provider = ScriptedProvider(rate_limited=10, latency=0, retry_after=0)
+    gateway = start_provider(provider, hedge_model=None, max_retries=1)
+
+    with pytest.raises(Exception) as error:
+        gateway.invoke("coupon_extraction", MESSAGES)
+
+    assert getattr(error.value, "status_code", None) == 429
+    assert provider.requests["small-model"] == 2
+
+
+def test_hedges_slow_calls(start_provider):
+    provider = FakeLLMProvider(reply="ok", model_latency={"large-model": 2.0, "hedge-model": 0.05})
+    gateway = start_provider(provider, hedge_model="hedge-model", hedge_after=0.1)
+
+    start = time.monotonic()
+    response = gateway.invoke("deal_message", MESSAGES)
+
+    assert response.content == "ok"
+    assert time.monotonic() - start < 1.5
+    assert provider.requests == {"large-model": 1, "hedge-model": 1}
+    assert provider.responses == {"hedge-model": 1}
+
+
+def test_fast_calls_are_not_hedged(start_provider):
+    provider = FakeLLMProvider(reply="ok", latency=0)
+    gateway = start_provider(provider, hedge_model="hedge-model", hedge_after=1)
+
+    gateway.invoke("deal_message", MESSAGES)
+
+    assert provider.requests == {"large-model": 1}
+
+
+def test_hedge_winner_cancels_the_primary(start_provider):
+    provider = FakeLLMProvider(reply="ok", latency=0)
+    gateway = start_provider(provider, hedge_model="hedge-model", hedge_after=0.1)
+    # The primary waits for its rate limit, the hedge answers first
+    gateway.client("large-model")
+    gateway.limiters["large-model"].pause(0.5)
+
+    gateway.invoke("deal_message", MESSAGES)
+    time.sleep(0.7)
+
+    assert provider.requests == {"hedge-model": 1}
@@ -0,0 +1,36 @@
+import pytest
+
+from agent.product_ids import is_short_link, product_id, sale_price_cents
+
+
+@pytest.mark.parametrize("message, cents", [
+    ("Fone Bluetooth por R$ 199,90", 19990),
+    ("de R$ 299 por R$ 199", 19900),
+    ("De R$ 2.499,00 por R$ 1.899,00 à vista", 189900),
+    ("por R$ 299,90 ou 10x de R$ 29,99", 29990),
+    ("R$ 299,90 em até 10x sem juros de R$ 29,99", 29990),
+    ("R$ 450 ou 3 parcelas de R$ 150", 45000),
+    ("R$ 1.899 + frete grátis, cashback R$ 50", 189900),
+    ("R$ 1.899 e R$ 50 de cashback", 189900),
+    ("Use o cupom de R$ 20 e leve por R$ 120", 12000),
+    ("R$ 30 OFF acima de R$ 199: tênis por R$ 249,90", 24990),
+    ("Compra mínima de R$ 99, camiseta R$ 59,90", 5990),
+    ("Frete de R$ 15, produto R$ 89,90", 8990),
+    ("Sem preço na mensagem", None),
+])
+def test_sale_price_cents(message, cents):
+    assert sale_price_cents(message) == cents
+
+
+def test_product_id():
+    assert product_id("https://produto.mercadolivre.com.br/MLB-1234567890-fone-_JM?tracking_id=x") == "MLB1234567890"
+    assert product_id("https://www.mercadolivre.com.br/fone/p/MLB19876543#reco") == "MLB19876543"
+    assert product_id("https://www.mercadolivre.com.br/fone/p/MLB19876543?pdp_filters=item_id:MLB1234567890") == "MLB1234567890"
+    assert product_id("https://www.amazon.com.br/dp/MLB1234567890") is None
+
+
+def test_is_short_link():
+    assert is_short_link("https://meli.la/2xYz")
+    assert is_short_link("https://mercadolivre.com/sec/1abc")
+    assert not is_short_link("https://meli.lab.com/x")
+    assert not is_short_link("https://produto.mercadolivre.com.br/MLB-1234567890")
@@ -0,0 +1,53 @@
+import threading
+
+# Initialize the embedding model (lazy loading - will load on first use)
+embedding_model = None
+# The listener and the wishlist bot may run in different threads of the same process
+embedding_model_lock = threading.Lock()
+
+def get_embedding_model():
+    """Get or initialize the embedding model"""
+    global embedding_model
+    with embedding_model_lock:
+        if embedding_model is None:
+            # Load the model - this will download it if not already present
+            print("Loading embedding model...")
+            # sentence_transformers (and torch) take seconds to import, only pay for it when the model is needed
+            from sentence_transformers import SentenceTransformer
+            embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+            print("Embedding model loaded")
+    return embedding_model
+
+def get_embedding(text):
+    """Generate embedding for the given text using MiniLM"""
+    try:
+        if not text or text.strip() == "":
+            return None
+            
+        # Truncate text if it's too long
+        if len(text) > 5000:  # Arbitrary limit to avoid memory issues
+            text = text[:5000]
+            
+        model = get_embedding_model()
+        embedding = model.encode(text)
+        
+        # Convert to list for database storage
+        return embedding.tolist()
+    except Exception as e:
+        print(f"Error generating embedding: {e}")
+        return None
+
+def get_embeddings(texts, batch_size=64):
+    """Embeddings of many texts, encoded in batches (None for the empty ones)"""
+    embeddings = [None] * len(texts)
+    indices = [i for i, text in enumerate(texts) if text and text.strip()]
+    if not indices:
+        return embeddings
+    try:
+        model = get_embedding_model()
+        vectors = model.encode([texts[i][:5000] for i in indices], batch_size=batch_size)
+        for i, vector in zip(indices, vectors):
+            embeddings[i] = vector.tolist()
+    except Exception as e:
+        print(f"Error generating embeddings: {e}")
+    return embeddings
@@ -0,0 +1,243 @@
+"""
+Opt-in sampling profiler for slow workflow runs.
+
+With PROFILE_SLOW_RUNS=true, a background thread samples the Python stacks of the
+process every PROFILE_INTERVAL_MS while a run is in progress. When the run took
+longer than PROFILE_THRESHOLD_SECONDS, its samples are written to PROFILE_DIR as a
+speedscope file (https://www.speedscope.app) or collapsed stacks (flamegraph.pl,
+speedscope), with a .meta.json holding the tag (message id), the duration and the
+workflow node timings. Fast runs are discarded. Oldest profiles are deleted to keep
+PROFILE_DIR under PROFILE_MAX_FILES runs and PROFILE_MAX_MB.
+
+Every thread is sampled (LangGraph runs parallel nodes and the LLM hedges in pools),
+the root frame of each stack is the thread name, "*" marks the thread of the run.
+"""
+import os
+import re
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from functools import wraps
+
+PROFILE_SLOW_RUNS = os.getenv("PROFILE_SLOW_RUNS", "false").lower() == "true"
+PROFILE_THRESHOLD_SECONDS = float(os.getenv("PROFILE_THRESHOLD_SECONDS", "10"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "10"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_FORMAT = os.getenv("PROFILE_FORMAT", "speedscope")  # speedscope or collapsed
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "50"))
+PROFILE_MAX_MB = float(os.getenv("PROFILE_MAX_MB", "50"))
+
+# Deeper stacks are cut at the root side
+MAX_STACK_DEPTH = 128
+
+# Run being profiled in the current context, workflow nodes add their timings to it
+current_run = ContextVar("current_run", default=None)
+
+
+class RunProfile:
+    """Samples and node timings of one run"""
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.thread_id = threading.get_ident()
+        self.started = time.perf_counter()
+        self.duration = None
+        # thread label -> [(seconds since the start, stack as a tuple of frame keys, root first)]
+        self.samples = {}
+        # (node, start, duration) in seconds since the start of the run
+        self.node_timings = []
+
+
+class StackSampler:
+    """One sampling thread for the whole process, only awake while runs are being profiled"""
+
+    def __init__(self, interval_ms=PROFILE_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self.runs = set()
+        self.lock = threading.Lock()
+        self.has_runs = threading.Event()
+        self.thread = None
+
+    def add(self, run: RunProfile):
+        with self.lock:
+            self.runs.add(run)
+            self.has_runs.set()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name="stack-sampler", daemon=True)
+                self.thread.start()
+
+    def remove(self, run: RunProfile):
+        with self.lock:
+            self.runs.discard(run)
+            if not self.runs:
+                self.has_runs.clear()
+
+    @staticmethod
+    def stack(frame):
+        frames = []
+        while frame is not None and len(frames) < MAX_STACK_DEPTH:
+            code = frame.f_code
+            frames.append((code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        frames.reverse()
+        return tuple(frames)
+
+    def _loop(self):
+        own = threading.get_ident()
+        while True:
+            self.has_runs.wait()
+            now = time.perf_counter()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = {
+                ident: self.stack(frame)
+                for ident, frame in sys._current_frames().items() if ident != own
+            }
+            with self.lock:
+                runs = list(self.runs)
+            for run in runs:
+                elapsed = now - run.started
+                for ident, stack in stacks.items():
+                    label = names.get(ident, str(ident)) + (" *" if ident == run.thread_id else "")
+                    run.samples.setdefault(label, []).append((elapsed, stack))
+            time.sleep(self.interval)
+
+
+sampler = StackSampler()
+
+@contextmanager
+def profile_run(tag, threshold_seconds=PROFILE_THRESHOLD_SECONDS):
+    """Profile the enclosed run, its profile is written only if it is slower than the threshold"""
+    if not PROFILE_SLOW_RUNS:
+        yield None
+        return
+
+    run = RunProfile(str(tag))
+    token = current_run.set(run)
+    sampler.add(run)
+    try:
+        yield run
+    finally:
+        sampler.remove(run)
+        current_run.reset(token)
+        run.duration = time.perf_counter() - run.started
+        if run.duration >= threshold_seconds:
+            try:
+                path = write_profile(run)
+                print(f"Slow run {run.tag} ({run.duration:.1f}s), profile written to {path}")
+            except Exception as e:
+                print(f"Could not write the profile of {run.tag}: {e}")
+
+def timed_node(name, function):
+    """Wrap a workflow node so its duration is recorded in the run being profiled"""
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        run = current_run.get()
+        if run is None:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            run.node_timings.append((name, start - run.started, time.perf_counter() - start))
+    return wrapper
+
+
+def frame_name(frame_key):
+    name, filename, line = frame_key
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+def collapsed_stacks(run: RunProfile) -> str:
+    """Brendan Gregg's collapsed format, one "thread;root;...;leaf count" line per stack"""
+    counts = {}
+    for label, samples in run.samples.items():
+        for _, stack in samples:
+            key = ";".join([label.replace(";", ":")] + [frame_name(frame) for frame in stack])
+            counts[key] = counts.get(key, 0) + 1
+    return "\n".join(f"{stack} {count}" for stack, count in sorted(counts.items())) + "\n"
+
+def speedscope_profile(run: RunProfile) -> dict:
+    """speedscope file with one sampled profile per thread"""
+    frames = []
+    frame_index = {}
+
+    def index(frame_key):
+        if frame_key not in frame_index:
+            frame_index[frame_key] = len(frames)
+            name, filename, line = frame_key
+            frames.append({"name": name, "file": filename, "line": line})
+        return frame_index[frame_key]
+
+    nodes = ", ".join(f"{name} {duration:.2f}s" for name, _, duration in run.node_timings)
+    profiles = []
+    for label, samples in sorted(run.samples.items(), key=lambda item: not item[0].endswith("*")):
+        stacks = [[index(frame) for frame in stack] for _, stack in samples]
+        times = [elapsed for elapsed, _ in samples]
+        # Each sample lasts until the next one
+        weights = [round((nxt - cur) * 1000, 3) for cur, nxt in zip(times, times[1:] + [run.duration])]
+        profiles.append({
+            "type": "sampled",
+            "name": label,
+            "unit": "milliseconds",
+            "startValue": 0,
+            "endValue": round(run.duration * 1000, 3),
+            "samples": stacks,
+            "weights": weights,
+        })
+
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": f"{run.tag} {run.duration:.1f}s" + (f" [{nodes}]" if nodes else ""),
+        "exporter": "mercadolivre-coupon-agent",
+        "activeProfileIndex": 0,
+        "shared": {"frames": frames},
+        "profiles": profiles,
+    }
+
+def write_profile(run: RunProfile, directory=PROFILE_DIR, profile_format=PROFILE_FORMAT) -> str:
+    """Write the profile and its metadata, then trim the directory to the disk budget"""
+    os.makedirs(directory, exist_ok=True)
+    safe_tag = re.sub(r"[^A-Za-z0-9_.-]+", "_", run.tag)[:80]
+    base = os.path.join(directory, f"{datetime.now():%Y%m%d-%H%M%S}_{safe_tag}_{run.duration:.1f}s")
+
+    if profile_format == "collapsed":
+        path = base + ".collapsed.txt"
+        with open(path, "w") as f:
+            f.write(collapsed_stacks(run))
+    else:
+        path = base + ".speedscope.json"
+        with open(path, "w") as f:
+            json.dump(speedscope_profile(run), f)
+
+    with open(base + ".meta.json", "w") as f:
+        json.dump({
+            "tag": run.tag,
+            "duration_seconds": round(run.duration, 3),
+            "samples": sum(len(samples) for samples in run.samples.values()),
+            "nodes": [{"node": name, "start": round(start, 3), "duration": round(duration, 3)}
+                      for name, start, duration in run.node_timings],
+            "profile": os.path.basename(path),
+        }, f, indent=2)
+
+    trim_profiles(directory)
+    return path
+
+def trim_profiles(directory=PROFILE_DIR, max_files=PROFILE_MAX_FILES, max_mb=PROFILE_MAX_MB):
+    """Delete the oldest runs (profile + metadata) beyond the file count or the size budget"""
+    runs = {}
+    for name in os.listdir(directory):
+        base = name.split(".", 1)[0]
+        path = os.path.join(directory, name)
+        runs.setdefault(base, []).append(path)
+
+    # Names start with the timestamp, so they sort oldest first
+    ordered = sorted(runs.items())
+    total = sum(os.path.getsize(path) for _, paths in ordered for path in paths)
+    while ordered and (len(ordered) > max_files or total > max_mb * 1024 * 1024):
+        _, paths = ordered.pop(0)
+        for path in paths:
+            total -= os.path.getsize(path)
+            os.remove(path)
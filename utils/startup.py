@@ -0,0 +1,91 @@
+"""
+Startup report of run_bots.py --profile-startup.
+
+Measures what importing each bot costs, which heavy dependencies it pulls at import
+time (they should only be loaded in the background, after Telegram is connected),
+and how long the lazy initialisations take.
+
+    python run_bots.py --profile-startup sales
+"""
+import sys
+import time
+import importlib
+
+# Dependencies that take seconds to import, none should be loaded by importing a bot
+HEAVY_MODULES = ["torch", "sentence_transformers", "numpy", "langchain_groq", "langgraph", "langchain_core"]
+
+# Module imported by each run_bots.py command
+COMMAND_MODULES = {
+    "sales": ["telegram_bots.sales_listener"],
+    "wishlist": ["telegram_bots.wishlist_bot"],
+    "test": ["telegram_bots.sales_listener"],
+    "both": ["telegram_bots.sales_listener", "telegram_bots.wishlist_bot"],
+}
+
+def timed(label, function, rows):
+    start = time.perf_counter()
+    try:
+        function()
+        status = ""
+    except Exception as e:
+        status = f"failed: {e}"
+    rows.append((label, (time.perf_counter() - start) * 1000, status))
+
+def init_embedding_model():
+    from utils.embeddings import get_embedding_model
+    get_embedding_model()
+
+def init_category_matrix():
+    from agent.categories import get_category_matrix
+    get_category_matrix()
+
+def init_workflow():
+    # Compiled without the Postgres checkpointer, the report doesn't need a database
+    from agent.sales_evaluation_agent import instantiate_workflow
+    instantiate_workflow()
+
+def init_deal_classifier():
+    from agent.deal_classifier import get_deal_classifier
+    get_deal_classifier()
+
+def init_llm_client():
+    from agent.llm_gateway import gateway
+    gateway.client(gateway.model_for("coupon_extraction"))
+
+# Lazy initialisations of each command, in the order the bots run them
+COMMAND_INITS = {
+    "sales": [("embedding model", init_embedding_model), ("workflow compile", init_workflow),
+              ("deal classifier", init_deal_classifier), ("LLM client", init_llm_client)],
+    "wishlist": [("embedding model", init_embedding_model), ("category embeddings", init_category_matrix)],
+    "test": [],
+}
+COMMAND_INITS["both"] = COMMAND_INITS["sales"] + COMMAND_INITS["wishlist"][1:]
+
+def print_rows(title, rows):
+    print(f"\n{title}")
+    for label, milliseconds, status in rows:
+        print(f"  {label:<45} {milliseconds:>9.1f} ms  {status}")
+    print(f"  {'total':<45} {sum(ms for _, ms, _ in rows):>9.1f} ms")
+
+def profile_startup(command="both"):
+    """Print the import and init time breakdown of a run_bots.py command"""
+    command = command if command in COMMAND_MODULES else "both"
+    print(f"Startup profile of '{command}'")
+
+    # What the bot pays before it can connect to Telegram
+    rows = []
+    for module in COMMAND_MODULES[command]:
+        timed(f"import {module}", lambda: importlib.import_module(module), rows)
+    print_rows("Import time (before connecting to Telegram):", rows)
+
+    loaded = [module for module in HEAVY_MODULES if module in sys.modules]
+    print(f"\nHeavy modules loaded at import: {', '.join(loaded) if loaded else 'none'}")
+
+    # What is loaded in the background, after the connection
+    rows = []
+    for module in HEAVY_MODULES:
+        if module not in sys.modules:
+            timed(f"import {module}", lambda: importlib.import_module(module), rows)
+    for label, function in COMMAND_INITS[command]:
+        timed(label, function, rows)
+    print_rows("Background loading (after connecting to Telegram):", rows)
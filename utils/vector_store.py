@@ -0,0 +1,240 @@
+"""
+Storage modes of the message embeddings in telegram_messages.
+
+    vector   full float32 `embedding` column (1.5 KB per message), exact search
+    halfvec  float16 `embedding_half` column (half the size), HNSW search with a wider candidate list
+    binary   `embedding_bits` column (48 bytes) for the HNSW search, candidates re-ranked
+             with the exact distance on `embedding_half`
+
+Select the mode with EMBEDDING_STORAGE. Existing rows are converted with
+`python run_bots.py migrate-vectors <mode>` and the modes are compared with
+`python run_bots.py bench-vectors` (size, latency and recall@k against float32).
+"""
+import os
+import time
+import psycopg2
+from utils.database import get_database_url
+
+EMBEDDING_STORAGE = os.getenv("EMBEDDING_STORAGE", "vector")
+STORAGE_MODES = ("vector", "halfvec", "binary")
+
+# Candidates of the HNSW search for each result (binary mode re-ranks them on the halfvec copy)
+EMBEDDING_RERANK_FACTOR = int(os.getenv("EMBEDDING_RERANK_FACTOR", "4"))
+
+EMBEDDING_DIMENSIONS = 384
+
+# Text of the embedding of a row whatever the mode it was stored with ('[0.1,0.2,...]')
+EMBEDDING_TEXT_SQL = "COALESCE(embedding::text, embedding_half::text)"
+
+def vector_literal(embedding) -> str:
+    """pgvector text format of an embedding, cast in SQL to vector or halfvec"""
+    return "[" + ",".join(f"{float(value):.7g}" for value in embedding) + "]"
+
+def storage_columns(embedding, mode=EMBEDDING_STORAGE):
+    """Columns, SQL placeholders and values to insert an embedding in the given mode"""
+    if embedding is None:
+        return [], [], []
+    literal = vector_literal(embedding)
+    if mode == "halfvec":
+        return ["embedding_half"], ["%s::halfvec"], [literal]
+    if mode == "binary":
+        return (["embedding_half", "embedding_bits"],
+                ["%s::halfvec", f"binary_quantize(%s::vector)::bit({EMBEDDING_DIMENSIONS})"],
+                [literal, literal])
+    return ["embedding"], ["%s::vector"], [literal]
+
+def search_similar(cursor, query_embedding, limit=5, mode=EMBEDDING_STORAGE, rerank_factor=EMBEDDING_RERANK_FACTOR):
+    """Rows (id, chat_title, message_text, similarity) of the messages closest to the query"""
+    query = vector_literal(query_embedding)
+    candidates = limit * max(rerank_factor, 1)
+
+    if mode == "binary":
+        # Hamming distance on the bits finds the candidates, the halfvec cosine distance orders them
+        cursor.execute("SET LOCAL hnsw.ef_search = %s", (max(40, candidates),))
+        cursor.execute(
+            f"""
+            SELECT id, chat_title, message_text, 1 - (embedding_half <=> %(query)s::halfvec) AS similarity
+            FROM (
+                SELECT id, chat_title, message_text, embedding_half
+                FROM telegram_messages
+                WHERE embedding_bits IS NOT NULL
+                ORDER BY embedding_bits <~> binary_quantize(%(query)s::vector)::bit({EMBEDDING_DIMENSIONS})
+                LIMIT %(candidates)s
+            ) candidates
+            ORDER BY embedding_half <=> %(query)s::halfvec
+            LIMIT %(limit)s
+            """,
+            {"query": query, "candidates": candidates, "limit": limit}
+        )
+    elif mode == "halfvec":
+        # The HNSW distances are already the halfvec ones (the float32 column is usually cleared),
+        # so there is nothing to re-rank with, a wider candidate list of the search keeps the recall
+        cursor.execute("SET LOCAL hnsw.ef_search = %s", (max(40, candidates),))
+        cursor.execute(
+            """
+            SELECT id, chat_title, message_text, 1 - (embedding_half <=> %(query)s::halfvec) AS similarity
+            FROM telegram_messages
+            WHERE embedding_half IS NOT NULL
+            ORDER BY embedding_half <=> %(query)s::halfvec
+            LIMIT %(limit)s
+            """,
+            {"query": query, "limit": limit}
+        )
+    else:
+        cursor.execute(
+            """
+            SELECT id, chat_title, message_text, 1 - (embedding <=> %(query)s::vector) AS similarity
+            FROM telegram_messages
+            WHERE embedding IS NOT NULL
+            ORDER BY embedding <=> %(query)s::vector
+            LIMIT %(limit)s
+            """,
+            {"query": query, "limit": limit}
+        )
+    return cursor.fetchall()
+
+def exact_search_ids(cursor, query_embedding, limit):
+    """Ids of the true nearest messages on the float32 column (sequential scan, the benchmark reference)"""
+    cursor.execute("SET LOCAL enable_indexscan = off")
+    cursor.execute("SET LOCAL enable_bitmapscan = off")
+    cursor.execute(
+        """
+        SELECT id FROM telegram_messages
+        WHERE embedding IS NOT NULL
+        ORDER BY embedding <=> %s::vector
+        LIMIT %s
+        """,
+        (vector_literal(query_embedding), limit)
+    )
+    ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute("RESET enable_indexscan")
+    cursor.execute("RESET enable_bitmapscan")
+    return ids
+
+
+def migrate_embeddings(mode=EMBEDDING_STORAGE, batch_size=1000, clear_float32=False, database_url=None):
+    """
+    Fill the columns of a storage mode from the float32 embeddings, one batch per transaction.
+
+    With clear_float32 the float32 column is emptied afterwards (run VACUUM FULL telegram_messages
+    to give the space back); the benchmark needs it, so only clear it once the mode is chosen.
+    """
+    if mode not in ("halfvec", "binary"):
+        print(f"Nothing to migrate for the '{mode}' storage mode")
+        return
+
+    target = "embedding_bits" if mode == "binary" else "embedding_half"
+    assignments = "embedding_half = embedding::halfvec"
+    if mode == "binary":
+        assignments += f", embedding_bits = binary_quantize(embedding)::bit({EMBEDDING_DIMENSIONS})"
+    if clear_float32:
+        assignments += ", embedding = NULL"
+
+    converted = 0
+    last_id = 0
+    start = time.perf_counter()
+    conn = psycopg2.connect(database_url or get_database_url())
+    try:
+        while True:
+            with conn, conn.cursor() as cur:
+                # Keyset batches on the primary key, short transactions keep the listener writing
+                cur.execute(
+                    f"""
+                    WITH batch AS (
+                        SELECT id FROM telegram_messages
+                        WHERE id > %s AND embedding IS NOT NULL AND ({target} IS NULL OR %s)
+                        ORDER BY id
+                        LIMIT %s
+                    )
+                    UPDATE telegram_messages t SET {assignments}
+                    FROM batch WHERE t.id = batch.id
+                    RETURNING t.id
+                    """,
+                    (last_id, clear_float32, batch_size)
+                )
+                ids = [row[0] for row in cur.fetchall()]
+            if not ids:
+                break
+            last_id = max(ids)
+            converted += len(ids)
+            print(f"Converted {converted} embeddings ({converted / (time.perf_counter() - start):.0f}/s)")
+    finally:
+        conn.close()
+    print(f"Migration to '{mode}' done: {converted} rows")
+
+
+def storage_report(cursor):
+    """Average bytes per row of each embedding column and the size of each vector index"""
+    cursor.execute(
+        """
+        SELECT COALESCE(AVG(pg_column_size(embedding)), 0),
+               COALESCE(AVG(pg_column_size(embedding_half)), 0),
+               COALESCE(AVG(pg_column_size(embedding_bits)), 0),
+               COUNT(*)
+        FROM telegram_messages
+        """
+    )
+    float32, half, bits, rows = cursor.fetchone()
+    cursor.execute(
+        """
+        SELECT indexrelid::regclass::text, pg_relation_size(indexrelid)
+        FROM pg_index
+        WHERE indrelid = 'telegram_messages'::regclass
+          AND indexrelid::regclass::text IN (
+              'idx_telegram_messages_embedding', 'idx_telegram_messages_embedding_half', 'idx_telegram_messages_embedding_bits')
+        """
+    )
+    indexes = dict(cursor.fetchall())
+    return {
+        "rows": rows,
+        "vector": (float(float32), indexes.get("idx_telegram_messages_embedding", 0)),
+        "halfvec": (float(half), indexes.get("idx_telegram_messages_embedding_half", 0)),
+        # Binary mode keeps the halfvec copy for the re-rank
+        "binary": (float(half) + float(bits), indexes.get("idx_telegram_messages_embedding_bits", 0)),
+    }
+
+def benchmark_vectors(queries=50, k=10, database_url=None):
+    """Compare the storage modes on disk/RAM size, query latency and recall@k against exact float32 search"""
+    conn = psycopg2.connect(database_url or get_database_url())
+    try:
+        with conn, conn.cursor() as cur:
+            report = storage_report(cur)
+            # Queries are stored messages, the float32 column is the reference
+            cur.execute(
+                """
+                SELECT embedding::text FROM telegram_messages
+                WHERE embedding IS NOT NULL AND embedding_half IS NOT NULL AND embedding_bits IS NOT NULL
+                ORDER BY random() LIMIT %s
+                """,
+                (queries,)
+            )
+            samples = [[float(value) for value in text.strip("[]").split(",")] for (text,) in cur.fetchall()]
+
+        if not samples:
+            print("No message has every column filled, run `python run_bots.py migrate-vectors binary` first")
+            return
+
+        truth = []
+        with conn, conn.cursor() as cur:
+            for sample in samples:
+                truth.append(set(exact_search_ids(cur, sample, k)))
+
+        print(f"{report['rows']} messages, {len(samples)} queries, recall@{k} against exact float32 search\n")
+        print(f"{'mode':<8} {'bytes/row':>10} {'index (RAM)':>12} {'mean ms':>9} {'p95 ms':>8} {'recall':>8}")
+        for mode in STORAGE_MODES:
+            latencies = []
+            hits = 0
+            with conn, conn.cursor() as cur:
+                for sample, expected in zip(samples, truth):
+                    start = time.perf_counter()
+                    rows = search_similar(cur, sample, k, mode)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    hits += len(expected & {row[0] for row in rows})
+            latencies.sort()
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            recall = hits / max(sum(len(expected) for expected in truth), 1)
+            row_bytes, index_bytes = report[mode]
+            print(f"{mode:<8} {row_bytes:>10.0f} {index_bytes / 1024 / 1024:>10.1f}MB "
+                  f"{sum(latencies) / len(latencies):>9.2f} {p95:>8.2f} {recall:>8.1%}")
+    finally:
+        conn.close()